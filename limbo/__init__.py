@@ -1,3 +1,4 @@
-from .limbo import main, FakeServer, init_db, InvalidPluginDir
-from .handlers import handle_message, run_hook
+from .limbo import main, FakeServer, init_db, init_plugins, InvalidPluginDir, PluginReloader
+from .tenants import TenantManager
+from .handlers import handle_message, run_command, run_hook
 from .fakeserver import FakeSlack
@@ -0,0 +1,212 @@
+"""An asyncio runtime for the bot.
+
+The plain Slackbot handles events one after another on the loop thread, so a
+slow Server Density request delays every reply behind it. AsyncSlackbot reads
+the RTM socket from an asyncio event loop and handles every event in its own
+task. Plugin hooks are ordinary blocking functions, so they run in a thread
+pool executor, with at most `concurrency` events being handled at once.
+
+This module needs python 3.5+ and is only imported when LIMBO_ASYNC is set.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import time
+import traceback
+
+from .connection import CONNECTION_ERRORS, backoff, check_event, close_websocket
+from .handlers import handle_event, run_hook
+from .limbo import Slackbot, LOOP_INTERVAL, PING_INTERVAL
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# default number of events handled at the same time
+CONCURRENCY = 8
+
+
+class AsyncSlackbot(Slackbot):
+    def __init__(self, *args, **kwargs):
+        super(AsyncSlackbot, self).__init__(*args, **kwargs)
+        self.concurrency = int(self.config.get("concurrency", CONCURRENCY))
+        self._tasks = set()
+        self._wakeup = None
+
+    def loop(self, test_loop=None):
+        """Run the main loop on a fresh event loop until it finishes.
+        test_loop, if present, is a number of times to run the loop"""
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(self.concurrency)
+        try:
+            loop.run_until_complete(self.run(loop, executor, test_loop))
+        except KeyboardInterrupt:
+            if os.environ.get("LIMBO_DEBUG"):
+                import pdb
+                pdb.set_trace()
+            raise
+        finally:
+            executor.shutdown(wait=False)
+            loop.close()
+
+    def _socket(self):
+        websocket = getattr(self.server.slack.server, "websocket", None)
+        return getattr(websocket, "sock", None)
+
+    async def run(self, loop, executor, test_loop=None):
+        config = self.server.config or {}
+        loop_interval = float(config.get("loop_interval", LOOP_INTERVAL))
+        ping_interval = float(config.get("ping_interval", PING_INTERVAL))
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        readable = asyncio.Event()
+        # stop() runs on another thread
+        self._wakeup = lambda: loop.call_soon_threadsafe(readable.set)
+        sock = self._socket()
+        if sock is not None:
+            loop.add_reader(sock, readable.set)
+
+        loop_hook = None
+        now = time.time()
+        next_loop_hook = now
+        last_activity = now
+        try:
+            while (test_loop is None or test_loop > 0) and not self._stopping.is_set():
+                if sock is None:
+                    # no real socket (FakeSlack in tests), so just poll rtm_read
+                    readable.set()
+                elif hasattr(sock, "pending") and sock.pending():
+                    # the SSL layer may already hold decrypted bytes that the
+                    # selector behind add_reader can't see
+                    readable.set()
+
+                timeout = max(min(next_loop_hook, last_activity + ping_interval) - time.time(), 0)
+                try:
+                    await asyncio.wait_for(readable.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+                if self._stopping.is_set():
+                    break
+
+                if readable.is_set():
+                    readable.clear()
+                    try:
+                        events = self.server.slack.rtm_read()
+                        for event in events:
+                            check_event(event)
+                    except CONNECTION_ERRORS as e:
+                        sock = await self._reconnect(e, loop, executor, readable, sock)
+                        if self._stopping.is_set():
+                            break
+                        events = []
+                    if events:
+                        last_activity = time.time()
+                    for event in events:
+                        logger.debug("got {0}".format(event.get("type", event)))
+                        if self.deduper.seen(event):
+                            logger.debug("dropping repeated event {0}".format(event.get("ts")))
+                            continue
+                        task = loop.create_task(self._handle(event, loop, executor, semaphore))
+                        self._tasks.add(task)
+                        metrics.add("limbo_event_queue_depth", 1)
+                        task.add_done_callback(self._handled)
+
+                now = time.time()
+
+                # Loop hooks run in the executor as well, but never overlap
+                # with the previous run of themselves.
+                if now >= next_loop_hook and (loop_hook is None or loop_hook.done()):
+                    loop_hook = loop.run_in_executor(executor, run_hook, self.server.hooks, "loop", self.server)
+                    next_loop_hook = now + loop_interval
+
+                if now - last_activity >= ping_interval:
+                    try:
+                        self._ping()
+                    except CONNECTION_ERRORS as e:
+                        sock = await self._reconnect(e, loop, executor, readable, sock)
+                        if self._stopping.is_set():
+                            break
+                    last_activity = time.time()
+
+                if test_loop:
+                    test_loop -= 1
+
+            # test_loop ran out or the bot is stopping; let the work finish,
+            # within the drain deadline when stopping
+            pending = list(self._tasks)
+            if loop_hook is not None:
+                pending.append(loop_hook)
+            if pending:
+                timeout = None
+                if self._stopping.is_set():
+                    timeout = max(self._drain_deadline - time.time(), 0)
+                await asyncio.wait(pending, timeout=timeout)
+        finally:
+            self._wakeup = None
+            if sock is not None:
+                loop.remove_reader(sock)
+
+    async def _reconnect(self, error, loop, executor, readable, sock):
+        """Reconnects like Slackbot._reconnect without blocking the event
+        loop, so events already being handled carry on. Returns the new
+        socket."""
+        self._connected = False
+        if sock is not None:
+            loop.remove_reader(sock)
+        attempt = 0
+        while True:
+            delay = backoff(attempt)
+            logger.warning("RTM connection lost ({0}), reconnecting in {1:.1f}s".format(error, delay))
+            # stop() sets `readable` to cut the wait short
+            readable.clear()
+            try:
+                await asyncio.wait_for(readable.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            readable.clear()
+            if self._stopping.is_set():
+                return None
+            close_websocket(self.server.slack)
+            try:
+                await loop.run_in_executor(executor, self.server.slack.rtm_connect)
+            except Exception as e:
+                error = e
+                attempt += 1
+                continue
+            logger.info("RTM reconnected after {0} attempts".format(attempt + 1))
+            break
+
+        sock = self._socket()
+        if sock is not None:
+            loop.add_reader(sock, readable.set)
+        self._connected = True
+        held, self._held = self._held, []
+        for event, response in held:
+            self._reply(event, response)
+        return sock
+
+    def _wake(self):
+        wakeup = self._wakeup
+        if wakeup is not None:
+            try:
+                wakeup()
+            except RuntimeError:
+                # the event loop has just closed
+                pass
+
+    def _handled(self, task):
+        self._tasks.discard(task)
+        metrics.add("limbo_event_queue_depth", -1)
+
+    async def _handle(self, event, loop, executor, semaphore):
+        try:
+            async with semaphore:
+                response = await loop.run_in_executor(executor, handle_event, event, self.server)
+            # replies are sent from the event loop thread, the only one that
+            # touches the websocket
+            if response:
+                self._reply(event, response)
+        except Exception:
+            logger.warning("Failed to handle event {0}".format(event))
+            logger.warning("{0}".format(traceback.format_exc()))
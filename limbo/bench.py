@@ -0,0 +1,311 @@
+"""Benchmarks of the plugin commands against a stub Server Density API.
+
+    python -m limbo.bench --devices 500 --latency 0.05
+
+Every scenario sends a stream of synthetic `sdbot ...` messages, each in a
+channel of its own, through the bot: through Slackbot.loop reading a
+FakeSlack (`--runtime loop`), the same with AsyncSlackbot (`async`), or
+straight into handle_event (`direct`). The Server Density API is a StubApi
+with the inventory size and latency asked for.
+
+For every scenario the throughput, the p50 and p99 of the time from an event
+being read to its first reply, the API requests made and the peak RSS of the
+process so far are reported. `--save` stores the results as the baseline,
+and later runs fail when a scenario is slower than the baseline by more than
+`--tolerance`. A run also fails, and won't be saved, when a scenario leaves
+some of its events unanswered.
+"""
+from __future__ import print_function
+import argparse
+from collections import deque, OrderedDict
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not on windows
+    resource = None
+
+from .fakeserver import FakeServer, FakeSlack
+from .handlers import handle_event, run_hook
+from .limbo import Slackbot, init_plugins
+from .stubapi import StubApi
+
+logger = logging.getLogger(__name__)
+
+BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'baseline.json')
+TOLERANCE = 0.25
+# seconds of p99 a scenario may lose to noise whatever the tolerance, as the
+# fastest ones answer in a few milliseconds
+NOISE = 0.01
+# seconds a scenario may go without a reply before it's given up on
+TIMEOUT = 30
+# seconds rtm_read sleeps when it has nothing left to hand out
+IDLE = 0.001
+
+RESOURCE = {
+    'resourceID': 'bench',
+    'resource': {'SlackBotAccessToken': 'bench', 'SD_AUTH_TOKEN': 'bench'}
+}
+
+# the messages of each scenario; {device}, {service} and {group} cycle
+# through the stub's inventory
+SCENARIOS = OrderedDict([
+    ('help', 'sdbot help'),
+    ('devices list', 'sdbot devices list 10'),
+    ('devices find', 'sdbot devices find web-{device}$'),
+    ('devices value', 'sdbot devices value cpuStats.CPUs.usr for web-{device}'),
+    ('devices values', 'sdbot devices value cpuStats.CPUs.usr for group:group-{group}'),
+    ('devices available', 'sdbot devices available web-{device}'),
+    ('services list', 'sdbot services list'),
+    ('services status', 'sdbot services status check-{service}'),
+    ('alerts list', 'sdbot alerts list'),
+    ('graph', 'sdbot graph cpuStats.CPUs.usr for web-{device} from 1 hour ago'),
+])
+
+
+class BenchSlack(FakeSlack):
+    """Hands the events of a scenario to the bot `batch` at a time, and
+    notes when each is read and first answered, by channel"""
+
+    def __init__(self, events, batch=1):
+        super(BenchSlack, self).__init__()
+        self.pending = deque(events)
+        self.batch = batch
+        self.read_at = {}
+        self.answered_at = {}
+        self.last_answer = time.time()
+        self._lock = threading.Lock()
+
+    def rtm_read(self):
+        if not self.pending:
+            time.sleep(IDLE)
+            return []
+        events = [self.pending.popleft() for _ in range(min(self.batch, len(self.pending)))]
+        now = time.time()
+        for event in events:
+            self.read_at[event['channel']] = now
+        return events
+
+    def answer(self, channel):
+        with self._lock:
+            if channel not in self.answered_at:
+                self.answered_at[channel] = self.last_answer = time.time()
+
+    def post_message(self, channel, message, **kwargs):
+        super(BenchSlack, self).post_message(channel, message, **kwargs)
+        self.answer(channel)
+
+    def rtm_send_message(self, channel, message):
+        super(BenchSlack, self).rtm_send_message(channel, message)
+        self.answer(channel)
+
+    def done(self, timeout):
+        if self.pending:
+            return False
+        return len(self.answered_at) == len(self.read_at) or time.time() - self.last_answer > timeout
+
+
+def make_events(template, count, stub):
+    events = []
+    start = time.time()
+    for i in range(count):
+        text = template.format(device=i % max(len(stub.devices), 1),
+                               service=i % max(len(stub.services), 1),
+                               group=i % 5)
+        events.append({
+            'type': 'message',
+            'user': '2',
+            'text': text,
+            'channel': 'B{0:06d}'.format(i),
+            'ts': '{0:.6f}'.format(start + i / 1e6)
+        })
+    return events
+
+
+def run_loop(slack, BotClass, timeout):
+    bot = BotClass(None, Client=lambda token: slack, config={'loglevel': logging.WARNING})
+    thread = threading.Thread(target=bot.start, args=(RESOURCE,), name='bench-bot')
+    thread.daemon = True
+    thread.start()
+    while not slack.done(timeout):
+        time.sleep(0.01)
+    bot.stop(timeout=timeout)
+    thread.join(timeout)
+
+
+def run_direct(slack, hooks):
+    server = FakeServer(slack=slack, config={'resource': RESOURCE['resource']}, hooks=hooks)
+    while True:
+        events = slack.rtm_read()
+        if not events:
+            break
+        for event in events:
+            if handle_event(event, server):
+                slack.answer(event['channel'])
+    run_hook(hooks, 'stop', server)
+
+
+def percentile(values, q):
+    """The nearest rank `q` percentile of `values`"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(math.ceil(q * len(values))) - 1, 0)]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def run_scenario(name, stub, options, hooks=None):
+    events = make_events(SCENARIOS[name], options.events, stub)
+    slack = BenchSlack(events, options.batch)
+    stub.on_slack = lambda method, params: slack.answer(params.get('channel') or params.get('channels'))
+    requests_before = stub.requests
+    start = time.time()
+    if options.runtime == 'direct':
+        run_direct(slack, hooks)
+    else:
+        if options.runtime == 'async':
+            from .aio import AsyncSlackbot as BotClass
+        else:
+            BotClass = Slackbot
+        run_loop(slack, BotClass, options.timeout)
+
+    latencies = [slack.answered_at[channel] - read for channel, read in slack.read_at.items()
+                 if channel in slack.answered_at]
+    finished = max(slack.answered_at.values()) if slack.answered_at else time.time()
+    elapsed = max(finished - start, 1e-6)
+    return OrderedDict([
+        ('events', len(events)),
+        ('answered', len(latencies)),
+        ('throughput', len(latencies) / elapsed),
+        ('p50', percentile(latencies, 0.5)),
+        ('p99', percentile(latencies, 0.99)),
+        ('api_requests', stub.requests - requests_before),
+        ('peak_rss_mb', peak_rss_mb()),
+    ])
+
+
+def unanswered(results):
+    """The scenarios that didn't answer every event they sent, as messages"""
+    return ['{0}: answered {1} of {2} events'.format(name, result['answered'], result['events'])
+            for name, result in results.items() if result['answered'] < result['events']]
+
+
+def compare(results, baseline, tolerance):
+    """The scenarios that got slower than `baseline` by more than
+    `tolerance`, as messages"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['answered'] < base['answered']:
+            regressions.append('{0}: answered {1} events, the baseline {2}'.format(
+                name, result['answered'], base['answered']))
+        if base['p99'] and result['p99'] is not None and result['p99'] > base['p99'] * (1 + tolerance) + NOISE:
+            regressions.append('{0}: p99 {1:.1f}ms, the baseline {2:.1f}ms'.format(
+                name, result['p99'] * 1000, base['p99'] * 1000))
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('{0}: {1:.1f} events/s, the baseline {2:.1f}'.format(
+                name, result['throughput'], base['throughput']))
+    return regressions
+
+
+def report(results):
+    lines = ['{0:<18} {1:>6} {2:>8} {3:>9} {4:>9} {5:>9} {6:>9} {7:>8}'.format(
+        'scenario', 'events', 'answered', 'events/s', 'p50 ms', 'p99 ms', 'api reqs', 'rss MB')]
+    for name, result in results.items():
+        def ms(value):
+            return '-' if value is None else '{0:.1f}'.format(value * 1000)
+        lines.append('{0:<18} {1:>6} {2:>8} {3:>9.1f} {4:>9} {5:>9} {6:>9} {7:>8}'.format(
+            name, result['events'], result['answered'], result['throughput'], ms(result['p50']),
+            ms(result['p99']), result['api_requests'],
+            '-' if result['peak_rss_mb'] is None else '{0:.0f}'.format(result['peak_rss_mb'])))
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the sdbot commands against a stub Server Density API')
+    parser.add_argument('--runtime', choices=['loop', 'async', 'direct'], default='loop',
+                        help='Slackbot.loop, AsyncSlackbot or handle_event straight away (default loop)')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='Run only this scenario; may be repeated')
+    parser.add_argument('--events', type=int, default=50, help='Events per scenario (default 50)')
+    parser.add_argument('--batch', type=int, default=10, help='Events per rtm_read (default 10)')
+    parser.add_argument('--devices', type=int, default=200, help='Devices in the stub inventory (default 200)')
+    parser.add_argument('--services', type=int, default=20, help='Services in the stub inventory (default 20)')
+    parser.add_argument('--alerts', type=int, default=10, help='Open alerts in the stub (default 10)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds the stub takes to answer a request (default 0.02)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT,
+                        help='Seconds to wait for a reply before giving up on a scenario')
+    parser.add_argument('--baseline', default=BASELINE, help='The baseline file (default bench/baseline.json)')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='How much slower than the baseline a scenario may be (default 0.25)')
+    return parser.parse_args(argv)
+
+
+def settings(options):
+    """The options that make results comparable"""
+    return dict((key, getattr(options, key))
+                for key in ('runtime', 'events', 'batch', 'devices', 'services', 'alerts', 'latency'))
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    stub = StubApi(options.devices, options.services, options.alerts, options.latency).start()
+    stub.install()
+    try:
+        hooks = init_plugins(None) if options.runtime == 'direct' else None
+        results = OrderedDict()
+        for name in options.scenario or SCENARIOS:
+            results[name] = run_scenario(name, stub, options, hooks)
+    finally:
+        stub.stop()
+    print(report(results))
+    missing = unanswered(results)
+    for message in missing:
+        print('UNANSWERED ' + message)
+
+    if options.save:
+        if missing:
+            print('not saving a baseline with unanswered events')
+            return 1
+        if not os.path.isdir(os.path.dirname(options.baseline) or '.'):
+            os.makedirs(os.path.dirname(options.baseline))
+        with open(options.baseline, 'w') as f:
+            json.dump({'settings': settings(options), 'results': results}, f, indent=2)
+        print('saved the baseline to {0}'.format(options.baseline))
+        return 0
+
+    if not os.path.exists(options.baseline):
+        print('no baseline at {0}, not comparing'.format(options.baseline))
+        return 1 if missing else 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != settings(options):
+        print('the baseline was taken with {0}, not comparing'.format(baseline.get('settings')))
+        return 1 if missing else 0
+    regressions = compare(results, baseline['results'], options.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions or missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Keeping the RTM connection up.
+
+When the websocket breaks, the bot reconnects in-process rather than exiting,
+so the plugins stay loaded and their caches stay warm. Attempts are spaced
+with exponential backoff and full jitter, so a Slack outage doesn't bring
+every bot (or every team of the multi-tenant runtime) back at the same
+instant.
+
+Slack may send an event again on a new connection, so recent events are
+remembered by type, channel and `ts`, and repeats are dropped instead of
+being answered twice.
+"""
+from collections import deque
+import logging
+import random
+import socket
+
+from slackrtm.server import SlackConnectionError, SlackLoginError
+from websocket import WebSocketException
+
+logger = logging.getLogger(__name__)
+
+# seconds before the first reconnect attempt, at most
+BACKOFF_BASE = 1
+# longest wait between attempts
+BACKOFF_CAP = 60
+# number of recent events remembered to drop repeats
+SEEN_EVENTS = 1000
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+# what a broken connection looks like: a closed websocket, a socket error,
+# a failed rtm.start, or select on a socket that's already closed
+CONNECTION_ERRORS = (ConnectionLost, WebSocketException, SlackConnectionError, SlackLoginError,
+                     socket.error, ValueError)
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Seconds to wait before reconnect attempt number `attempt`, counting
+    from 0: anything up to `base * 2**attempt`, capped at `cap`"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def close_websocket(slack):
+    websocket = getattr(slack.server, "websocket", None)
+    if websocket is not None:
+        try:
+            websocket.close()
+        except Exception:
+            logger.debug("closing the RTM websocket failed", exc_info=True)
+
+
+def check_event(event):
+    """Raises ConnectionLost for the event Slack sends before it closes the
+    connection"""
+    if event.get("type") == "goodbye":
+        raise ConnectionLost("Slack said goodbye")
+
+
+class EventDeduper(object):
+    """Remembers the last `size` events that carry a `ts`"""
+
+    def __init__(self, size=SEEN_EVENTS):
+        self.size = size
+        self._seen = set()
+        self._order = deque()
+
+    def seen(self, event):
+        """True if an event with the same type, channel and ts came before"""
+        ts = event.get("ts")
+        if ts is None:
+            return False
+        channel = event.get("channel")
+        if isinstance(channel, dict):
+            channel = channel.get("id")
+        key = (event.get("type"), event.get("subtype"), channel, ts)
+        if key in self._seen:
+            return True
+        self._seen.add(key)
+        self._order.append(key)
+        if len(self._order) > self.size:
+            self._seen.discard(self._order.popleft())
+        return False
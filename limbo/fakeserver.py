@@ -18,14 +18,29 @@ class FakeServer(object):
         self.db.commit()
         return rows
 
+    def close(self):
+        pass
+
 class FakeSlack(object):
     def __init__(self, server=None, users=None, events=None):
         self.server = server or FakeSlackServer(users=users)
         self.posted_message = None
         self.events = events if events else []
+        # everything sent, as (channel, message, kwargs)
+        self.sent = []
 
     def post_message(self, channel, message, **kwargs):
         self.posted_message = (message, kwargs)
+        self.sent.append((channel, message, kwargs))
+
+    def rtm_send_message(self, channel, message):
+        self.sent.append((channel, message, {}))
+
+    def upload_file(self, channel, filename, content, filetype=None):
+        self.sent.append((channel, "", {"file": filename, "filetype": filetype}))
+
+    def rtm_connect(self):
+        return True
 
     def rtm_read(self):
         return self.events.pop() if self.events else []
@@ -49,3 +64,6 @@ class FakeSlackServer(object):
             "1": Bot("1", "otherbot", [], False)
         }
 
+    def ping(self):
+        pass
+
@@ -1,10 +1,19 @@
 import json
 import logging
+import re
 import sys
+import time
 import traceback
 
+from ..metrics import metrics
+
 logger = logging.getLogger(__name__)
 
+# Every bot command looks like `sdbot <command> ...`; the command word picks
+# the plugin from the table built by the plugin loader.
+COMMAND_PREFIX = "sdbot"
+COMMAND_PATTERN = re.compile(r"^sdbot(?:\s+(\S+)|\s*$)", re.IGNORECASE)
+
 
 def handle_bot_message(event, server):
     try:
@@ -30,7 +39,9 @@ def handle_message(event, server):
         logger.debug("event {0} has no user".format(event))
         return
 
-    return "\n".join(run_hook(server.hooks, "message", event, server))
+    responses = run_command(server.hooks, event, server)
+    responses.extend(run_hook(server.hooks, "message", event, server))
+    return "\n".join(responses)
 
 
 def handle_channel_joined(event, server):
@@ -39,6 +50,7 @@ def handle_channel_joined(event, server):
 
 
 def handle_event(event, server):
+    metrics.event(event.get("type"))
     handler = event_handlers.get(event.get("type"))
     if handler:
         return handler(event, server)
@@ -50,9 +62,39 @@ event_handlers = {
 }
 
 
+def run_command(hooks, event, server):
+    """Run the one `on_message` hook registered for the command in `event`.
+
+    Most traffic isn't meant for the bot, so anything that doesn't start with
+    the command prefix is turned away before any regex runs."""
+    commands = hooks.get("commands")
+    text = event.get("text") or ""
+    if not commands or text[:len(COMMAND_PREFIX)].lower() != COMMAND_PREFIX:
+        return []
+
+    match = COMMAND_PATTERN.match(text)
+    if not match:
+        return []
+
+    # command words are matched whatever their case, as `sdbot` is
+    command = (match.group(1) or "").lower()
+    hookfun = commands.get(command)
+    if not hookfun:
+        # words that aren't commands go to the bare `sdbot` handler, help,
+        # which answers `sdbot word` with the help on `word`
+        command = ""
+        hookfun = commands.get(command)
+    if not hookfun:
+        return []
+    with metrics.timer("limbo_command_seconds", command=command.lower()):
+        return run_hook({"message": [hookfun]}, "message", event, server)
+
+
 def run_hook(hooks, hook, *args):
     responses = []
-    for hook in hooks.get(hook, []):
+    name = hook
+    for hook in hooks.get(name, []):
+        start = time.time()
         try:
             h = hook(*args)
             if h:
@@ -61,9 +103,26 @@ def run_hook(hooks, hook, *args):
             logger.warning("Failed to run plugin {0}, module not loaded".format(hook))
             logger.warning("{0}".format(sys.exc_info()[0]))
             logger.warning("{0}".format(traceback.format_exc()))
+        finally:
+            metrics.observe("limbo_hook_seconds", time.time() - start,
+                            plugin=getattr(hook, "__module__", None) or "unknown", hook=name)
     return responses
 
 
+def run_stop(hooks, server):
+    """Runs the stop hooks of a team's server, then frees the API connections
+    and cached data the plugins share for its SD account, once"""
+    run_hook(hooks, "stop", server)
+    # imported here, the core doesn't need the plugins to load
+    from ..plugins.common.basewrapper import BaseWrapper, MissingToken
+    try:
+        BaseWrapper.release(server.config)
+    except MissingToken:
+        pass
+    except Exception:
+        logger.warning("releasing the SD account failed", exc_info=True)
+
+
 # Below is handlers specific to beepboop resources
 def bb_on_message(ws, message):
     logger.debug('Beepboop msg type: {}, msg: {}'.format(
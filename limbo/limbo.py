@@ -7,8 +7,11 @@ import importlib
 import logging
 import os
 import re
+import select
+import socket
 import sqlite3
 import sys
+import threading
 import time
 import traceback
 import json
@@ -17,12 +20,15 @@ from slackrtm import SlackClient
 from slackrtm.server import SlackConnectionError, SlackLoginError
 
 from beepboop import resourcer
-from beepboop import bot_manager
 
 from .server import LimboServer
+from .connection import CONNECTION_ERRORS, EventDeduper, backoff, check_event, close_websocket
 from .fakeserver import FakeServer
+from .manifest import LazyHook, read_manifest
+from .metrics import metrics, serve_metrics
+from .tenants import TenantManager
 
-from .handlers import handle_event, bb_handlers, run_hook
+from .handlers import handle_event, bb_handlers, run_hook, run_stop
 from .utils import (decode,
                     encode,
                     relevant_environ,
@@ -33,6 +39,13 @@ from .settings import CONFIG
 CURDIR = os.path.abspath(os.path.dirname(__file__))
 DIR = functools.partial(os.path.join, CURDIR)
 
+# seconds between runs of the `loop` hooks
+LOOP_INTERVAL = 1
+# seconds without any RTM activity before we send a keepalive ping
+PING_INTERVAL = 5
+# seconds a stopping bot waits for the events in flight to be handled
+DRAIN_TIMEOUT = 10
+
 logger = logging.getLogger(__name__)
 
 
@@ -42,6 +55,202 @@ class InvalidPluginDir(Exception):
         super(InvalidPluginDir, self).__init__(message)
 
 
+def init_log(config):
+    loglevel = config.get("loglevel", logging.INFO)
+    logformat = config.get("logformat", '%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+    if config.get("logfile"):
+        logging.basicConfig(filename=config.get("logfile"), format=logformat, level=loglevel)
+    else:
+        logging.basicConfig(format=logformat, level=loglevel)
+
+
+def split_plugins(plugins_to_load):
+    # LIMBO_PLUGINS comes as a comma separated string
+    if plugins_to_load and hasattr(plugins_to_load, "split"):
+        return plugins_to_load.split(",")
+    return plugins_to_load
+
+
+def find_plugins(plugindir):
+    """The directory plugins are imported from and the names of the plugins
+    in it"""
+    if plugindir and not os.path.isdir(plugindir):
+        raise InvalidPluginDir(plugindir)
+
+    if not plugindir:
+        plugindir = DIR("plugins")
+
+    logger.debug("plugindir: {0}".format(plugindir))
+
+    if os.path.isdir(plugindir):
+        pluginfiles = glob(os.path.join(plugindir, "[!_]*.py"))
+        plugins = strip_extension(os.path.basename(p) for p in pluginfiles)
+    else:
+        # we might be in an egg; try to get the files that way
+        logger.debug("trying pkg_resources")
+        import pkg_resources
+        try:
+            plugins = strip_extension(
+                    pkg_resources.resource_listdir(__name__, "plugins"))
+        except OSError:
+            raise InvalidPluginDir(plugindir)
+
+    return plugindir, list(plugins)
+
+
+def init_plugins(plugindir, plugins_to_load=None):
+    plugindir, plugins = find_plugins(plugindir)
+    plugins_to_load = split_plugins(plugins_to_load)
+
+    hooks = {}
+
+    oldpath = copy.deepcopy(sys.path)
+    sys.path.insert(0, plugindir)
+
+    for plugin in plugins:
+        if plugins_to_load and plugin not in plugins_to_load:
+            logger.debug("skipping plugin {0}, not in plugins_to_load {1}".format(plugin, plugins_to_load))
+            continue
+        load_plugin(hooks, plugindir, plugin)
+
+    sys.path = oldpath
+    return hooks
+
+
+def load_plugin(hooks, plugindir, plugin):
+    """Adds the hooks, commands and help of `plugin` to `hooks`. `plugindir`
+    has to be on sys.path."""
+    logger.debug("plugin: {0}".format(plugin))
+    try:
+        # a plugin whose manifest can be read from its source is only
+        # imported once one of its hooks is called
+        manifest = None
+        if os.path.isdir(plugindir) and plugin not in sys.modules:
+            manifest = read_manifest(os.path.join(plugindir, plugin + ".py"), plugin)
+        if manifest is not None:
+            modname = manifest.name
+            moddoc = manifest.doc
+            prefixes = manifest.prefixes
+            hookfuns = [(hook, LazyHook(plugindir, plugin, hook, manifest.requires.get(hook)))
+                        for hook in manifest.hooks]
+            logger.debug("plugin: read the manifest of %s, importing it on first use", modname)
+        else:
+            mod = importlib.import_module(plugin)
+            modname = mod.__name__
+            moddoc = mod.__doc__
+            prefixes = getattr(mod, "PREFIXES", None)
+            hookfuns = [(hook, getattr(mod, "on_" + hook))
+                        for hook in re.findall("on_(\w+)", " ".join(dir(mod)))]
+
+        # plugins that declare their command prefixes only see the
+        # messages addressed to them, through the command table
+        for hook, hookfun in hookfuns:
+            if hook == "message" and prefixes is not None:
+                for prefix in prefixes:
+                    logger.debug("plugin: routing command '%s' to %s", prefix, modname)
+                    hooks.setdefault("commands", {})[prefix.lower()] = hookfun
+                continue
+            logger.debug("plugin: attaching %s hook for %s", hook, modname)
+            hooks.setdefault(hook, []).append(hookfun)
+
+        if moddoc:
+            # firstline = moddoc.split('\n')[0]
+            part_attachment = json.loads(moddoc)
+            hooks.setdefault('help', {})[modname] = part_attachment
+            hooks.setdefault('extendedhelp', {})[modname] = moddoc
+
+    # bare except, because the modules could raise any number of errors
+    # on import, and we want them not to kill our server
+    except:
+        logger.warning("import failed on module {0}, module not loaded".format(plugin))
+        logger.warning("{0}".format(sys.exc_info()[0]))
+        logger.warning("{0}".format(traceback.format_exc()))
+
+
+def unload_plugin(hooks, plugin):
+    """Removes everything `plugin` added to `hooks` and forgets its module, so
+    that loading it again imports its current source"""
+    for name, value in list(hooks.items()):
+        if isinstance(value, list):
+            hooks[name] = [f for f in value if getattr(f, "__module__", None) != plugin]
+            if not hooks[name]:
+                del hooks[name]
+        elif name == "commands":
+            for prefix, hookfun in list(value.items()):
+                if getattr(hookfun, "__module__", None) == plugin:
+                    del value[prefix]
+        else:
+            # help and extendedhelp, by plugin name
+            value.pop(plugin, None)
+    sys.modules.pop(plugin, None)
+
+
+class PluginReloader(object):
+    """Loads the plugins once, then reloads only those whose file changed,
+    appeared or went away since, going by the files' mtimes"""
+
+    def __init__(self, plugindir=None, plugins_to_load=None):
+        self.plugindir = plugindir
+        self.plugins_to_load = split_plugins(plugins_to_load)
+        self.mtimes = {}
+
+    def load(self):
+        hooks = init_plugins(self.plugindir, self.plugins_to_load)
+        self.mtimes = self._mtimes()
+        return hooks
+
+    def _mtimes(self):
+        plugindir, plugins = find_plugins(self.plugindir)
+        mtimes = {}
+        if not os.path.isdir(plugindir):
+            # installed as an egg, nothing to watch
+            return mtimes
+        for plugin in plugins:
+            if self.plugins_to_load and plugin not in self.plugins_to_load:
+                continue
+            try:
+                mtimes[plugin] = os.path.getmtime(os.path.join(plugindir, plugin + ".py"))
+            except OSError:
+                pass
+        return mtimes
+
+    def reload(self, server):
+        """Reloads the changed plugins into `server.hooks`, running the stop
+        hooks of their old version first. Returns the names of the plugins
+        reloaded."""
+        mtimes = self._mtimes()
+        changed = sorted(plugin for plugin in set(mtimes) | set(self.mtimes)
+                         if mtimes.get(plugin) != self.mtimes.get(plugin))
+        self.mtimes = mtimes
+        if not changed:
+            return changed
+
+        for plugin in changed:
+            for hookfun in server.hooks.get("stop", []):
+                if getattr(hookfun, "__module__", None) != plugin:
+                    continue
+                try:
+                    hookfun(server)
+                except Exception:
+                    logger.exception("stop hook of {0} failed before reloading it".format(plugin))
+            unload_plugin(server.hooks, plugin)
+
+        if hasattr(importlib, "invalidate_caches"):
+            importlib.invalidate_caches()
+        plugindir = find_plugins(self.plugindir)[0]
+        oldpath = copy.deepcopy(sys.path)
+        sys.path.insert(0, plugindir)
+        try:
+            for plugin in changed:
+                if plugin in mtimes:
+                    load_plugin(server.hooks, plugindir, plugin)
+        finally:
+            sys.path = oldpath
+
+        logger.info("plugin: reloaded {0}".format(", ".join(changed)))
+        return changed
+
+
 class Slackbot(object):
     def __init__(self, bot_token=None, ServerClass=LimboServer, Client=SlackClient, config=CONFIG):
         self.resource = None
@@ -53,6 +262,15 @@ class Slackbot(object):
         self.ServerClass = ServerClass
         self.Client = Client
         self.config = config
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._closed = False
+        self._wake_r = self._wake_w = None
+        # replies held back while the connection is down
+        self._connected = False
+        self._held = []
+        self.deduper = EventDeduper()
 
         self._init_log(config)
         logger.debug("config: {0}".format(config))
@@ -64,69 +282,10 @@ class Slackbot(object):
         self.hooks = self._init_plugins(None, plugins_to_load)
 
     def _init_log(self, config):
-        loglevel = config.get("loglevel", logging.INFO)
-        logformat = config.get("logformat", '%(asctime)s:%(levelname)s:%(name)s:%(message)s')
-        if config.get("logfile"):
-            logging.basicConfig(filename=config.get("logfile"), format=logformat, level=loglevel)
-        else:
-            logging.basicConfig(format=logformat, level=loglevel)
+        init_log(config)
 
     def _init_plugins(self, plugindir, plugins_to_load=None):
-        if plugindir and not os.path.isdir(plugindir):
-            raise InvalidPluginDir(plugindir)
-
-        if not plugindir:
-            plugindir = DIR("plugins")
-
-        logger.debug("plugindir: {0}".format(plugindir))
-
-        if os.path.isdir(plugindir):
-            pluginfiles = glob(os.path.join(plugindir, "[!_]*.py"))
-            plugins = strip_extension(os.path.basename(p) for p in pluginfiles)
-        else:
-            # we might be in an egg; try to get the files that way
-            logger.debug("trying pkg_resources")
-            import pkg_resources
-            try:
-                plugins = strip_extension(
-                        pkg_resources.resource_listdir(__name__, "plugins"))
-            except OSError:
-                raise InvalidPluginDir(plugindir)
-
-        hooks = {}
-
-        oldpath = copy.deepcopy(sys.path)
-        sys.path.insert(0, plugindir)
-
-        for plugin in plugins:
-            if plugins_to_load and plugin not in plugins_to_load:
-                logger.debug("skipping plugin {0}, not in plugins_to_load {1}".format(plugin, plugins_to_load))
-                continue
-
-            logger.debug("plugin: {0}".format(plugin))
-            try:
-                mod = importlib.import_module(plugin)
-                modname = mod.__name__
-                for hook in re.findall("on_(\w+)", " ".join(dir(mod))):
-                    hookfun = getattr(mod, "on_" + hook)
-                    logger.debug("plugin: attaching %s hook for %s", hook, modname)
-                    hooks.setdefault(hook, []).append(hookfun)
-
-                if mod.__doc__:
-                    # firstline = mod.__doc__.split('\n')[0]
-                    part_attachment = json.loads(mod.__doc__)
-                    hooks.setdefault('help', {})[modname] = part_attachment
-                    hooks.setdefault('extendedhelp', {})[modname] = mod.__doc__
-
-            # bare except, because the modules could raise any number of errors
-            # on import, and we want them not to kill our server
-            except:
-                logger.warning("import failed on module {0}, module not loaded".format(plugin))
-                logger.warning("{0}".format(sys.exc_info()[0]))
-                logger.warning("{0}".format(traceback.format_exc()))
-
-        sys.path = oldpath
-        return hooks
+        return init_plugins(plugindir, plugins_to_load)
 
     def start(self, resource=None):
         if resource:
@@ -143,59 +302,220 @@ class Slackbot(object):
 
         # Currently not supporting a database, might do later
         self.server = self.ServerClass(slack, config, self.hooks, None)
-        self.server.slack.rtm_connect()
-        self.loop()
+        self._stopping.clear()
+        self._stopped.clear()
+        self._closed = False
+        # lets stop() wake the loop up while it waits for events
+        self._wake_r, self._wake_w = socket.socketpair()
+        try:
+            self.server.slack.rtm_connect()
+            self._connected = True
+            self.loop()
+        finally:
+            self._stopped.set()
+
+    def stop(self, resource=None, timeout=None):
+        """Stop reading events, give the ones in flight up to `timeout`
+        seconds (the `drain_timeout` config, 10 by default) to be handled,
+        then close the RTM connection and run the `stop` hooks, which free
+        what the plugins hold for this team."""
+        if timeout is None:
+            timeout = float(self.config.get("drain_timeout", DRAIN_TIMEOUT))
+        if self.resource:
+            logger.debug("Stopping Bot for ResourceID: {}".format(
+                self.resource['resourceID'])
+            )
+        self._drain_deadline = time.time() + timeout
+        self._stopping.set()
+        self._wake()
+        if not self._stopped.wait(timeout):
+            logger.warning("Bot still busy after {0}s, closing it anyway".format(timeout))
+        self._close()
+
+    def _wake(self):
+        if self._wake_w is not None:
+            try:
+                self._wake_w.send(b"x")
+            except socket.error:
+                pass
+
+    def _close(self):
+        if self._closed or self.server is None:
+            return
+        self._closed = True
+        websocket = getattr(self.server.slack.server, "websocket", None)
+        if websocket is not None:
+            try:
+                websocket.close()
+            except Exception:
+                logger.debug("closing the RTM websocket failed", exc_info=True)
+        run_stop(self.server.hooks, self.server)
+        # replies still queued for Slack
+        self.server.close()
+        for sock in (self._wake_r, self._wake_w):
+            if sock is not None:
+                sock.close()
+        self._wake_r = self._wake_w = None
+        logger.debug("Closed Bot")
+
+    def _wait_for_events(self, timeout):
+        """Block until the RTM websocket is readable or `timeout` seconds pass.
+
+        Returns True if there may be events waiting for `rtm_read`"""
+        websocket = getattr(self.server.slack.server, "websocket", None)
+        sock = getattr(websocket, "sock", None)
+        if sock is None:
+            # no real socket (FakeSlack in tests), so just poll rtm_read
+            return True
+
+        # the SSL layer may already hold decrypted bytes that select can't see
+        if hasattr(sock, "pending") and sock.pending():
+            return True
+
+        waiting = [sock] if self._wake_r is None else [sock, self._wake_r]
+        readable, _, _ = select.select(waiting, [], [], timeout)
+        return sock in readable
+
+    def _handle_events(self, events):
+        pending = len(events)
+        metrics.add("limbo_event_queue_depth", pending)
+        try:
+            for event in events:
+                try:
+                    logger.debug("got {0}".format(event.get("type", event)))
+                    if self.deduper.seen(event):
+                        logger.debug("dropping repeated event {0}".format(event.get("ts")))
+                        continue
+                    try:
+                        response = handle_event(event, self.server)
+                    except Exception:
+                        # one bad event doesn't cost the connection or the
+                        # rest of the batch
+                        logger.exception("handling event {0} failed".format(event.get("ts")))
+                        continue
+                    if response:
+                        # a broken connection is raised to the loop
+                        self._reply(event, response)
+                finally:
+                    pending -= 1
+                    metrics.add("limbo_event_queue_depth", -1)
+        finally:
+            # the rest of the batch is dropped when the connection breaks
+            if pending:
+                metrics.add("limbo_event_queue_depth", -pending)
+
+    def _reply(self, event, response):
+        if self._closed:
+            # sending would have slackrtm reconnect the closed socket
+            logger.debug("dropping a reply to {0}, the bot is closed".format(event.get("channel")))
+            return
+        if not self._connected:
+            self._held.append((event, response))
+            return
+        if isinstance(event['channel'], dict):
+            channel_id = event['channel']['id']
+        else:
+            channel_id = event['channel']
+        self.server.slack.rtm_send_message(channel_id, response)
 
-    def stop(self, resource):
-        logger.debug("Stopped Bot for ResourceID: {}".format(
-            self.resource['resourceID'])
-        )
-        self.server.slack = None
-        # close connection to slack.
+    def _ping(self):
+        websocket = getattr(self.server.slack.server, "websocket", None)
+        if websocket is None:
+            self.server.slack.server.ping()
+        else:
+            # slackrtm's ping swallows errors and reconnects on the spot;
+            # we want to see the error and back off
+            websocket.send(json.dumps({"type": "ping"}))
+
+    def _reconnect(self, error):
+        """Reconnect to RTM after `error`, waiting longer after each failed
+        attempt. The plugins and their caches are kept as they are. Returns
+        False if the bot was stopped before it got back."""
+        self._connected = False
+        attempt = 0
+        while True:
+            delay = backoff(attempt)
+            logger.warning("RTM connection lost ({0}), reconnecting in {1:.1f}s".format(error, delay))
+            if self._stopping.wait(delay):
+                return False
+            close_websocket(self.server.slack)
+            try:
+                self.server.slack.rtm_connect()
+            except Exception as e:
+                error = e
+                attempt += 1
+                continue
+            logger.info("RTM reconnected after {0} attempts".format(attempt + 1))
+            self._connected = True
+            held, self._held = self._held, []
+            for event, response in held:
+                self._reply(event, response)
+            return True
 
     def loop(self, test_loop=None):
         """Run the main loop
         server is a limbo Server object
         test_loop, if present, is a number of times to run the loop
+
+        Rather than polling, the loop blocks on the RTM websocket and wakes up
+        as soon as an event arrives, or when the next timer is due: the `loop`
+        hooks run every `loop_interval` seconds and a keepalive ping is sent
+        after `ping_interval` seconds without activity.
         """
+        config = self.server.config or {}
+        loop_interval = float(config.get("loop_interval", LOOP_INTERVAL))
+        ping_interval = float(config.get("ping_interval", PING_INTERVAL))
+
         try:
-            loops_without_activity = 0
-            while test_loop is None or test_loop > 0:
-                start = time.time()
-                loops_without_activity += 1
-
-                events = self.server.slack.rtm_read()
-                for event in events:
-                    loops_without_activity = 0
-                    logger.debug("got {0}".format(event.get("type", event)))
-                    response = handle_event(event, self.server)
-                    if response:
-                        if isinstance(event['channel'], dict):
-                            channel_id = event['channel']['id']
-                        else:
-                            channel_id = event['channel']
-                        self.server.slack.rtm_send_message(channel_id, response)
+            now = time.time()
+            next_loop_hook = now
+            last_activity = now
+            while (test_loop is None or test_loop > 0) and not self._stopping.is_set():
+                timeout = max(min(next_loop_hook, last_activity + ping_interval) - time.time(), 0)
+                events = []
+                try:
+                    if self._wait_for_events(timeout) and not self._stopping.is_set():
+                        events = self.server.slack.rtm_read()
+                        for event in events:
+                            check_event(event)
+                except CONNECTION_ERRORS as e:
+                    if not self._reconnect(e):
+                        break
+                    events = []
+                    last_activity = time.time()
+                if events:
+                    last_activity = time.time()
+                    try:
+                        self._handle_events(events)
+                    except CONNECTION_ERRORS as e:
+                        if not self._reconnect(e):
+                            break
+                        last_activity = time.time()
+
+                now = time.time()
 
                 # Run the loop hook. This doesn't send messages it receives,
                 # because it doesn't know where to send them. Use
                 # server.slack.post_message to send messages from a loop hook
-                run_hook(self.server.hooks, "loop", self.server)
+                if now >= next_loop_hook:
+                    run_hook(self.server.hooks, "loop", self.server)
+                    next_loop_hook = now + loop_interval
 
                 # The Slack RTM API docs say:
                 #
                 # > When there is no other activity clients should send a ping
                 # > every few seconds
                 #
-                # So, if we've gone >5 seconds without any activity, send a ping.
-                # If the connection has broken, this will reveal it so slack can
-                # quit
-                if loops_without_activity > 5:
-                    self.server.slack.server.ping()
-                    loops_without_activity = 0
-
-                end = time.time()
-                runtime = start - end
-                time.sleep(max(1 - runtime, 0))
+                # So, if we've gone `ping_interval` seconds without any
+                # activity, send a ping. If the connection has broken, this
+                # will reveal it and we reconnect
+                if now - last_activity >= ping_interval:
+                    try:
+                        self._ping()
+                    except CONNECTION_ERRORS as e:
+                        if not self._reconnect(e):
+                            break
+                    last_activity = time.time()
 
                 if test_loop:
                     test_loop -= 1
@@ -243,20 +563,39 @@ def main(args):
     elif args.command is not None:
         init_log(CONFIG)
         cmd = decode(args.command)
-        print(run_cmd(cmd, FakeServer(), args.hook, args.pluginpath, CONFIG.get("plugins")))
+        server = FakeServer(hooks=init_plugins(args.pluginpath, CONFIG.get("plugins")))
+        print(run_cmd(cmd, server, args.hook))
         return
+    elif getattr(args, "replay", None):
+        init_log(CONFIG)
+        from .replay import replay_file
+        summary = replay_file(args.replay, init_plugins(args.pluginpath, CONFIG.get("plugins")),
+                              speed=args.speed, concurrency=args.concurrency, fixtures=args.fixtures,
+                              record=args.record, output=args.replay_output)
+        return 1 if summary["errors"] else 0
+
+    BotClass = Slackbot
+    if CONFIG.get("async"):
+        # the asyncio runtime needs python 3.5+, so only import it on demand
+        from .aio import AsyncSlackbot as BotClass
 
     def spawn_bot(bot_token=None):
         if bot_token:
-            return Slackbot(bot_token)
-        return Slackbot()
+            return BotClass(bot_token)
+        return BotClass()
+
+    if CONFIG.get("metrics_port"):
+        serve_metrics(CONFIG["metrics_port"])
 
     try:
         # initialize bot runner.
         print(os.environ.keys())
         if CONFIG.get('beepboop'):
-            botManager = bot_manager.BotManager(spawn_bot)
-            bp = resourcer.Resourcer(botManager)
+            # every team is served by one shared loop and worker pool
+            init_log(CONFIG)
+            manager = TenantManager(init_plugins(None, CONFIG.get("plugins")), CONFIG)
+            manager.start()
+            bp = resourcer.Resourcer(manager)
             bp.handlers(bb_handlers)
             bp.start()
         else:
@@ -283,11 +622,15 @@ export SLACK_TOKEN=<your-slack-bot-token>
         raise
 
 
-def run_cmd(cmd, server, hook, pluginpath, plugins_to_load):
+def run_cmd(cmd, server, hook, pluginpath=None, plugins_to_load=None):
     """run a command. cmd should be a unicode string (str in python3, unicode in python2).
-       returns a string appropriate for printing (str in py2 and py3)"""
+       returns a string appropriate for printing (str in py2 and py3)
 
-    server.hooks = init_plugins(pluginpath, plugins_to_load)
+       The plugins are only loaded if the server has none yet, so a server
+       can be reused for any number of commands."""
+
+    if server.hooks is None:
+        server.hooks = init_plugins(pluginpath, plugins_to_load)
     event = {'type': hook, 'text': cmd, "user": "2", 'ts': time.time(), 'team': None, 'channel': 'repl_channel'}
     return encode(handle_event(event, server))
 
@@ -299,13 +642,21 @@ except NameError:
 
 
 def repl(server, args):
+    """Runs the commands typed in against `server`. The plugins are loaded
+    once; `reload` reloads those whose file changed since."""
+    reloader = PluginReloader(args.pluginpath)
+    server.hooks = reloader.load()
     try:
         while 1:
             cmd = decode(input("limbo> "))
             if cmd.lower() == "quit" or cmd.lower() == "exit":
                 return
+            if cmd.lower() == "reload":
+                reloaded = reloader.reload(server)
+                print("reloaded {0}".format(", ".join(reloaded)) if reloaded else "no plugins changed")
+                continue
 
-            print(run_cmd(cmd, server, args.hook, args.pluginpath, None))
+            print(run_cmd(cmd, server, args.hook))
     except (EOFError, KeyboardInterrupt):
         print()
         pass
@@ -0,0 +1,126 @@
+"""Plugin manifests, read without importing the plugin.
+
+Importing every plugin at startup is slow: graph alone pulls in matplotlib,
+numpy and parsedatetime. Most of what init_plugins needs from a
+plugin is plain data, though: its help JSON in the module docstring, its
+command PREFIXES and the names of its `on_` hooks. read_manifest gets those
+from the plugin's syntax tree. The hooks of a plugin with a manifest are
+LazyHooks, which import the module the first time one of them is called
+and log what the import cost.
+
+A plugin may also declare REQUIRES, the settings each hook needs, such as
+`{'loop': ['SD_AUTH_TOKEN']}`. Until the plugin is imported, a hook whose
+settings aren't in the team's resource or the environment does nothing,
+so a loop hook that is turned off doesn't import its plugin on every tick.
+"""
+import ast
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# plugins are imported from their directory, one at a time
+_import_lock = threading.Lock()
+
+
+class Manifest(object):
+    def __init__(self, name, doc, prefixes, hooks, requires=None):
+        self.name = name
+        self.doc = doc
+        self.prefixes = prefixes
+        self.hooks = hooks
+        self.requires = requires or {}
+
+
+def read_manifest(path, name):
+    """The Manifest of the plugin in `path`, or None when it has to be
+    imported to be known: it doesn't declare PREFIXES as a literal list or
+    REQUIRES as a literal dict, or it doesn't parse."""
+    try:
+        with open(path, "rb") as f:
+            tree = ast.parse(f.read(), path)
+    except (IOError, OSError, SyntaxError, ValueError):
+        return None
+
+    prefixes = None
+    requires = {}
+    hooks = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name.startswith("on_"):
+            hooks.append(node.name[len("on_"):])
+        elif isinstance(node, ast.Assign):
+            targets = [t.id for t in node.targets if isinstance(t, ast.Name)]
+            if "PREFIXES" in targets:
+                try:
+                    prefixes = ast.literal_eval(node.value)
+                except ValueError:
+                    return None
+            elif "REQUIRES" in targets:
+                try:
+                    requires = ast.literal_eval(node.value)
+                except ValueError:
+                    return None
+    if not isinstance(prefixes, (list, tuple)) or not isinstance(requires, dict):
+        return None
+    return Manifest(name, ast.get_docstring(tree, clean=False), list(prefixes), hooks, requires)
+
+
+def import_plugin(plugindir, name):
+    """Imports the plugin `name` from `plugindir`, the way init_plugins does"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    with _import_lock:
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        start = time.time()
+        sys.path.insert(0, plugindir)
+        try:
+            module = importlib.import_module(name)
+        finally:
+            sys.path.remove(plugindir)
+        logger.info("plugin: imported {0} on first use in {1:.0f}ms".format(name, (time.time() - start) * 1000))
+        return module
+
+
+def has_settings(server, names):
+    """Whether every setting in `names` is in the resource of `server`'s
+    team or in the environment"""
+    resource = (getattr(server, "config", None) or {}).get("resource") or {}
+    return all(resource.get(name) or os.environ.get(name) for name in names)
+
+
+class LazyHook(object):
+    """Stands in for the `on_<hook>` function of a plugin that hasn't been
+    imported yet. A `stop` hook of a plugin that was never imported has
+    nothing to clean up, so it doesn't import it, and neither does a hook
+    whose `requires` settings the team doesn't have."""
+
+    def __init__(self, plugindir, name, hook, requires=None):
+        self.plugindir = plugindir
+        self.name = name
+        self.hook = hook
+        self.requires = requires or []
+        self.__name__ = "on_" + hook
+        self.__module__ = name
+        self._func = None
+
+    def __call__(self, *args):
+        func = self._func
+        if func is None:
+            if self.hook == "stop" and self.name not in sys.modules:
+                return None
+            # the server is the last argument of every hook
+            if self.requires and self.name not in sys.modules and not has_settings(args[-1], self.requires):
+                return None
+            module = import_plugin(self.plugindir, self.name)
+            func = self._func = getattr(module, self.__name__)
+        return func(*args)
+
+    def __repr__(self):
+        return "<lazy {0}.{1}>".format(self.name, self.__name__)
@@ -0,0 +1,276 @@
+"""What the bot spends its time on.
+
+Hooks and commands, Server Density API calls and Slack posts are timed into
+latency histograms, labelled with the plugin, command, endpoint or Slack
+method. Events are counted as they are handled, and the runtimes keep a gauge
+of the events received but not handled yet.
+
+Everything is kept in the process wide `metrics` registry. It is served in
+the Prometheus text format on /metrics when LIMBO_METRICS_PORT is set, and
+summed up by `sdbot stats`.
+"""
+from collections import deque
+import contextlib
+import logging
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# seconds over which events per second are measured
+RATE_WINDOW = 60
+
+HELP = {
+    "limbo_hook_seconds": "Time spent in a plugin hook",
+    "limbo_command_seconds": "Time spent answering an sdbot command",
+    "limbo_events_total": "Slack events handled",
+    "limbo_events_per_second": "Events handled per second over the last minute",
+    "limbo_event_queue_depth": "Events received but not handled yet",
+    "sd_api_seconds": "Round trip time of a Server Density API call",
+    "sd_api_errors_total": "Server Density API calls that raised",
+    "sd_api_wait_seconds": "Time a Server Density API call queued for its account's rate limit",
+    "sd_api_coalesced_total": "Server Density API calls answered by an identical call already in flight",
+    "slack_post_seconds": "Time spent posting to Slack",
+    "slack_queue_seconds": "Time from a message being queued for Slack to it being sent",
+    "slack_outbound_queue_depth": "Messages queued for Slack but not sent yet",
+    "slack_rate_limited_total": "Messages Slack answered with a 429",
+    "slack_merged_total": "Messages sent merged into the one before them",
+    "slack_dropped_total": "Messages that couldn't be sent",
+}
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, observations up to it) for every bucket, the last
+        one unbounded"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """Estimates the `q` quantile by interpolating within its bucket, as
+        Prometheus' histogram_quantile does"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower, below = 0.0, 0
+        for bound, total in self.cumulative():
+            if total >= rank:
+                if bound == float("inf"):
+                    return lower
+                inside = total - below
+                return lower + (bound - lower) * ((rank - below) / inside if inside else 0)
+            lower, below = bound, total
+        return lower
+
+
+class Meter(object):
+    """Counts events per second over the last `window` seconds"""
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.started = time.time()
+        self._seconds = deque()
+
+    def mark(self, now=None):
+        second = int(now or time.time())
+        if self._seconds and self._seconds[-1][0] == second:
+            self._seconds[-1][1] += 1
+        else:
+            self._seconds.append([second, 1])
+        self._expire(second)
+
+    def _expire(self, now):
+        while self._seconds and self._seconds[0][0] <= now - self.window:
+            self._seconds.popleft()
+
+    def rate(self, now=None):
+        now = now or time.time()
+        self._expire(int(now))
+        # a fresh process hasn't been up for a whole window yet
+        span = min(self.window, max(now - self.started, 1))
+        return sum(count for _, count in self._seconds) / float(span)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.events = Meter()
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add(self, name, amount, **labels):
+        """Moves the gauge `name` up or down by `amount`"""
+        key = (name, _labels(labels))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def event(self, kind):
+        """Counts a handled event of type `kind`"""
+        self.inc("limbo_events_total", type=kind or "unknown")
+        with self._lock:
+            self.events.mark()
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, _labels(labels)))
+
+    def gauge(self, name, **labels):
+        return self.gauges.get((name, _labels(labels)), 0)
+
+    def total(self, name):
+        """The sum of the counter `name` over all its labels"""
+        with self._lock:
+            return sum(value for (cname, _), value in self.counters.items() if cname == name)
+
+    def rate(self):
+        """Events handled per second"""
+        with self._lock:
+            return self.events.rate()
+
+    def render(self):
+        """All the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            self.gauges[("limbo_events_per_second", ())] = self.events.rate()
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, (h.cumulative(), h.sum, h.count))
+                                for key, h in self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP {0} {1}".format(name, HELP.get(name, name)))
+                lines.append("# TYPE {0} {1}".format(name, kind))
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append("{0}{1} {2}".format(name, format_labels(labels), format_value(value)))
+        for (name, labels), value in gauges:
+            describe(name, "gauge")
+            lines.append("{0}{1} {2}".format(name, format_labels(labels), format_value(value)))
+        for (name, labels), (buckets, total, count) in histograms:
+            describe(name, "histogram")
+            for bound, observed in buckets:
+                le = "+Inf" if bound == float("inf") else format_value(bound)
+                lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels + (("le", le),)), observed))
+            lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), format_value(total)))
+            lines.append("{0}_count{1} {2}".format(name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name):
+        """(labels, count, mean, p50, p99) of every histogram called `name`,
+        the slowest by p99 first"""
+        with self._lock:
+            rows = [(dict(labels), h.count, h.sum / h.count, h.quantile(0.5), h.quantile(0.99))
+                    for (hname, labels), h in self.histograms.items() if hname == name and h.count]
+        return sorted(rows, key=lambda row: row[4], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.events = Meter()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = ('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+def serve_metrics(port, host=""):
+    """Serves /metrics on `port` from a daemon thread. Returns the server."""
+    server = HTTPServer((host, int(port)), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    logger.info("metrics: serving /metrics on port {0}".format(server.server_port))
+    return server
@@ -0,0 +1,314 @@
+"""One way out to Slack for every message the bot sends.
+
+Replies used to leave by three roads: rtm_send_message for what hooks
+return, SlackClient.post_message for attachments, and a Slacker of its own
+in graph. None of them knew about Slack's rate limits, so a burst of replies
+got 429s and some were lost.
+
+Everything now goes through the process wide `outbound` dispatcher. Messages
+queue per channel, and a channel is sent at most one message every
+`interval` seconds, as Slack allows. Small text messages waiting in the same
+channel go out merged into one. A 429 holds the channel back for as long as
+its Retry-After asks before the message is tried again. A few worker threads
+deliver for every channel of every team, and each team's messages to the
+Web API share one keep-alive session.
+"""
+from collections import deque
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import metrics
+from .settings import CONFIG
+
+logger = logging.getLogger(__name__)
+
+API_BASE_URL = "https://slack.com/api/{api}"
+# seconds between two messages to the same channel
+INTERVAL = 1.0
+WORKERS = 4
+# longest text that small messages are merged into
+MERGE_LIMIT = 3000
+# tries of a message that keeps being rate limited
+RETRIES = 5
+# seconds a closing team gets to send what it has queued
+FLUSH_TIMEOUT = 5
+POOL_SIZE = 4
+TIMEOUT = (3, 10)
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__("rate limited for {0}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+class SlackError(Exception):
+    pass
+
+
+class Message(object):
+    """A message for `channel`. `method` is the Web API method, or "rtm" for
+    a reply to an RTM event."""
+
+    def __init__(self, method, channel, text="", params=None, files=None):
+        self.method = method
+        self.channel = channel
+        self.text = text
+        self.params = params or {}
+        self.files = files
+        self.parts = 1
+        self.attempts = 0
+        self.queued = time.time()
+
+    def merges_with(self, other, limit):
+        return (self.method == other.method and self.params == other.params and
+                self.files is None and other.files is None and "attachments" not in self.params and
+                len(self.text) + len(other.text) + 1 <= limit)
+
+    def merge(self, other):
+        self.text += "\n" + other.text
+        self.parts += other.parts
+
+
+class WebTransport(object):
+    """Sends messages with the Web API over one keep-alive session"""
+
+    def __init__(self, token, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        self.token = token
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def send(self, message):
+        method = message.method
+        data = dict(message.params, token=self.token)
+        if method == "files.upload":
+            data["channels"] = message.channel
+        else:
+            data.update(channel=message.channel, text=message.text)
+        if method == "rtm":
+            method = "chat.postMessage"
+            data["as_user"] = "true"
+
+        response = self.session.post(API_BASE_URL.format(api=method), data=data, files=message.files,
+                                     timeout=self.timeout)
+        if response.status_code == 429:
+            raise RateLimited(float(response.headers.get("Retry-After", 1)))
+        response.raise_for_status()
+        body = response.json()
+        if not body.get("ok"):
+            if body.get("error") == "ratelimited":
+                raise RateLimited(1.0)
+            raise SlackError(body.get("error"))
+        return body
+
+    def close(self):
+        self.session.close()
+
+
+class ClientTransport(object):
+    """Sends messages through a client's own methods, for FakeSlack and
+    friends"""
+
+    def __init__(self, slack):
+        self.slack = slack
+
+    def send(self, message):
+        if message.method == "rtm":
+            return self.slack.rtm_send_message(message.channel, message.text)
+        if message.method == "files.upload":
+            filename, content, filetype = message.files["file"]
+            return self.slack.upload_file(message.channel, filename, content, filetype)
+        return self.slack.post_message(message.channel, message.text, **message.params)
+
+    def close(self):
+        pass
+
+
+class Channel(object):
+    def __init__(self, transport, id):
+        self.transport = transport
+        self.id = id
+        self.queue = deque()
+        # when the channel may be sent to next
+        self.next_at = 0.0
+        self.busy = False
+        self.scheduled = False
+
+
+class Outbound(object):
+    def __init__(self, interval=INTERVAL, workers=WORKERS, merge_limit=MERGE_LIMIT, retries=RETRIES):
+        self.interval = interval
+        self.workers = workers
+        self.merge_limit = merge_limit
+        self.retries = retries
+        self._channels = {}
+        # (next_at, seq, channel) of the channels with messages to send
+        self._ready = []
+        self._seq = itertools.count()
+        # messages of each transport queued or being sent
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def send(self, transport, message):
+        """Queues `message`; it's sent by a worker thread"""
+        with self._cond:
+            key = (transport, message.channel)
+            channel = self._channels.get(key)
+            if channel is None:
+                channel = self._channels[key] = Channel(transport, message.channel)
+            channel.queue.append(message)
+            self._pending[transport] = self._pending.get(transport, 0) + 1
+            self._schedule(channel)
+            self._start()
+        metrics.add("slack_outbound_queue_depth", 1)
+
+    def flush(self, transport, timeout=FLUSH_TIMEOUT):
+        """Waits up to `timeout` seconds for the messages of `transport` to
+        be sent. Returns whether they were."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._pending.get(transport):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, transport, timeout=FLUSH_TIMEOUT):
+        """Flushes `transport`, drops whatever it couldn't send in time and
+        closes it"""
+        self.flush(transport, timeout)
+        dropped = 0
+        with self._cond:
+            for key in [key for key in self._channels if key[0] is transport]:
+                channel = self._channels.pop(key)
+                dropped += sum(message.parts for message in channel.queue)
+                channel.queue.clear()
+            if dropped:
+                self._done(transport, dropped)
+        if dropped:
+            logger.warning("outbound: dropped {0} messages that couldn't be sent in time".format(dropped))
+            metrics.inc("slack_dropped_total", dropped, method="close")
+        transport.close()
+
+    def _schedule(self, channel):
+        """Puts `channel` on the heap for when it may be sent to next. An idle
+        one goes on too, and is dropped then unless more was queued for it."""
+        if not channel.busy and not channel.scheduled:
+            channel.scheduled = True
+            heapq.heappush(self._ready, (channel.next_at, next(self._seq), channel))
+            self._cond.notify()
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name="limbo-outbound")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _done(self, transport, count):
+        self._pending[transport] -= count
+        if not self._pending[transport]:
+            del self._pending[transport]
+        metrics.add("slack_outbound_queue_depth", -count)
+        self._cond.notify_all()
+
+    def _take(self):
+        """Waits for a channel that may be sent to. Returns it and its next
+        message, merged with the small ones queued after it."""
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, channel = heapq.heappop(self._ready)
+                    channel.scheduled = False
+                    if not channel.queue:
+                        # idle, or its team was closed
+                        key = (channel.transport, channel.id)
+                        if self._channels.get(key) is channel:
+                            del self._channels[key]
+                        continue
+                    channel.busy = True
+                    message = channel.queue.popleft()
+                    while channel.queue and message.merges_with(channel.queue[0], self.merge_limit):
+                        message.merge(channel.queue.popleft())
+                    return channel, message
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _work(self):
+        while True:
+            channel, message = self._take()
+            self._deliver(channel, message)
+
+    def _deliver(self, channel, message):
+        message.attempts += 1
+        retry_after = None
+        try:
+            with metrics.timer("slack_post_seconds", method=message.method):
+                channel.transport.send(message)
+        except RateLimited as e:
+            retry_after = e.retry_after
+            metrics.inc("slack_rate_limited_total", method=message.method)
+        except Exception:
+            logger.warning("outbound: sending to {0} failed".format(channel.id), exc_info=True)
+            metrics.inc("slack_dropped_total", method=message.method)
+
+        now = time.time()
+        with self._cond:
+            channel.busy = False
+            if retry_after is not None and message.attempts < self.retries:
+                logger.info("outbound: {0} is rate limited, retrying in {1}s".format(channel.id, retry_after))
+                channel.queue.appendleft(message)
+                channel.next_at = now + retry_after
+            else:
+                if retry_after is not None:
+                    logger.warning("outbound: gave up on {0} after {1} tries".format(channel.id, message.attempts))
+                    metrics.inc("slack_dropped_total", method=message.method)
+                channel.next_at = now + self.interval
+                metrics.observe("slack_queue_seconds", now - message.queued, method=message.method)
+                if message.parts > 1:
+                    metrics.inc("slack_merged_total", message.parts - 1)
+                self._done(channel.transport, message.parts)
+            self._schedule(channel)
+
+
+outbound = Outbound(float(CONFIG.get("slack_interval", INTERVAL)), int(CONFIG.get("slack_workers", WORKERS)))
+
+
+class OutboundSlack(object):
+    """Stands in for a SlackClient, sending its messages through the
+    `outbound` dispatcher. Calls it doesn't queue go to the client."""
+
+    def __init__(self, slack, transport=None, dispatcher=None):
+        self._slack = slack
+        self.transport = transport or ClientTransport(slack)
+        self.outbound = dispatcher or outbound
+
+    def __getattr__(self, name):
+        return getattr(self._slack, name)
+
+    def rtm_send_message(self, channel, message):
+        self.outbound.send(self.transport, Message("rtm", channel, message))
+
+    def post_message(self, channel, message, **kwargs):
+        self.outbound.send(self.transport, Message("chat.postMessage", channel, message, kwargs))
+
+    def upload_file(self, channel, filename, content, filetype=None):
+        """Posts the file `content` to `channel`"""
+        self.outbound.send(self.transport, Message("files.upload", channel, params={"filename": filename},
+                                                   files={"file": (filename, content, filetype)}))
+
+    def api_call(self, method, **kwargs):
+        with metrics.timer("slack_post_seconds", method=method):
+            return self._slack.api_call(method, **kwargs)
+
+    def close(self, timeout=FLUSH_TIMEOUT):
+        self.outbound.close(self.transport, timeout)
@@ -7,23 +7,37 @@
 import re
 import time
 import json
-
-from serverdensity.wrapper import Device
-from serverdensity.wrapper import Service
-from serverdensity.wrapper import Alert
+import logging
+import os
+import threading
 
 from limbo.plugins.common.basewrapper import BaseWrapper
+from limbo.plugins.common.basewrapper import MissingToken
+from limbo.plugins.common.pool import executor
+
+logger = logging.getLogger(__name__)
 
 COMMANDS = ['list', 'help']
+PREFIXES = ['alerts']
+PATTERN = re.compile(r"^[sS][dD][bB]ot alerts (\b\w+\b)\s?(\b\w+\b)?\s?(\b\w+\b)?")
 COLOR = '#3EB891'
+TRIGGERED_COLOR = '#E83880'
+
+# Triggered alerts are polled every SD_ALERT_POLL_INTERVAL seconds for the
+# accounts with alert channels, 0 turns the poller off. New and resolved
+# alerts are posted to the comma separated channels of SD_ALERT_CHANNELS.
+POLL_INTERVAL = int(os.environ.get('SD_ALERT_POLL_INTERVAL', 60))
+ALERT_CHANNELS = os.environ.get('SD_ALERT_CHANNELS', '')
+# the loop hook only imports this plugin for teams that poll
+REQUIRES = {'loop': ['SD_AUTH_TOKEN', 'SD_ALERT_CHANNELS']}
+# most alerts listed in a single notification
+NOTIFY_LIMIT = 20
 
 
 class Wrapper(BaseWrapper):
     def __init__(self, msg, server):
         super(Wrapper, self).__init__(msg, server)
-        self.alert = Alert(self.token)
-        self.device = Device(self.token)
-        self.service = Service(self.token)
+        self.alert = self.clients.alert
 
     def results_of(self, command, typeof, name):
         if typeof == 'help' or command == 'help':
@@ -73,14 +87,17 @@ class Wrapper(BaseWrapper):
             text = 'Instead of `{}` you should have used `group`, `service`, `device` or `all`'.format(typeof), ''
             return text
 
-        services = self.service.list()
-        devices = self.device.list()
-
         if name and typeof != 'group':
-            _id = name if not name else self.find_id(name, services, devices)
+            _id = name if not name else self.find_id(name)
             params['filter']['config.subjectId'] = _id
 
-        results = self.alert.triggered(params=params)
+        snapshot = poller.snapshot(self.token)
+        if snapshot is None:
+            results = self.alert.triggered(params=params)
+        else:
+            # answered from the poller's last look at the open alerts
+            _filter = params['filter']
+            results = [alert for alert in snapshot.values() if self._matches(alert, _filter)]
         alerts = sorted(results, key=lambda alert: alert['config']['lastTriggeredAt']['sec'], reverse=True)
         if not (typeof or name):
             # When making a standard `alerts list` we want to give a limited amount of alerts.
@@ -88,60 +105,179 @@ class Wrapper(BaseWrapper):
         else:
             # we want to keep the entire list here
             stripped_alerts = alerts
-        open_alerts = []
-
-        for alert in stripped_alerts:
-            field = alert['config']['fullName'].split(' > ')
-            comparison = alert['config'].get('fullComparison', '')
-            value = '{}{}'.format(alert['config'].get('value', ''), alert['config'].get('units', ''))
-            group = alert['config'].get('group', 'Ungrouped')
-            triggered_time = time.localtime(alert['config']['lastTriggeredAt']['sec'])
-
-            _id = alert['config']['subjectId']
-            if self._is_mongoId(_id):
-                name = self.find_name(_id, services, devices)
-                name = '{}: {}'.format(alert['config']['subjectType'].title(), name)
-            else:
-                name = 'Group: {}'.format(_id)
-
-            attachment = {
-                'title': '{}'.format(name),
-                'text': '{} {} {}'.format(
-                    field[1],
-                    comparison,
-                    value
-                ),
-                'color': COLOR,
-                'fields': [
-                    {
-                        'title': 'Last triggered',
-                        'value': time.strftime('%Y-%m-%d, %H:%M:%S', triggered_time)
-                    },
-                    # waiting on backend bugfix sd-2190
-                    # {
-                    #     'title': 'Group',
-                    #     'value': group,
-                    #     'short': True
-                    # }
-                ]
-            }
-            open_alerts.append(attachment)
+        open_alerts = [self.attachment(alert) for alert in stripped_alerts]
         if open_alerts:
             if len(alerts) > len(stripped_alerts):
-                message = ('You have {} open alerts but I\'m only showing the last {},'.format(len(alerts), len(stripped_alerts)) +
-                           ' do `list open alerts all` to see all of them')
+                message = ('You have {} open alerts but I\'m only showing the last {},'
+                           ' do `list open alerts all` to see all of them').format(len(alerts), len(stripped_alerts))
             else:
                 message = 'Chop chop, you\'d better sort out these open alerts soon'
             return open_alerts, message
         else:
             return 'I could not find any open alerts for you.', ''
 
+    def _matches(self, alert, _filter):
+        """Whether `alert` passes the filter list_alerts would have sent to
+        the triggered alerts endpoint"""
+        config = alert['config']
+        if 'config.subjectType' in _filter and config.get('subjectType') != _filter['config.subjectType']:
+            return False
+        if 'config.subjectId' in _filter and config.get('subjectId') != _filter['config.subjectId']:
+            return False
+        if 'subjectGroup' in _filter and alert.get('subjectGroup', config.get('group')) != _filter['subjectGroup']:
+            return False
+        return True
+
+    def attachment(self, alert, color=COLOR):
+        field = alert['config']['fullName'].split(' > ')
+        comparison = alert['config'].get('fullComparison', '')
+        value = '{}{}'.format(alert['config'].get('value', ''), alert['config'].get('units', ''))
+        group = alert['config'].get('group', 'Ungrouped')
+        triggered_time = time.localtime(alert['config']['lastTriggeredAt']['sec'])
+
+        _id = alert['config']['subjectId']
+        if self._is_mongoId(_id):
+            name = self.find_name(_id)
+            name = '{}: {}'.format(alert['config']['subjectType'].title(), name)
+        else:
+            name = 'Group: {}'.format(_id)
+
+        attachment = {
+            'title': '{}'.format(name),
+            'text': '{} {} {}'.format(
+                field[1],
+                comparison,
+                value
+            ),
+            'color': color,
+            'fields': [
+                {
+                    'title': 'Last triggered',
+                    'value': time.strftime('%Y-%m-%d, %H:%M:%S', triggered_time)
+                },
+                # waiting on backend bugfix sd-2190
+                # {
+                #     'title': 'Group',
+                #     'value': group,
+                #     'short': True
+                # }
+            ]
+        }
+        return attachment
+
+    def notify(self, channels, alerts, color, message):
+        """Posts `alerts` to every channel in `channels`"""
+        attachments = [self.attachment(alert, color) for alert in alerts[:NOTIFY_LIMIT]]
+        if len(alerts) > NOTIFY_LIMIT:
+            message += ', showing the first {} of {}'.format(NOTIFY_LIMIT, len(alerts))
+        for channel in channels:
+            self.server.slack.post_message(
+                channel,
+                message,
+                as_user=self.server.slack.server.username,
+                attachments=json.dumps(attachments))
+
+
+def alert_key(alert):
+    return alert.get('_id') or alert['config']['_id']
+
+
+class AlertPoller(object):
+    """Keeps the open alerts of every account, polled in the background.
+    Alerts that are new or gone since the previous poll are posted to the
+    account's alert channels; the first poll only takes note of what's
+    already open."""
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self._warned = False
+        self._snapshots = {}
+        self._due = {}
+        self._polling = set()
+        self._lock = threading.Lock()
+
+    def snapshot(self, token):
+        """The open alerts of the last poll for `token` by id, or None if
+        there hasn't been one lately"""
+        snapshot = self._snapshots.get(token)
+        if snapshot is None or time.time() - snapshot[0] > 2 * self.interval:
+            return None
+        return snapshot[1]
+
+    def tick(self, server):
+        """Starts a poll for the account of `server` when one is due and
+        there are channels to post to. The poll runs on the fetch pool, so
+        the loop isn't held up."""
+        if not self.interval or not self.channels(server.config):
+            return
+        try:
+            token = Wrapper.token_of(server.config)
+        except MissingToken:
+            if not self._warned:
+                self._warned = True
+                logger.warning('alerts: no SD_AUTH_TOKEN, not polling alerts')
+            return
+        now = time.time()
+        with self._lock:
+            if token in self._polling or now < self._due.get(token, 0):
+                return
+            self._polling.add(token)
+            self._due[token] = now + self.interval
+        executor.submit(self.poll, Wrapper({}, server))
+
+    def poll(self, api):
+        try:
+            alerts = api.alert.triggered(params={'filter': {'fixed': False}})
+            current = dict((alert_key(alert), alert) for alert in alerts)
+            previous = self._snapshots.get(api.token)
+            self._snapshots[api.token] = (time.time(), current)
+            channels = self.channels(api.server.config)
+            if previous is None or not channels:
+                return
+
+            previous = previous[1]
+            new = [alert for key, alert in current.items() if key not in previous]
+            resolved = [alert for key, alert in previous.items() if key not in current]
+            if new:
+                api.notify(channels, new, TRIGGERED_COLOR, '{} new alerts'.format(len(new)))
+            if resolved:
+                api.notify(channels, resolved, COLOR, '{} alerts resolved'.format(len(resolved)))
+        except Exception:
+            logger.exception('alerts: polling failed')
+        finally:
+            with self._lock:
+                self._polling.discard(api.token)
+
+    def channels(self, config):
+        channels = ((config or {}).get('resource') or {}).get('SD_ALERT_CHANNELS') or ALERT_CHANNELS
+        return [channel.strip() for channel in channels.split(',') if channel.strip()]
+
+    def discard(self, token):
+        """Forget the alerts of the account `token`"""
+        with self._lock:
+            self._snapshots.pop(token, None)
+            self._due.pop(token, None)
+
+
+poller = AlertPoller()
+
+
+def on_loop(server):
+    poller.tick(server)
+
+
+def on_stop(server):
+    try:
+        poller.discard(Wrapper.token_of(server.config))
+    except MissingToken:
+        pass
+
 
 def on_message(msg, server):
     text = msg.get("text", "")
     text = Wrapper.clean_parsing(text)
 
-    match = re.findall(r"^[sS][dD][bB]ot alerts (\b\w+\b)\s?(\b\w+\b)?\s?(\b\w+\b)?", text)
+    match = PATTERN.findall(text)
     if not match:
         return
     command, typeof, name = match[0]
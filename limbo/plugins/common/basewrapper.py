@@ -1,49 +1,109 @@
 import os
 import time
 import re
+from fnmatch import fnmatchcase
 
 from pytz import timezone
 
+from limbo.plugins.common.clients import registry
+from limbo.plugins.common.inventory import inventory
+from limbo.plugins.common.timeseries import metric_cache
+
+# set SD_IGNORE_CASE to let `web1` find a device called `Web1`
+IGNORE_CASE = bool(os.environ.get('SD_IGNORE_CASE'))
+
+LINK_PATTERN = re.compile('<http://((-?\w+-?\.?)+)\|(-?\w+-?\.?)+>')
+
+# `group:<name>` picks every device of a group for batch commands
+GROUP_PREFIX = 'group:'
+# most devices a single batch command will fetch metrics for
+BATCH_LIMIT = int(os.environ.get('SD_BATCH_LIMIT', 50))
+
+
+class MissingToken(Exception):
+    pass
+
 
 class BaseWrapper(object):
     def __init__(self, msg, server):
         self.msg = msg
         self.server = server
 
-        if self.server.config.get('resource'):
-            self.token = self.server.config['resource']['SD_AUTH_TOKEN']
+        self.token = self.token_of(self.server.config)
+        self.clients = registry.get(self.token)
+        self.timezone = timezone(os.environ.get('TIMEZONE', 'Europe/London'))
+
+    @classmethod
+    def token_of(cls, config):
+        """The SD token of the team a server belongs to"""
+        resource = (config or {}).get('resource') or {}
+        if resource.get('SD_AUTH_TOKEN'):
+            return resource['SD_AUTH_TOKEN']
         elif os.environ.get('SD_AUTH_TOKEN'):
-            self.token = os.environ['SD_AUTH_TOKEN']
+            return os.environ['SD_AUTH_TOKEN']
         else:
-            raise Exception('SD_AUTH_TOKEN is missing from environment')
-        self.timezone = timezone(os.environ.get('TIMEZONE', 'Europe/London'))
+            raise MissingToken('SD_AUTH_TOKEN is missing from environment')
+
+    @classmethod
+    def release(cls, config):
+        """Frees the API connections and cached data of the account a
+        server belongs to, when its team stops"""
+        token = cls.token_of(config)
+        registry.release(token)
+        inventory.invalidate(token)
+        metric_cache.discard(token)
 
     @classmethod
     def clean_parsing(cls, string):
-        reg = '<http://((-?\w+-?\.?)+)\|(-?\w+-?\.?)+>'
-        match = re.search(reg, string)
+        match = LINK_PATTERN.search(string)
 
         if match:
             clean_string = match.group(1)
             string = string.replace(string[match.start():match.end()], clean_string)
         return string
 
-    def find_name(self, _id, services, devices):
-        for s in services:
-            if _id == s['_id']:
-                return s['name']
-        for d in devices:
-            if _id == d['_id']:
-                return d['name']
-        return 'No name'
-
-    def find_id(self, name, services, devices):
-        for s in services:
-            if name == s['name']:
-                return s['_id']
-        for d in devices:
-            if name == d['name']:
-                return d['_id']
+    def get_devices(self):
+        """The device list of the account, from the shared inventory cache"""
+        return inventory.get(self.token).devices
+
+    def get_services(self):
+        """The service list of the account, from the shared inventory cache"""
+        return inventory.get(self.token).services
+
+    def find_name(self, _id):
+        name = inventory.get(self.token).index.name(_id)
+        return name if name else 'No name'
+
+    def find_id(self, name, kind=None):
+        """The id of the service or device called `name`. Pass `kind`
+        'service' or 'device' to only look at one of them."""
+        return inventory.get(self.token).index.id(name, kind, ignore_case=IGNORE_CASE)
+
+    def suggest(self, name, kind=None):
+        """A hint listing a few names that start like `name`, or ''"""
+        names = inventory.get(self.token).index.prefix(name[:3], kind, limit=5) if name else []
+        if not names:
+            return ''
+        return ' Did you mean {}?'.format(', '.join('`{}`'.format(n) for n in names))
+
+    @classmethod
+    def is_pattern(cls, name):
+        """Whether `name` picks several devices, like `web-*` or `group:web`"""
+        return name.startswith(GROUP_PREFIX) or any(c in name for c in '*?[')
+
+    def find_devices(self, pattern):
+        """The devices matching a glob such as `web-*`, or all the devices
+        of a group when `pattern` looks like `group:<name>`"""
+        devices = self.get_devices()
+        if pattern.startswith(GROUP_PREFIX):
+            group = pattern[len(GROUP_PREFIX):].strip()
+            return [d for d in devices if d.get('group') == group]
+        return [d for d in devices if fnmatchcase(d['name'], pattern)]
+
+    def get_metrics_data(self, _id, start, end, filter):
+        """The metrics endpoint's answer for `_id` from `start` to `end`,
+        through the shared cache of series"""
+        return metric_cache.get(self.clients, _id, start, end, filter)
 
     def get_data(self, data, names=None):
         """Inputs the data from the metrics endpoints and returns
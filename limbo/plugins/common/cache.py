@@ -0,0 +1,75 @@
+"""A thread safe LRU cache bounded by the size of its values.
+
+Values are weighed with `sizeof` (len by default, which for bytes is the
+number of bytes). When the total goes over `max_bytes` the least recently
+used entries are dropped until it fits again. Hits, misses and evictions are
+counted so the cache's usefulness can be checked.
+"""
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # back on top as the most recently used
+            self._items[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                # would push everything else out and still not fit
+                return
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, dropped) = self._items.popitem(last=False)
+                self.size -= dropped
+                self.evictions += 1
+
+    def discard(self, predicate):
+        """Drops every entry whose key `predicate` returns True for"""
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self.size -= self._items.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,210 @@
+"""Server Density API clients shared by every plugin.
+
+serverdensity.wrapper gives every `Device(token)`, `Metrics(token)`... object
+its own ApiClient and requests Session, and mounts a fresh HTTPAdapter before
+each request, which throws the connection pool away. Every command so paid a
+new TCP and TLS handshake to the API.
+
+The registry keeps one keep-alive connection pool per SD token instead, and
+hands out clients that send all their requests through it. ApiClient keeps
+per request state on itself, so each thread gets its own ApiClient, all of
+them sharing the token's session.
+
+Each token also gets a TokenBucket of SD_RATE_LIMIT requests a second, which
+callers queue on once it's spent, and identical calls in flight at the same
+time are made once (see throttle.py).
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from serverdensity.wrapper import ApiClient
+from serverdensity.wrapper import Alert
+from serverdensity.wrapper import Device
+from serverdensity.wrapper import Metrics
+from serverdensity.wrapper import Service
+from serverdensity.wrapper import ServiceStatus
+
+from limbo.metrics import metrics
+
+from .throttle import SingleFlight, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.environ.get('SD_POOL_SIZE', 10))
+CONNECT_TIMEOUT = float(os.environ.get('SD_CONNECT_TIMEOUT', 3))
+READ_TIMEOUT = float(os.environ.get('SD_READ_TIMEOUT', 5))
+RETRIES = 3
+# requests a second each account may make, 0 for no limit, and how many of
+# them may go out at once after a quiet spell
+RATE_LIMIT = float(os.environ.get('SD_RATE_LIMIT', 10))
+RATE_BURST = int(os.environ.get('SD_RATE_BURST', 20))
+
+
+class PooledSession(requests.Session):
+    """A Session whose https adapter stays put once it has been set up, so
+    ApiClient can't swap out the connection pool on every request."""
+
+    def __init__(self, adapter):
+        super(PooledSession, self).__init__()
+        requests.Session.mount(self, 'https://', adapter)
+        self.pooled_adapter = adapter
+
+    def mount(self, prefix, adapter):
+        if prefix == 'https://' and getattr(self, 'pooled_adapter', None):
+            return
+        super(PooledSession, self).mount(prefix, adapter)
+
+
+def timed_call(endpoint, func, *args, **kwargs):
+    """Calls `func`, recording the API round trip under `endpoint`"""
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        metrics.inc('sd_api_errors_total', endpoint=endpoint)
+        raise
+    finally:
+        metrics.observe('sd_api_seconds', time.time() - start, endpoint=endpoint)
+
+
+def call_key(endpoint, args, kwargs):
+    """What makes two calls identical"""
+    return endpoint, repr(args), repr(sorted(kwargs.items()))
+
+
+class ApiProxy(object):
+    """Stands in for a serverdensity.wrapper object such as Device, looking up
+    the calling thread's instance whenever one of its methods is used. Every
+    call goes through Clients.call."""
+
+    def __init__(self, clients, cls):
+        self._clients = clients
+        self._cls = cls
+
+    def __getattr__(self, name):
+        attr = getattr(self._clients.entity(self._cls), name)
+        if not callable(attr):
+            return attr
+        endpoint = '{0}.{1}'.format(self._cls.__name__, name)
+
+        def call(*args, **kwargs):
+            return self._clients.call(endpoint, attr, *args, **kwargs)
+        return call
+
+
+class Clients(object):
+    """The API clients for a single SD token"""
+
+    def __init__(self, token, pool_size=POOL_SIZE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 rate=RATE_LIMIT, burst=RATE_BURST):
+        self.token = token
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.flights = SingleFlight()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=RETRIES)
+        self.session = PooledSession(self.adapter)
+        self._local = threading.local()
+
+        self.alert = ApiProxy(self, Alert)
+        self.device = ApiProxy(self, Device)
+        self.metrics = ApiProxy(self, Metrics)
+        self.service = ApiProxy(self, Service)
+        self.status = ApiProxy(self, ServiceStatus)
+
+    def entity(self, cls):
+        """The calling thread's instance of `cls`, bound to its ApiClient"""
+        entities = getattr(self._local, 'entities', None)
+        if entities is None:
+            api = ApiClient(self.token, timeout=self.timeout)
+            api._session = self.session
+            entities = self._local.entities = {'api': api}
+        if cls not in entities:
+            entities[cls] = cls(api=entities['api'])
+        return entities[cls]
+
+    def call(self, endpoint, func, *args, **kwargs):
+        """Calls `func`, unless an identical call is already in flight, in
+        which case its answer is waited for. Calls wait for the token's rate
+        limit and are timed under `endpoint`."""
+        result, shared = self.flights.do(call_key(endpoint, args, kwargs), self._send,
+                                         endpoint, func, *args, **kwargs)
+        if shared:
+            metrics.inc('sd_api_coalesced_total', endpoint=endpoint)
+        return result
+
+    def _send(self, endpoint, func, *args, **kwargs):
+        if self.bucket is not None:
+            waited = self.bucket.acquire()
+            if waited:
+                metrics.observe('sd_api_wait_seconds', waited, endpoint=endpoint)
+        return timed_call(endpoint, func, *args, **kwargs)
+
+    def get(self, path, **params):
+        """GET an API endpoint that the wrapper doesn't cover, through the
+        same connection pool. Returns the decoded json."""
+        params['token'] = self.token
+
+        def fetch(**query):
+            response = self.session.get(ApiClient.BASE_URL + '/' + path, params=query, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        return self.call(path, fetch, **params)
+
+    def connection_stats(self):
+        """How many requests went out and how many connections (each one a
+        TCP+TLS handshake) were opened to serve them"""
+        requests_sent = handshakes = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            handshakes += pool.num_connections
+        return {
+            'requests': requests_sent,
+            'handshakes': handshakes,
+            'reused': requests_sent - handshakes
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class Registry(object):
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Returns the Clients for `token`, creating them on first use"""
+        with self._lock:
+            clients = self._clients.get(token)
+            if clients is None:
+                clients = self._clients[token] = Clients(token)
+            return clients
+
+    def release(self, token):
+        """Close the connections of `token` and forget its clients"""
+        with self._lock:
+            clients = self._clients.pop(token, None)
+        if clients is not None:
+            logger.debug('clients: releasing {0}'.format(clients.connection_stats()))
+            clients.close()
+
+    def connection_stats(self):
+        with self._lock:
+            all_clients = list(self._clients.values())
+        totals = {'requests': 0, 'handshakes': 0, 'reused': 0}
+        for clients in all_clients:
+            for key, value in clients.connection_stats().items():
+                totals[key] += value
+        return totals
+
+
+registry = Registry()
@@ -0,0 +1,71 @@
+"""Downsampling of metric series before they are plotted.
+
+A graph is only a few hundred pixels wide, but a long period can hold
+hundreds of thousands of points. Both methods here cut a series down to
+about one point per pixel, so drawing time and memory depend on the size of
+the image rather than the length of the period.
+
+`x` and `y` are NumPy arrays of the same length, `x` in ascending order.
+"""
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: keeps the first and last point and,
+    for each of `threshold - 2` buckets, the point forming the largest
+    triangle with the point kept before it and the average of the next
+    bucket. It follows the visual shape of the line closely."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    xf = x.astype(np.float64)
+    yf = y.astype(np.float64)
+
+    # bucket i holds the points edges[i]:edges[i + 1], leaving out the
+    # first and last point, which are always kept
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(xf[:n - 1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(yf[:n - 1], edges[:-1]) / counts
+    # the bucket after the last one is the last point
+    next_x = np.append(avg_x[1:], xf[-1])
+    next_y = np.append(avg_y[1:], yf[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        area = np.abs((xf[a] - next_x[i]) * (yf[start:end] - yf[a]) -
+                      (xf[a] - xf[start:end]) * (next_y[i] - yf[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return x[selected], y[selected]
+
+
+def minmax(x, y, buckets):
+    """Keeps the smallest and largest value of each of `buckets` equally
+    sized buckets, plus the first and last point. Cheaper than lttb and
+    never hides a spike."""
+    n = len(x)
+    if n <= 2 * buckets or buckets < 1:
+        return x, y
+
+    size = n // buckets
+    m = size * buckets
+    offsets = np.arange(buckets) * size
+    grouped = y[:m].reshape(buckets, size)
+    keep = [offsets + grouped.argmin(axis=1), offsets + grouped.argmax(axis=1), [0, n - 1]]
+    if m < n:
+        # the few points left over after the last full bucket
+        keep.append([m + int(np.argmin(y[m:])), m + int(np.argmax(y[m:]))])
+    idx = np.unique(np.concatenate(keep))
+    return x[idx], y[idx]
+
+
+METHODS = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
@@ -0,0 +1,63 @@
+"""Name and id lookups over an inventory snapshot.
+
+The index is built once per snapshot (see inventory.py), which turns every
+name or id resolution into a dictionary lookup instead of a scan over all
+services and devices.
+"""
+from bisect import bisect_left
+
+# lookups that don't ask for a kind try services before devices
+KINDS = ('service', 'device')
+
+
+class EntityIndex(object):
+    def __init__(self, services, devices):
+        self._names = {}
+        self._ids = dict((kind, {}) for kind in KINDS)
+        self._folded_ids = dict((kind, {}) for kind in KINDS)
+        self._sorted = dict((kind, []) for kind in KINDS)
+
+        for kind, entities in zip(KINDS, (services, devices)):
+            ids = self._ids[kind]
+            folded_ids = self._folded_ids[kind]
+            for entity in entities:
+                name = entity['name']
+                # the first entity with a name or id wins, like the scans did
+                self._names.setdefault(entity['_id'], name)
+                ids.setdefault(name, entity['_id'])
+                folded_ids.setdefault(name.lower(), entity['_id'])
+            self._sorted[kind] = sorted((name.lower(), name) for name in ids)
+
+    def _kinds(self, kind):
+        return (kind,) if kind else KINDS
+
+    def name(self, _id):
+        """Returns the name of the service or device with id `_id`, or None"""
+        return self._names.get(_id)
+
+    def id(self, name, kind=None, ignore_case=False):
+        """Returns the id of the service or device called `name`, or None.
+        `kind` is 'service' or 'device' to only look at one of them."""
+        for k in self._kinds(kind):
+            _id = self._ids[k].get(name)
+            if _id:
+                return _id
+        if ignore_case:
+            for k in self._kinds(kind):
+                _id = self._folded_ids[k].get(name.lower())
+                if _id:
+                    return _id
+
+    def prefix(self, prefix, kind=None, limit=None):
+        """Returns the names starting with `prefix`, ignoring case, in
+        alphabetical order."""
+        prefix = prefix.lower()
+        names = []
+        for k in self._kinds(kind):
+            entries = self._sorted[k]
+            i = bisect_left(entries, (prefix, ''))
+            while i < len(entries) and entries[i][0].startswith(prefix):
+                names.append(entries[i][1])
+                i += 1
+        names.sort(key=lambda name: name.lower())
+        return names[:limit] if limit else names
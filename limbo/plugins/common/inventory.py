@@ -0,0 +1,108 @@
+"""A shared cache of the Server Density inventory.
+
+Resolving a device or service name needs the whole device and service list
+of the account. Rather than downloading them for every command, the lists are
+kept here per SD token and shared by every plugin and message. A snapshot is
+used for SD_INVENTORY_TTL seconds; once it is older than SD_INVENTORY_REFRESH
+seconds it is refreshed in a background thread while callers keep using it.
+
+The lists are shared between threads, so treat them as read only.
+"""
+import logging
+import os
+import threading
+import time
+
+from limbo.plugins.common.clients import registry
+from limbo.plugins.common.index import EntityIndex
+
+logger = logging.getLogger(__name__)
+
+TTL = float(os.environ.get('SD_INVENTORY_TTL', 60))
+REFRESH = float(os.environ.get('SD_INVENTORY_REFRESH', TTL / 2))
+
+
+class Snapshot(object):
+    def __init__(self, devices, services):
+        self.devices = devices
+        self.services = services
+        self.index = EntityIndex(services, devices)
+        self.fetched_at = time.time()
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+
+class Inventory(object):
+    def __init__(self, ttl=TTL, refresh=REFRESH):
+        self.ttl = ttl
+        self.refresh = refresh
+        self._snapshots = {}
+        self._locks = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Returns the inventory Snapshot for `token`, downloading it if we
+        don't hold one younger than the ttl."""
+        snapshot = self._snapshots.get(token)
+        if snapshot is None or snapshot.age() >= self.ttl:
+            return self._fetch(token, snapshot)
+
+        if snapshot.age() >= self.refresh:
+            self._refresh_in_background(token, snapshot)
+        return snapshot
+
+    def invalidate(self, token=None):
+        """Drop the snapshot for `token`, or every snapshot if no token is
+        given, so the next `get` downloads a fresh inventory."""
+        with self._lock:
+            if token is None:
+                self._snapshots.clear()
+                self._locks.clear()
+            else:
+                self._snapshots.pop(token, None)
+                self._locks.pop(token, None)
+
+    def _token_lock(self, token):
+        with self._lock:
+            return self._locks.setdefault(token, threading.Lock())
+
+    def _fetch(self, token, stale):
+        # Only one thread downloads the inventory of an account, the others
+        # wait for it and use its result.
+        with self._token_lock(token):
+            snapshot = self._snapshots.get(token)
+            if snapshot is not None and snapshot is not stale:
+                return snapshot
+
+            start = time.time()
+            clients = registry.get(token)
+            snapshot = Snapshot(clients.device.list(), clients.service.list())
+            logger.debug("inventory: fetched {0} devices and {1} services in {2:.2f}s".format(
+                len(snapshot.devices), len(snapshot.services), time.time() - start))
+            with self._lock:
+                self._snapshots[token] = snapshot
+            return snapshot
+
+    def _refresh_in_background(self, token, stale):
+        with self._lock:
+            if token in self._refreshing:
+                return
+            self._refreshing.add(token)
+
+        def refresh():
+            try:
+                self._fetch(token, stale)
+            except Exception:
+                logger.warning("inventory: background refresh failed", exc_info=True)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(token)
+
+        thread = threading.Thread(target=refresh, name="inventory-refresh")
+        thread.daemon = True
+        thread.start()
+
+
+inventory = Inventory()
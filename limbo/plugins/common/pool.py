@@ -0,0 +1,66 @@
+"""A bounded thread pool for commands that fan out into several API requests.
+
+The requests are plain blocking calls, so running them side by side makes a
+command cost roughly one round trip instead of one per request.
+"""
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import os
+import time
+
+WORKERS = int(os.environ.get('SD_FETCH_WORKERS', 16))
+
+executor = ThreadPoolExecutor(WORKERS)
+
+
+class FetchTimeout(Exception):
+    pass
+
+
+def fetch_all(func, items, timeout=None, pool=None):
+    """Calls `func(item)` for every item on the pool and returns a list of
+    `(result, error)` tuples in the order of `items`.
+
+    A call that raises gets its exception as `error`; one that is still
+    running `timeout` seconds after it started gets a FetchTimeout, so a
+    single slow request only spoils its own result. Calls waiting for a
+    worker of a busy pool aren't timed until they start.
+    """
+    started = {}
+
+    def call(i, item):
+        started[i] = time.time()
+        return func(item)
+
+    futures = [(pool or executor).submit(call, i, item) for i, item in enumerate(items)]
+    timed_out = set()
+    if timeout is None:
+        wait(futures)
+    else:
+        pending = set(range(len(futures)))
+        while pending:
+            now = time.time()
+            for i in list(pending):
+                if futures[i].done():
+                    pending.discard(i)
+                elif i in started and now - started[i] >= timeout:
+                    timed_out.add(i)
+                    pending.discard(i)
+            if not pending:
+                break
+            # calls that haven't started yet are looked at again after at
+            # most `timeout`, in case they started in the meantime
+            deadlines = [started[i] + timeout for i in pending if i in started]
+            wait([futures[i] for i in pending], max(min(deadlines or [now + timeout]) - now, 0),
+                 return_when=FIRST_COMPLETED)
+
+    results = []
+    for i, future in enumerate(futures):
+        if i in timed_out:
+            results.append((None, FetchTimeout('timed out after {}s'.format(timeout))))
+        elif future.exception() is not None:
+            results.append((None, future.exception()))
+        else:
+            results.append((future.result(), None))
+    return results
@@ -0,0 +1,188 @@
+"""Graph rendering in a pool of worker processes.
+
+Drawing a graph is CPU heavy, and pyplot keeps global state, so doing it on
+the bot's threads blocks everything else and isn't thread safe. Graphs are
+drawn here with matplotlib's object oriented Figure and Agg canvas instead,
+in worker processes. At most SD_RENDER_QUEUE graphs are queued or drawing at
+a time; past that callers wait up to SD_RENDER_WAIT seconds for a slot and
+then get RenderBusy, so a burst of requests can't pile up without bound.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import io
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    BrokenProcessPool = RuntimeError
+
+from matplotlib import rc_context
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import AutoDateLocator
+from matplotlib.dates import DateFormatter
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
+import numpy as np
+
+WORKERS = int(os.environ.get('SD_RENDER_WORKERS', 2))
+QUEUE_SIZE = int(os.environ.get('SD_RENDER_QUEUE', 8))
+WAIT = float(os.environ.get('SD_RENDER_WAIT', 10))
+
+# 800 and 355 pixels.
+WIDTH = 8
+HEIGHT = 3.55
+DPI = 100
+TICKS = 5
+BGCOLOR = '#f3f6f6'
+FONT = {
+    'font.size': 16,
+    'font.family': 'Arial'
+}
+# one color per line when several devices share a graph
+LINE_COLORS = ['#53b4d4', '#e83880', '#3eb891', '#e8a824', '#8e44ad', '#71cadc']
+
+
+class RenderBusy(Exception):
+    pass
+
+
+def render_graph(series, diff_sec, unit):
+    """Draws one line per `(label, x, y)` tuple in `series`, where `x` are
+    unix timestamps, and returns the PNG as bytes. `diff_sec` is the length
+    of the period in seconds, which picks the date format."""
+    if diff_sec < 86400:
+        x_no_ticks = 10
+        fmt = '%H:%M'
+    elif diff_sec < (3600*24*4):
+        x_no_ticks = 5
+        fmt = '%d %b, %H:%M'
+    else:
+        x_no_ticks = 6
+        fmt = '%d %b %Y'
+
+    with rc_context(FONT):
+        # size of figure and setting background color
+        fig = Figure(figsize=(WIDTH, HEIGHT), facecolor=BGCOLOR)
+        FigureCanvasAgg(fig)
+
+        # axis color, no ticks and bottom line in grey color.
+        ax = fig.add_subplot(111, frameon=True)
+        # the axisbg argument is gone from matplotlib 2, this works in both
+        ax.patch.set_facecolor(BGCOLOR)
+        ax.xaxis.set_ticks_position('none')
+        ax.spines['bottom'].set_color('#aabcc2')
+        ax.yaxis.set_ticks_position('none')
+
+        # removing all but bottom spines
+        for key, sp in ax.spines.items():
+            if key != 'bottom':
+                sp.set_visible(False)
+
+        # setting amounts of ticks on y axis
+        ax.yaxis.set_major_locator(MaxNLocator(TICKS))
+
+        # Deciding how many ticks we want on the graph
+        ax.xaxis.set_major_locator(AutoDateLocator(minticks=(x_no_ticks - 2), maxticks=x_no_ticks))
+        ax.xaxis.set_major_formatter(DateFormatter(fmt))
+
+        # turns off small ticks
+        ax.tick_params(axis='x',
+                       which='both',
+                       bottom='on',
+                       top='off',
+                       pad=10)
+        # Can't seem to set label color differently, changing tick_params color changes labels.
+        ax.xaxis.label.set_color('#FFFFFF')
+
+        # setting dates in x-axis automatically triggers use of AutoDateLocator
+        for i, (label, x, y) in enumerate(series):
+            dates = [datetime.fromtimestamp(t) for t in x]
+            ax.plot(dates, y, color=LINE_COLORS[i % len(LINE_COLORS)], linewidth=2, label=label)
+        if len(series) > 1:
+            ax.legend(loc='upper left', fontsize='x-small', frameon=False)
+
+        # pick values for y-axis
+        y_ticks_values = np.concatenate([np.asarray(y, dtype=float) for _, _, y in series])
+        y_ticks = np.linspace(np.nanmin(y_ticks_values), np.nanmax(y_ticks_values), TICKS)
+        y_ticks = np.round(y_ticks, decimals=2)
+        ax.set_yticks(y_ticks)
+        ax.set_yticklabels([str(val) + unit for val in y_ticks])
+
+        fig.tight_layout()
+        buf = io.BytesIO()
+        fig.savefig(buf,
+                    format='png',
+                    facecolor=fig.get_facecolor(),
+                    dpi=DPI)
+    return buf.getvalue()
+
+
+class RenderPool(object):
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        # graphs queued or drawing; a Condition rather than a semaphore, as
+        # python 2's Semaphore.acquire takes no timeout
+        self._queued = 0
+        self._slots = threading.Condition()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _acquire(self, wait):
+        deadline = time.time() + wait
+        with self._slots:
+            while self._queued >= self.queue_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._slots.wait(remaining)
+            self._queued += 1
+            return True
+
+    def _release(self):
+        with self._slots:
+            self._queued -= 1
+            self._slots.notify()
+
+    def _get_executor(self):
+        # started on first use, so processes that never draw never fork
+        with self._lock:
+            if self._executor is None:
+                kwargs = {}
+                if sys.version_info >= (3, 7) and 'forkserver' in multiprocessing.get_all_start_methods():
+                    # forking a process full of threads can copy held locks
+                    kwargs['mp_context'] = multiprocessing.get_context('forkserver')
+                self._executor = ProcessPoolExecutor(self.workers, **kwargs)
+            return self._executor
+
+    def render(self, series, diff_sec, unit, wait=WAIT):
+        """Renders a graph on the pool, see `render_graph`. Blocks until it's
+        done, and raises RenderBusy if no slot frees up within `wait` seconds"""
+        if not self._acquire(wait):
+            raise RenderBusy('{} graphs are already queued'.format(self.queue_size))
+        try:
+            executor = self._get_executor()
+            try:
+                return executor.submit(render_graph, series, diff_sec, unit).result()
+            except BrokenProcessPool:
+                # a worker died; start a fresh pool for the next graph
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                raise
+        finally:
+            self._release()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+renderer = RenderPool()
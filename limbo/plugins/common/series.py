@@ -0,0 +1,57 @@
+"""Metric data as NumPy arrays.
+
+The metrics endpoint returns every point as a `{'x': ..., 'y': ...}` dict.
+Series turns the node returned by BaseWrapper.get_data into two arrays in a
+single pass, timestamps as int64 and values as float64, and answers the usual
+questions about them with vectorised operations. Missing values become NaN
+and are left out of the statistics.
+"""
+import numpy as np
+
+NAN = float('nan')
+
+
+def _flatten(data):
+    for point in data:
+        yield point['x']
+        y = point['y']
+        yield NAN if y is None else y
+
+
+class Series(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    @classmethod
+    def from_node(cls, node):
+        data = node.get('data') or []
+        flat = np.fromiter(_flatten(data), dtype=np.float64, count=2 * len(data)).reshape(-1, 2)
+        return cls(flat[:, 0].astype(np.int64), np.ascontiguousarray(flat[:, 1]))
+
+    def __len__(self):
+        return len(self.x)
+
+    def min(self):
+        return float(np.nanmin(self.y))
+
+    def max(self):
+        return float(np.nanmax(self.y))
+
+    def mean(self):
+        return float(np.nanmean(self.y))
+
+    def percentile(self, q):
+        return float(np.nanpercentile(self.y, q))
+
+    def latest(self):
+        return float(self.y[-1])
+
+    @staticmethod
+    def display(value):
+        """`value` as text, without a trailing .0 for whole numbers"""
+        if np.isnan(value):
+            return 'n/a'
+        if value == int(value):
+            return str(int(value))
+        return str(value)
@@ -0,0 +1,98 @@
+"""Keeps the bot within the API budget of a Server Density account.
+
+When an alert fires, everybody in the channel asks about the same devices at
+once, and the API starts throttling the account. Two things stop that:
+
+A TokenBucket lets `rate` requests a second through, with bursts of up to
+`burst`. A caller that finds it empty waits for its turn instead of failing.
+
+SingleFlight runs identical requests that are in flight at the same time
+once: the first caller makes the request, and the callers that ask for the
+same thing before it's answered wait for it and get copies of its answer, or
+its exception.
+"""
+import copy
+import threading
+import time
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Takes a token, returning how many seconds the caller has to wait
+        before it may use it. Waiting callers queue up in the order they
+        asked, as the bucket goes into debt for them."""
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        """Waits for a token; returns the seconds waited"""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Returns (result, shared): what `func(*args, **kwargs)` returned,
+        and whether it was the answer to a call somebody else made"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), True
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            self._finish(key, call)
+            raise
+        # the callers mustn't see each other's changes to the answer, so the
+        # waiting ones copy one that the caller here can't touch
+        self._finish(key, call, result)
+        return result, False
+
+    def _finish(self, key, call, result=None):
+        with self._lock:
+            del self._calls[key]
+        if call.waiters and call.error is None:
+            call.result = copy.deepcopy(result)
+        call.done.set()
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,182 @@
+"""A cache of metric series that only asks the API for what it doesn't have.
+
+`devices value`, `services value` and `graph` ask for a window ending now,
+so the same device and metric are fetched again and again with nearly the
+same range. For every (account, device, metric filter) the cache keeps the
+points it has already seen and the range they cover. A request is answered
+from them, and only the part of the range before or after it is fetched,
+then merged in by timestamp.
+
+The newest OVERLAP seconds are fetched again with the tail, as points can
+reach the API a little after their timestamp. A series only keeps the points
+from the oldest start asked for in the last SD_METRIC_CACHE_TTL seconds, so
+one that is asked for all the time doesn't grow without bound as its tail
+moves on. Series unused for SD_METRIC_CACHE_TTL seconds are dropped, and the
+least recently used ones go when the cache holds more than
+SD_METRIC_CACHE_MB.
+"""
+import calendar
+from collections import deque
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import pytz
+
+from limbo.plugins.common.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+TTL = int(os.environ.get('SD_METRIC_CACHE_TTL', 900))
+MAX_BYTES = int(float(os.environ.get('SD_METRIC_CACHE_MB', 64)) * 1024 * 1024)
+OVERLAP = 120
+# a tail younger than this isn't worth a request
+FRESH = 10
+# rough size of a point, a dict holding two numbers
+POINT_BYTES = 250
+
+
+def as_utc(dt):
+    """`dt` as an aware UTC datetime; naive datetimes are taken to be UTC,
+    which is how the API reads them"""
+    if dt.tzinfo is None:
+        return pytz.utc.localize(dt)
+    return dt.astimezone(pytz.utc)
+
+
+def timestamp(dt):
+    """Seconds since the epoch"""
+    return calendar.timegm(as_utc(dt).utctimetuple())
+
+
+def merge(old, new):
+    """Merges the metric tree `new` into `old`, matching nodes by name. The
+    points of a node are kept ordered by time, with those of `new` winning
+    when both have a point for the same time."""
+    merged = [dict(node) for node in old]
+    by_name = dict((node.get('name'), node) for node in merged)
+    for node in new:
+        current = by_name.get(node.get('name'))
+        if current is None:
+            merged.append(node)
+        elif 'data' in node:
+            points = dict((p['x'], p) for p in current.get('data') or [])
+            points.update((p['x'], p) for p in node['data'])
+            current['data'] = [points[x] for x in sorted(points)]
+        else:
+            current['tree'] = merge(current.get('tree') or [], node.get('tree') or [])
+    return merged
+
+
+def window(tree, start, end):
+    """A copy of `tree` holding only the points from `start` to `end`"""
+    result = []
+    for node in tree:
+        node = dict(node)
+        if 'data' in node:
+            node['data'] = [p for p in node['data'] or [] if start <= p['x'] <= end]
+        else:
+            node['tree'] = window(node.get('tree') or [], start, end)
+        result.append(node)
+    return result
+
+
+def count_points(tree):
+    return sum(len(node.get('data') or []) if 'data' in node else count_points(node.get('tree') or [])
+               for node in tree)
+
+
+class CachedSeries(object):
+    """The points of one device and metric filter, and the range covered"""
+
+    def __init__(self):
+        self.tree = None
+        self.start = self.end = None
+        self.used = time.time()
+        self.lock = threading.Lock()
+        # (asked at, start) of the recent requests, the starts increasing,
+        # so the first one is the oldest start still wanted
+        self.starts = deque()
+
+    def keep_from(self, first, now, ttl):
+        """Notes a request for points from `first`; returns the oldest point
+        worth keeping"""
+        while self.starts and self.starts[-1][1] >= first:
+            self.starts.pop()
+        self.starts.append((now, first))
+        while now - self.starts[0][0] > ttl:
+            self.starts.popleft()
+        return self.starts[0][1]
+
+    def size(self):
+        return POINT_BYTES * count_points(self.tree or [])
+
+
+class MetricCache(object):
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL):
+        self.ttl = ttl
+        self.requests = 0
+        self.fetched = 0
+        self._series = LRUCache(max_bytes, sizeof=lambda series: series.size())
+        self._lock = threading.Lock()
+
+    def get(self, clients, _id, start, end, filter):
+        """What `clients.metrics.get(_id, start, end, filter)` would return,
+        fetching only the parts of the range that aren't cached yet. The
+        plugins ask in UTC or in their own timezone, so the range is taken
+        in UTC before it's matched against what the cache holds."""
+        start, end = as_utc(start), as_utc(end)
+        key = (clients.token, _id, json.dumps(filter, sort_keys=True))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None or time.time() - series.used > self.ttl:
+                series = CachedSeries()
+                self._series.put(key, series)
+            series.used = time.time()
+            self.requests += 1
+
+        first, last = timestamp(start), timestamp(end)
+        with series.lock:
+            if series.tree is None:
+                series.tree = self._fetch(clients, _id, first, last, filter)
+                series.start, series.end = first, last
+            else:
+                if first < series.start:
+                    head = self._fetch(clients, _id, first, series.start, filter)
+                    series.tree = merge(series.tree, head)
+                    series.start = first
+                if last > series.end + FRESH:
+                    tail = self._fetch(clients, _id, max(series.start, series.end - OVERLAP), last, filter)
+                    series.tree = merge(series.tree, tail)
+                    series.end = last
+            oldest = series.keep_from(first, time.time(), self.ttl)
+            if oldest > series.start:
+                series.tree = window(series.tree, oldest, series.end)
+                series.start = oldest
+            result = window(series.tree, first, last)
+        # weighed again now that it has grown or been trimmed
+        self._series.put(key, series)
+        return result
+
+    def _fetch(self, clients, _id, first, last, filter):
+        self.fetched += 1
+        logger.debug('timeseries: fetching {} {} from {} to {}'.format(_id, filter, first, last))
+        return clients.metrics.get(_id,
+                                   datetime.fromtimestamp(first, pytz.utc),
+                                   datetime.fromtimestamp(last, pytz.utc),
+                                   filter)
+
+    def discard(self, token):
+        """Forget the series of the account `token`"""
+        self._series.discard(lambda key: key[0] == token)
+
+    def stats(self):
+        stats = self._series.stats()
+        stats.update({'requests': self.requests, 'fetched': self.fetched})
+        return stats
+
+
+metric_cache = MetricCache()
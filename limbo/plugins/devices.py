@@ -8,20 +8,24 @@ import re
 import json
 from datetime import datetime
 from datetime import timedelta
-from serverdensity.wrapper import Device
-from serverdensity.wrapper import Metrics
+
+import pytz
 
 from limbo.plugins.common.basewrapper import BaseWrapper
+from limbo.plugins.common.basewrapper import BATCH_LIMIT
+from limbo.plugins.common.pool import fetch_all
+from limbo.plugins.common.series import Series
 
 COMMANDS = ['find', 'value', 'available', 'list', 'help']
+PREFIXES = ['devices', 'device']
+PATTERN = re.compile(r"^[sS][dD][bB]ot devices? (\b\w+\b)\s?((\.?[\/0-9A-Za-z.\s\[\]\-()_]+){1,3} for)?\s?(.*)?")
 COLOR = '#E83880'
 
 
 class Wrapper(BaseWrapper):
     def __init__(self, msg, server):
         super(Wrapper, self).__init__(msg, server)
-        self.device = Device(self.token)
-        self.metrics = Metrics(self.token)
+        self.metrics = self.clients.metrics
 
     def results_of(self, command, metrics, name):
         if command == 'help' or name == 'help':
@@ -42,8 +46,10 @@ class Wrapper(BaseWrapper):
                 'title': 'Latest Value for a Device',
                 'mrkdwn_in': ['text'],
                 'text': ('To get the latest value for a device, type ' +
-                         '`sdbot devices metric.here for deviceName`. ' +
-                         'The metrics need to be separated by dots.'),
+                         '`sdbot devices value metric.here for deviceName`. ' +
+                         'The metrics need to be separated by dots. Instead of ' +
+                         'a name you can use a pattern like `web-*` or `group:groupName` ' +
+                         'to get the value for several devices at once.'),
                 'color': COLOR
             },
             'find': {
@@ -122,7 +128,7 @@ class Wrapper(BaseWrapper):
             except ValueError:
                 text = '{} is not a number, now is it. You see, it needs to be.'.format(number)
                 return text
-        devices = self.device.list()
+        devices = self.get_devices()
         if number:
             devices_trunc = devices[:number]
         else:
@@ -131,7 +137,7 @@ class Wrapper(BaseWrapper):
         return self._format_devices(devices_trunc)
 
     def find_device(self, name):
-        devices = self.device.list()
+        devices = self.get_devices()
 
         if not name:
             msg = 'Here are all the devices that I found'
@@ -151,10 +157,12 @@ class Wrapper(BaseWrapper):
         return formatted_devices
 
     def get_value(self, name, metrics):
-        devices = self.device.list()
-        _id = self.find_id(name, [], devices)
+        if self.is_pattern(name):
+            return self.get_values(name, metrics)
+
+        _id = self.find_id(name, 'device')
         if not _id:
-            return 'I couldn\'t find your device'
+            return 'I couldn\'t find your device.' + self.suggest(name, 'device')
 
         if not metrics:
             return ('You have not included any metrics the right way to do it ' +
@@ -162,10 +170,10 @@ class Wrapper(BaseWrapper):
         metrics = metrics.split('.')
         _, filter = self.metric_filter(metrics)
 
-        now = datetime.now()
+        now = datetime.now(pytz.utc)
         past30 = now - timedelta(minutes=35)
 
-        metrics = self.metrics.get(_id, past30, now, filter)
+        metrics = self.get_metrics_data(_id, past30, now, filter)
         device, names = self.get_data(metrics)
 
         if not device.get('data'):
@@ -178,13 +186,53 @@ class Wrapper(BaseWrapper):
             'fields': [
                 {
                     'title': 'Latest Value',
-                    'value': '{}{}'.format(device['data'][-1]['y'], self.extract_unit(device)),
+                    'value': '{}{}'.format(Series.display(Series.from_node(device).latest()),
+                                           self.extract_unit(device)),
                     'short': True
                 }
             ]
         }
         return [result]
 
+    def get_values(self, pattern, metrics):
+        """The latest value of a metric for every device matching `pattern`,
+        as one table"""
+        if not metrics:
+            return ('You have not included any metrics the right way to do it ' +
+                    'is give metrics this way `sdbot devices value memory.memSwapFree for {}`'.format(pattern))
+
+        devices = self.find_devices(pattern)
+        if not devices:
+            return 'I couldn\'t find any devices matching `{}`'.format(pattern)
+        truncated = len(devices) > BATCH_LIMIT
+        devices = devices[:BATCH_LIMIT]
+
+        _, filter = self.metric_filter(metrics.split('.'))
+        now = datetime.now(pytz.utc)
+        past30 = now - timedelta(minutes=35)
+
+        def fetch(device):
+            return self.get_data(self.get_metrics_data(device['_id'], past30, now, filter))
+
+        names = metrics.split('.')
+        rows = []
+        for device, (result, error) in zip(devices, fetch_all(fetch, devices)):
+            if error is not None:
+                value = 'error: {}'.format(error)
+            elif not result or not result[0].get('data'):
+                value = 'no data'
+            else:
+                node, names = result
+                value = '{}{}'.format(Series.display(Series.from_node(node).latest()), self.extract_unit(node))
+            rows.append((device['name'], value))
+
+        width = max(len(device_name) for device_name, _ in rows)
+        table = '\n'.join('{}  {}'.format(device_name.ljust(width), value) for device_name, value in rows)
+        text = 'Latest values of {} for `{}`'.format(' > '.join(names), pattern)
+        if truncated:
+            text += ', showing the first {} devices'.format(BATCH_LIMIT)
+        return text + '\n```' + table + '```'
+
     def flatten(self, lst):
         for dct in lst:
             key = dct["key"]
@@ -195,12 +243,11 @@ class Wrapper(BaseWrapper):
                     yield [key] + result
 
     def get_available(self, name):
-        devices = self.device.list()
-        _id = self.find_id(name, [], devices)
+        _id = self.find_id(name, 'device')
 
         if not _id:
-            return 'It looks like there is no device named `{}`'.format(name)
-        now = datetime.now()
+            return 'It looks like there is no device named `{}`.'.format(name) + self.suggest(name, 'device')
+        now = datetime.now(pytz.utc)
         past30 = now - timedelta(minutes=120)
 
         metrics = self.metrics.available(_id, past30, now)
@@ -218,7 +265,7 @@ def on_message(msg, server):
     text = msg.get("text", "")
     text = Wrapper.clean_parsing(text)
 
-    match = re.findall(r"^[sS][dD][bB]ot devices? (\b\w+\b)\s?((\.?[\/0-9A-Za-z.\s\[\]\-()_]+){1,3} for)?\s?(.*)?", text)
+    match = PATTERN.findall(text)
 
     if not match:
         return
@@ -1,42 +1,57 @@
 """{
     "title": "graph <metrics> for <name> from <period>",
-    "text": "This command can display a graph for any of the available metrics for a device. The `metrics` argument needs to be separated by dots, for example `cpuStats.CPUs.usr`. Note that the expression is case sensitive. An example of the command would be `sdbot graph cpuStats.CPUs.usr for deviceName from 24 hours ago`.",
+    "text": "This command can display a graph for any of the available metrics for a device. The `metrics` \
+argument needs to be separated by dots, for example `cpuStats.CPUs.usr`. Note that the expression is case \
+sensitive. An example of the command would be `sdbot graph cpuStats.CPUs.usr for deviceName from 24 hours \
+ago`. Use a pattern like `web-*` or `group:groupName` instead of the name to draw several devices in one \
+graph.",
     "mrkdwn_in": ["text"],
     "color": "#E8A824"
 }"""
 
-import os
 import json
 import re
-import io
-import time
 import importlib
+import logging
+import os
+import calendar
 from datetime import timedelta
 from datetime import datetime
 
-from serverdensity.wrapper import Metrics
-from serverdensity.wrapper import Device
-
-from matplotlib.dates import AutoDateLocator
-from matplotlib.dates import DateFormatter
-from matplotlib import pyplot as plt
-import numpy as np
-
-from slacker import Slacker
 import parsedatetime
 
 from limbo.plugins.common.basewrapper import BaseWrapper
+from limbo.plugins.common.basewrapper import BATCH_LIMIT
+from limbo.plugins.common.basewrapper import MissingToken
+from limbo.plugins.common import downsample
+from limbo.plugins.common.cache import LRUCache
+from limbo.plugins.common.pool import fetch_all
+from limbo.plugins.common.render import renderer
+from limbo.plugins.common.render import RenderBusy
+from limbo.plugins.common.render import WIDTH, DPI
+from limbo.plugins.common.series import Series
+
+logger = logging.getLogger(__name__)
 
 COLOR = "#E8A824"
 COMMANDS = ['graph', 'help']
+PREFIXES = ['graph']
+PATTERN = re.compile(r"^[sS][dD][bB]ot graph ((\.?[\/0-9A-Za-z.\s\[\]\-()_]+){1,3} for)?\s?(.*)")
 
+# every line is cut down to about one point per pixel before it is drawn,
+# with `lttb` or `minmax`, see common/downsample.py
+DOWNSAMPLE = os.environ.get('SD_DOWNSAMPLE', 'lttb')
+MAX_POINTS = int(WIDTH * DPI)
+
+# Rendered graphs are kept for requests for the same devices and metric over
+# the same period, with both ends of the period rounded to
+# SD_GRAPH_CACHE_BUCKET seconds. The PNGs take up to SD_GRAPH_CACHE_MB.
+CACHE_BUCKET = int(os.environ.get('SD_GRAPH_CACHE_BUCKET', 60))
+CACHE_SIZE = int(float(os.environ.get('SD_GRAPH_CACHE_MB', 32)) * 1024 * 1024)
+cache = LRUCache(CACHE_SIZE, sizeof=lambda graph: len(graph[0]))
 
-class Wrapper(BaseWrapper):
-    def __init__(self, msg, server):
-        super(Wrapper, self).__init__(msg, server)
-        self.metrics = Metrics(self.token)
-        self.device = Device(self.token)
 
+class Wrapper(BaseWrapper):
     def results_of(self, metrics, name, period):
         if name == 'help':
             mod = importlib.import_module('limbo.plugins.graph')
@@ -45,100 +60,23 @@ class Wrapper(BaseWrapper):
             result = self.get_metrics(metrics, name, period)
         return result
 
-    def create_graph(self, device, difference):
-
-        # 800 and 355 pixels.
-        ticks = 5
-        width = 8
-        height = 3.55
-
-        dpi = 100
-        bgcolor = '#f3f6f6'
-
-        font = {
-            'size': 16,
-            'family': 'Arial'
-        }
-        plt.rc('font', **font)
-
-        diff_sec = int(difference.total_seconds())
-
-        if diff_sec < 86400:
-            x_no_ticks = 10
-            fmt = '%H:%M'
-        elif (3600*24) < diff_sec and diff_sec < (3600*24*4):
-            x_no_ticks = 5
-            fmt = '%d %b, %H:%M'
-        elif (3600*24*4) < diff_sec:
-            x_no_ticks = 6
-            fmt = '%d %b %Y'
-
-        # size of figure and setting background color
-        fig = plt.gcf()
-        fig.set_size_inches(width, height)
-        fig.set_facecolor(bgcolor)
-
-        # axis color, no ticks and bottom line in grey color.
-        ax = plt.axes(axisbg=bgcolor, frameon=True)
-        ax.xaxis.set_ticks_position('none')
-        ax.spines['bottom'].set_color('#aabcc2')
-        ax.yaxis.set_ticks_position('none')
-
-        # removing all but bottom spines
-        for key, sp in ax.spines.items():
-            if key != 'bottom':
-                sp.set_visible(False)
-
-        # setting amounts of ticks on y axis
-        yloc = plt.MaxNLocator(ticks)
-        ax.yaxis.set_major_locator(yloc)
-
-        # Deciding how many ticks we want on the graph
-        locator = AutoDateLocator(minticks=(x_no_ticks - 2), maxticks=x_no_ticks)
-        formatter = DateFormatter(fmt)
-
-        ax.xaxis.set_major_locator(locator)
-        ax.xaxis.set_major_formatter(formatter)
-
-        # turns off small ticks
-        plt.tick_params(axis='x',
-                        which='both',
-                        bottom='on',
-                        top='off',
-                        pad=10)
-        # Can't seem to set label color differently, changing tick_params color changes labels.
-        ax.xaxis.label.set_color('#FFFFFF')
-
-        # setting dates in x-axis automatically triggers use of AutoDateLocator
-        x = [datetime.fromtimestamp(point['x']) for point in device['data']]
-        y = [point['y'] for point in device['data']]
-        plt.plot(x, y, color='#53b4d4', linewidth=2)
-
-        # pick values for y-axis
-        y_ticks_values = np.array([point['y'] for point in device['data']])
-        y_ticks = np.linspace(y_ticks_values.min(), y_ticks_values.max(), ticks)
-        y_ticks = np.round(y_ticks, decimals=2)
-        plt.yticks(y_ticks, [str(val) + self.extract_unit(device) for val in y_ticks])
-        # plt.ylim(ymin=0.1)  # Only show values of a certain threshold.
-
-        plt.tight_layout()
-        buf = io.BytesIO()
-        plt.savefig(buf,
-                    format='png',
-                    facecolor=fig.get_facecolor(),
-                    dpi=dpi)
-        buf.seek(0)
-        filename = 'graph-{}.png'.format(int(time.time()))
-        with io.open(filename, 'wb') as f:
-            f.write(buf.read())
-        plt.close()
-        return filename
+    def downsample(self, node):
+        series = Series.from_node(node)
+        if DOWNSAMPLE == 'minmax':
+            # two points per bucket
+            return downsample.minmax(series.x, series.y, MAX_POINTS // 2)
+        return downsample.lttb(series.x, series.y, MAX_POINTS)
 
     def get_metrics(self, metrics, name, period):
-        devices = self.device.list()
-        _id = self.find_id(name, [], devices)
-        if not _id:
-            return 'I couldn\'t find your device.'
+        if self.is_pattern(name):
+            devices = self.find_devices(name)[:BATCH_LIMIT]
+            if not devices:
+                return 'I couldn\'t find any devices matching `{}`'.format(name)
+        else:
+            _id = self.find_id(name, 'device')
+            if not _id:
+                return 'I couldn\'t find your device.' + self.suggest(name, 'device')
+            devices = [{'_id': _id, 'name': name}]
 
         metrics_names = metrics.split('.')
         _, filter = self.metric_filter(metrics_names)
@@ -152,26 +90,20 @@ class Wrapper(BaseWrapper):
         if past > now:
             return 'Hey, I can\'t predict your data into the future, your date has to be in the past and now your date is {}'.format(past)
 
-        metrics_data = self.metrics.get(_id, past, now, filter)
-        device, names = self.get_data(metrics_data)
-        if not device.get('data'):
-            text = ('It might be that your device is offline or has no metrics for `{}`.'.format(metrics) +
-                    'You can see what metrics are available by using `sdbot devices available {}`'.format(name))
-            return text
-
-        # creates file
-        try:
-            slack = Slacker(self.server.config['resource']['SlackBotAccessToken'])
-        except KeyError:
-            slack = Slacker(self.server.config['token'])
-        slack.chat.post_message(
-            self.msg['channel'],
-            'Preparing the graphs for you this very moment',
-            as_user=self.server.slack.server.username
-        )
-
-        filename = self.create_graph(device, now - past)
+        key = self.cache_key(devices, filter, past, now)
+        graph = cache.get(key)
+        if graph is None:
+            graph = self.draw(devices, filter, metrics, name, past, now)
+            if isinstance(graph, tuple):
+                cache.put(key, graph)
+        else:
+            logger.debug('graph: cache hit for {} {}'.format(name, metrics))
+        if not isinstance(graph, tuple):
+            # no data, or the renderer is busy
+            return graph
+        png, names = graph
 
+        slack = self.server.slack
         attachment = [
             {
                 'text': ('I brought you a graph for {} for the device `{}`'.format(' '.join(names), name) +
@@ -181,29 +113,72 @@ class Wrapper(BaseWrapper):
             }
         ]
 
-        slack.chat.post_message(
+        # both go out through the outbound queue, in order, see outbound.py
+        slack.post_message(
             self.msg['channel'],
             '',
-            attachments=attachment,
-            as_user=self.server.slack.server.username
+            attachments=json.dumps(attachment),
+            as_user=slack.server.username
         )
 
-        # uploads and sends the graph to channel
-        file_response = slack.files.upload(
-            filename,
-            filename='{}.png'.format(name),
-            channels=self.msg['channel']
-        )
-        # Deletes the graph file after upload so it doesn't litter the container
-        os.remove(filename)
+        # uploads and sends the graph to channel, straight from memory
+        slack.upload_file(self.msg['channel'], '{}.png'.format(name), png, 'image/png')
 
         return None # We're sending information in function itself this time
 
+    def cache_key(self, devices, filter, past, now):
+        def bucket(dt):
+            return calendar.timegm(dt.utctimetuple()) // CACHE_BUCKET
+        return (
+            self.token,
+            tuple((device['_id'], device['name']) for device in devices),
+            json.dumps(filter, sort_keys=True),
+            DOWNSAMPLE,
+            bucket(past),
+            bucket(now)
+        )
+
+    def draw(self, devices, filter, metrics, name, past, now):
+        """Fetches the metrics of `devices` and renders them. Returns a
+        `(png, names)` tuple, or the text to answer with when there is
+        nothing to draw."""
+        def fetch(device):
+            return self.get_data(self.get_metrics_data(device['_id'], past, now, filter))
+
+        # with a pattern every device is fetched at the same time
+        series = []
+        names = metrics.split('.')
+        for device, (result, error) in zip(devices, fetch_all(fetch, devices)):
+            if error is not None:
+                logger.warning('graph: fetching {} failed: {}'.format(device['name'], error))
+            elif result and result[0].get('data'):
+                node, names = result
+                series.append((device['name'], node))
+
+        if not series:
+            text = ('It might be that your device is offline or has no metrics for `{}`.'.format(metrics) +
+                    'You can see what metrics are available by using `sdbot devices available {}`'.format(name))
+            return text
+
+        self.server.slack.post_message(
+            self.msg['channel'],
+            'Preparing the graphs for you this very moment',
+            as_user=self.server.slack.server.username
+        )
+
+        # drawn in a worker process, see common/render.py
+        lines = [(label,) + self.downsample(node) for label, node in series]
+        try:
+            png = renderer.render(lines, int((now - past).total_seconds()), self.extract_unit(series[0][1]))
+        except RenderBusy:
+            return 'I\'m drawing a lot of graphs right now, could you ask me again in a moment?'
+        return png, names
+
 def on_message(msg, server):
     text = msg.get("text", "")
     text = Wrapper.clean_parsing(text)
 
-    match = re.findall(r"^[sS][dD][bB]ot graph ((\.?[\/0-9A-Za-z.\s\[\]\-()_]+){1,3} for)?\s?(.*)", text)
+    match = PATTERN.findall(text)
     if not match:
         return
     _, metrics, name_period = match[0]
@@ -232,3 +207,11 @@ def on_message(msg, server):
         return None
     else:
         return results
+
+
+def on_stop(server):
+    try:
+        token = Wrapper.token_of(server.config)
+    except MissingToken:
+        return
+    cache.discard(lambda key: key[0] == token)
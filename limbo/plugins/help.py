@@ -11,13 +11,19 @@ import json
 
 logger = logging.getLogger(__name__)
 
+# `sdbot help <topic>` and a bare `sdbot`
+PREFIXES = ['help', '']
+PATTERN = re.compile(r"^sdbot help(?:\s+(.*))?$", re.IGNORECASE)
+# a bare `sdbot`, or `sdbot <word>` for a word that isn't a command
+BARE_PATTERN = re.compile(r'^[sS][dD][bB]ot\s?(\S*)\s*$')
+
 def on_message(msg, server):
     text = msg.get("text", "")
     logger.debug(text)
-    match = re.findall(r"^[sS][dD][bB]ot help\s?( .*)?", text)
+    match = PATTERN.findall(text)
 
     if not match:
-        match = re.findall(r'^[sS][dD][bB]ot\s?(.?)?$', text)
+        match = BARE_PATTERN.findall(text)
     if not match:
         return
 
@@ -28,7 +34,7 @@ def on_message(msg, server):
     else:
         # if no plugin has a docstring, there's no help key
         helpdict = server.hooks.get("help", {})
-        attachments = sorted([attach for attach in helpdict.values()])
+        attachments = sorted(helpdict.values(), key=lambda attach: attach.get('title', ''))
         kwargs = {
             'attachments': json.dumps(attachments),
             'text': 'I know lots of commands, try one out!'
@@ -15,6 +15,7 @@ from serverdensity.wrapper import Alert
 from limbo.plugins.common.basewrapper import BaseWrapper
 
 COMMANDS = ['open alerts', 'services', 'devices', 'help']
+PREFIXES = ['list']
 COLOR = '#3EB891'
 
 
@@ -204,11 +205,8 @@ class Wrapper(BaseWrapper):
             text = 'Instead of `{}` you should have used `group`, `service`, `device` or `all`'.format(typeof), ''
             return text
 
-        services = self.service.list()
-        devices = self.device.list()
-
         if name:
-            _id = name if not name else self.find_id(name, services, devices)
+            _id = name if not name else self.find_id(name)
             params['filter']['config.subjectId'] = _id
 
         if typeof == 'group':
@@ -231,7 +229,7 @@ class Wrapper(BaseWrapper):
             triggered_time = time.localtime(alert['config']['lastTriggeredAt']['sec'])
 
             _id = alert['config']['subjectId']
-            name = self.find_name(_id, services, devices)
+            name = self.find_name(_id)
             attachment = {
                 'title': '{}'.format(name),
                 'text': '{} {} {}'.format(
@@ -6,28 +6,31 @@
 }"""
 
 import json
-import requests
+import os
 import re
 
 from datetime import timedelta
 from datetime import datetime
 
-from serverdensity.wrapper import Service
-from serverdensity.wrapper import Metrics
-from serverdensity.wrapper import ServiceStatus
+import pytz
+
 from limbo.plugins.common.basewrapper import BaseWrapper
+from limbo.plugins.common.pool import fetch_all
+from limbo.plugins.common.series import Series
 
-COMMANDS = ['status', 'find', 'list', 'help']
-BASEURL = 'https://api.serverdensity.io/'
+COMMANDS = ['status', 'value', 'find', 'list', 'help']
+PREFIXES = ['services', 'service']
+PATTERN = re.compile(r"^[sS][dD][bB]ot services? (\b\w+\b)\s?(\b\w+\b)?")
 COLOR = '#8E44AD'
+# seconds we wait for the metrics of a single check location
+LOCATION_TIMEOUT = float(os.environ.get('SD_LOCATION_TIMEOUT', 10))
 
 
 class Wrapper(BaseWrapper):
     def __init__(self, msg, server):
         super(Wrapper, self).__init__(msg, server)
-        self.service = Service(self.token)
-        self.metrics = Metrics(self.token)
-        self.status = ServiceStatus(self.token)
+        self.service = self.clients.service
+        self.status = self.clients.status
 
     def results_of(self, command, name):
         if command == 'help' or name == 'help':
@@ -152,7 +155,7 @@ class Wrapper(BaseWrapper):
                 text = '{} is not a number, now is it. You see, it needs to be.'.format(number)
                 return text, ''
 
-        services = self.service.list()
+        services = self.get_services()
         if number:
             services_trunc = services[:number]
         else:
@@ -169,7 +172,7 @@ class Wrapper(BaseWrapper):
 
     def find_service(self, name):
 
-        services = self.service.list()
+        services = self.get_services()
         http = [s for s in services if s['checkType'] == 'http' and
                 re.search(name, s['name'])]
         tcp = [s for s in services if s['checkType'] == 'tcp' and
@@ -178,25 +181,37 @@ class Wrapper(BaseWrapper):
         return self._format_services(http, tcp), ''
 
     def get_value(self, name):
-        services = self.service.list()
-        _id = self.find_id(name, services, [])
+        _id = self.find_id(name, 'service')
         if not _id:
-            return 'I couldn\'t find your service', ''
+            return 'I couldn\'t find your service.' + self.suggest(name, 'service'), ''
         service = self.service.view(_id)
         locations = service['checkLocations']
-        all_results = []
-        for location in locations:
+        now = datetime.now(pytz.utc)
+        past30 = now - timedelta(minutes=35)
+
+        def fetch(location):
             filtered = {'time': {location: 'all'}}
-            now = datetime.now()
-            past30 = now - timedelta(minutes=35)
+            return self.get_metrics_data(_id, past30, now, filtered)
+
+        # every location is fetched at the same time
+        fetched = fetch_all(fetch, locations, LOCATION_TIMEOUT)
+
+        all_results = []
+        for location, (metrics, error) in zip(locations, fetched):
+            if error is not None:
+                all_results.append({
+                    'title': location,
+                    'color': COLOR,
+                    'text': 'I couldn\'t get the values for this location: {}'.format(error)
+                })
+                continue
 
-            metrics = self.metrics.get(_id, past30, now, filtered)
             service = metrics[0]['tree'][0]
-            data = service['data']
-            try:
-                latest = '{}s'.format(round(data[-1]['y'], 3))
-                avg = '{}s'.format(round(sum([point['y'] for point in data])/len(data), 3))
-            except IndexError:
+            series = Series.from_node(service)
+            if len(series):
+                latest = '{}s'.format(round(series.latest(), 3))
+                avg = '{}s'.format(round(series.mean(), 3))
+            else:
                 latest = 'down'
                 avg = 'down'
 
@@ -227,18 +242,17 @@ class Wrapper(BaseWrapper):
                 return node['name']
 
     def get_status(self, name):
-        services = self.service.list()
-        _id = self.find_id(name, services, [])
+        _id = self.find_id(name, 'service')
         if not _id:
-            return 'I couldn\'t find your service', ''
-        nodes = requests.get(BASEURL + 'service-monitor/nodes', params={'token': self.token})
+            return 'I couldn\'t find your service.' + self.suggest(name, 'service'), ''
+        nodes = self.clients.get('service-monitor/nodes')
         statuses = self.status.location(_id)
 
         all_results = []
         for status in statuses:
 
             result = {
-                'title': self.real_name(status['location'], nodes.json()),
+                'title': self.real_name(status['location'], nodes),
                 'color': COLOR,
                 'fields': [
                     {
@@ -272,7 +286,7 @@ def on_message(msg, server):
     text = msg.get("text", "")
     text = Wrapper.clean_parsing(text)
 
-    match = re.findall(r"^[sS][dD][bB]ot services? (\b\w+\b)\s?(\b\w+\b)?", text)
+    match = PATTERN.findall(text)
     if not match:
         return
     command, name = match[0]
@@ -0,0 +1,53 @@
+"""{
+    "title": "stats",
+    "text": "Shows which commands, plugins, Server Density API calls and Slack posts are slowest, \
+and how many events I'm handling.",
+    "mrkdwn_in": ["text"],
+    "color": "#71CADC"
+}"""
+import re
+
+from limbo.metrics import metrics
+
+PREFIXES = ['stats']
+PATTERN = re.compile(r"^[sS][dD][bB]ot stats\s*$")
+# rows shown per section
+ROWS = 5
+
+SECTIONS = [
+    # words that aren't commands are timed as '', and answered by help
+    ('Commands', 'limbo_command_seconds', lambda labels: '`sdbot {0}`'.format(labels['command'] or 'help')),
+    ('Plugins', 'limbo_hook_seconds', lambda labels: '{0} ({1})'.format(labels['plugin'], labels['hook'])),
+    ('Server Density API', 'sd_api_seconds', lambda labels: labels['endpoint']),
+    ('Slack posts', 'slack_post_seconds', lambda labels: labels['method']),
+]
+
+
+def seconds(value):
+    if value < 1:
+        return '{0:.0f}ms'.format(value * 1000)
+    return '{0:.2f}s'.format(value)
+
+
+def report():
+    lines = ['*Events*: {0} handled, {1:.2f}/s over the last minute, {2} waiting'.format(
+        metrics.total('limbo_events_total'), metrics.rate(), metrics.gauge('limbo_event_queue_depth'))]
+    for title, name, describe in SECTIONS:
+        rows = metrics.summary(name)
+        if not rows:
+            continue
+        lines.append('*{0}*, slowest first:'.format(title))
+        for labels, count, mean, p50, p99 in rows[:ROWS]:
+            lines.append('{0}: {1} calls, mean {2}, p50 {3}, p99 {4}'.format(
+                describe(labels), count, seconds(mean), seconds(p50), seconds(p99)))
+    errors = metrics.total('sd_api_errors_total')
+    if errors:
+        lines.append('{0} Server Density API calls failed'.format(errors))
+    return '\n'.join(lines)
+
+
+def on_message(msg, server):
+    text = msg.get("text", "")
+    if not PATTERN.match(text):
+        return
+    return report()
@@ -0,0 +1,210 @@
+"""Replays a log of Slack events through the plugins.
+
+    bin/limbo --replay events.jsonl --speed 10 --fixtures fixtures/
+
+The log holds one RTM event per line, as json. Lines wrapping the event in
+an `event` key are read too; blank lines, lines starting with # and anything
+else are skipped. Events are dispatched at the pace their `ts` says, sped up
+`speed` times (0 sends them as fast as they can be handled), on
+`concurrency` threads.
+
+Replies go to a FakeSlack sink instead of Slack, graph's uploads included.
+Server Density is a StubApi: its generated inventory, or the answers
+recorded in the `fixtures` directory (see stubapi.FixtureStore). With
+`record`, answers missing from the fixtures are fetched from the real API
+with SD_AUTH_TOKEN and kept.
+
+Every event's reply, what it posted and how long it took is written out as a
+line of json, followed by a summary line.
+"""
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from slackrtm.server import User, Bot
+from serverdensity.wrapper import ApiClient
+
+from .bench import percentile
+from .fakeserver import FakeServer, FakeSlack
+from .handlers import handle_event, run_stop
+from .stubapi import FixtureStore, StubApi
+
+logger = logging.getLogger(__name__)
+
+
+class Users(dict):
+    """Every id is somebody, as the log comes from a real team"""
+
+    def __missing__(self, key):
+        return User(None, key, key, "", 0)
+
+
+class Bots(dict):
+    def __missing__(self, key):
+        return Bot(key, key, [], False)
+
+
+class ReplaySlack(FakeSlack):
+    """The sink of one replayed event"""
+
+    def __init__(self):
+        super(ReplaySlack, self).__init__()
+        self.server.users = Users()
+        self.server.bots = Bots()
+
+
+def read_events(path):
+    """The events logged in the json lines file `path`"""
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("replay: line {0} of {1} isn't json, skipped".format(number, path))
+                continue
+            if isinstance(record, dict) and isinstance(record.get("event"), dict):
+                record = record["event"]
+            if isinstance(record, dict) and "type" in record:
+                yield record
+            else:
+                logger.debug("replay: line {0} of {1} isn't an event, skipped".format(number, path))
+
+
+def timestamp(event):
+    try:
+        return float(event.get("ts"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Replay(object):
+    def __init__(self, hooks, config, speed=1.0, concurrency=1):
+        self.hooks = hooks
+        self.config = config
+        self.speed = speed
+        self.concurrency = concurrency
+        self.records = []
+        # the sink of the event being handled in each channel, for the Web
+        # API calls that reach the stub
+        self._sinks = {}
+        self._lock = threading.Lock()
+
+    def on_slack(self, method, params):
+        channel = params.get("channel") or params.get("channels")
+        with self._lock:
+            sink = self._sinks.get(channel)
+        if sink is not None:
+            sink.sent.append((channel, params.get("text", ""), {"method": method}))
+
+    def handle(self, event, due):
+        sink = ReplaySlack()
+        channel = event.get("channel")
+        if isinstance(channel, dict):
+            channel = channel.get("id")
+        server = FakeServer(slack=sink, config=self.config, hooks=self.hooks)
+        with self._lock:
+            self._sinks[channel] = sink
+        started = time.time()
+        try:
+            response = handle_event(event, server)
+            error = None
+        except Exception as e:
+            response, error = None, repr(e)
+        seconds = time.time() - started
+        with self._lock:
+            if self._sinks.get(channel) is sink:
+                del self._sinks[channel]
+
+        record = {
+            "ts": event.get("ts"),
+            "type": event.get("type"),
+            "channel": channel,
+            "text": event.get("text"),
+            "lag": round(max(started - due, 0), 6),
+            "seconds": round(seconds, 6),
+            "response": response,
+            "posted": [{"channel": c, "text": text, "attachments": kwargs.get("attachments")}
+                       for c, text, kwargs in sink.sent],
+        }
+        if error:
+            record["error"] = error
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def run(self, events, out):
+        """Dispatches `events` on their schedule, writing a record of each
+        to `out` as they finish. Returns the summary."""
+        executor = ThreadPoolExecutor(self.concurrency)
+        started = time.time()
+        first = None
+        futures = []
+        write_lock = threading.Lock()
+
+        def write(future):
+            with write_lock:
+                out.write(json.dumps(future.result()) + "\n")
+
+        for event in events:
+            ts = timestamp(event)
+            due = started
+            if self.speed and ts is not None:
+                first = ts if first is None else first
+                due = started + (ts - first) / self.speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            future = executor.submit(self.handle, event, max(due, started))
+            future.add_done_callback(write)
+            futures.append(future)
+        executor.shutdown(wait=True)
+        return self.summary(time.time() - started)
+
+    def summary(self, elapsed):
+        seconds = [record["seconds"] for record in self.records]
+        answered = [record for record in self.records if record["response"] or record["posted"]]
+        return {
+            "summary": True,
+            "events": len(self.records),
+            "answered": len(answered),
+            "errors": len([record for record in self.records if "error" in record]),
+            "elapsed": round(elapsed, 3),
+            "p50": percentile(seconds, 0.5),
+            "p99": percentile(seconds, 0.99),
+            "max_lag": max([record["lag"] for record in self.records] or [0]),
+        }
+
+
+def replay_file(path, hooks, speed=1.0, concurrency=1, fixtures=None, record=False, output=None):
+    """Replays the event log `path` through `hooks`, writing the records to
+    the file `output` or stdout"""
+    store = None
+    if fixtures:
+        store = FixtureStore(fixtures, upstream=ApiClient.BASE_URL if record else None)
+    # a generated inventory only stands in when there are no fixtures
+    stub = StubApi(devices=0 if store else 100, services=0 if store else 10, fixtures=store).start()
+    token = os.environ.get("SD_AUTH_TOKEN", "replay") if record else "replay"
+    config = {"resource": {"SD_AUTH_TOKEN": token, "SlackBotAccessToken": "replay"}}
+    replay = Replay(hooks, config, speed, concurrency)
+    stub.on_slack = replay.on_slack
+    stub.install()
+
+    out = open(output, "w") if output else sys.stdout
+    try:
+        summary = replay.run(read_events(path), out)
+        out.write(json.dumps(summary) + "\n")
+    finally:
+        stub.stop()
+        run_stop(hooks, FakeServer(config=config, hooks=hooks))
+        if output:
+            out.close()
+    logger.info("replay: {events} events, {answered} answered, {errors} errors in {elapsed}s".format(**summary))
+    return summary
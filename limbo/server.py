@@ -1,6 +1,14 @@
+from slackrtm import SlackClient
+
+from .outbound import OutboundSlack, WebTransport
+
+
 class LimboServer(object):
     def __init__(self, slack, config, hooks, db):
-        self.slack = slack
+        # everything sent goes through the outbound dispatcher; a real client
+        # sends with the Web API, see outbound.py
+        transport = WebTransport(slack.token) if isinstance(slack, SlackClient) else None
+        self.slack = OutboundSlack(slack, transport)
         self.config = config
         self.hooks = hooks
         self.db = db
@@ -12,3 +20,8 @@ class LimboServer(object):
         c.close()
         self.db.commit()
         return rows
+
+    def close(self):
+        """Sends what's still queued for Slack, then lets go of the
+        connections"""
+        self.slack.close()
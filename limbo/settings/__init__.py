@@ -9,6 +9,15 @@ def init_config():
     getif(config, "plugins", "LIMBO_PLUGINS")
     getif(config, "heroku", "LIMBO_ON_HEROKU")
     getif(config, "beepboop", "BEEPBOOP_TOKEN")
+    getif(config, "loop_interval", "LIMBO_LOOP_INTERVAL")
+    getif(config, "ping_interval", "LIMBO_PING_INTERVAL")
+    getif(config, "async", "LIMBO_ASYNC")
+    getif(config, "concurrency", "LIMBO_CONCURRENCY")
+    getif(config, "workers", "LIMBO_WORKERS")
+    getif(config, "drain_timeout", "LIMBO_DRAIN_TIMEOUT")
+    getif(config, "metrics_port", "LIMBO_METRICS_PORT")
+    getif(config, "slack_interval", "LIMBO_SLACK_INTERVAL")
+    getif(config, "slack_workers", "LIMBO_SLACK_WORKERS")
     return config
 
 CONFIG = init_config()
@@ -0,0 +1,315 @@
+"""A local stand-in for the Server Density API, for benchmarks and replays.
+
+StubApi serves the endpoints the plugins use from a generated inventory of
+`devices` devices and `services` services, answering every request after
+`latency` seconds. Metric series are made up on the fly for whatever filter
+and range is asked for, with a point every `step` seconds.
+
+Given a FixtureStore, recorded answers are served first. A store with an
+`upstream` fetches what it doesn't hold yet from the real API and keeps it.
+
+It also answers the Slack Web API calls of the outbound dispatcher
+(chat.postMessage, files.upload) and hands them to `on_slack`, so nothing
+leaves the machine. `install()` points the serverdensity wrapper and the
+dispatcher at the stub, `uninstall()` puts them back.
+"""
+import calendar
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+import requests
+from serverdensity.wrapper import ApiClient
+
+from . import outbound
+
+logger = logging.getLogger(__name__)
+
+GROUPS = 5
+LOCATIONS = ['lon', 'nyc', 'sfo']
+# query parameters that change with every request and don't pick the answer
+VOLATILE = ('token', 'start', 'end')
+ISOFORMAT = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.\d+)?(?:([+-])(\d\d):(\d\d))?$')
+
+
+def object_id(kind, number):
+    """A 24 character id, like the mongo ids of the real API"""
+    return '{0}{1:023x}'.format(kind, number)
+
+
+class FixtureStore(object):
+    """Recorded API answers, one json file per endpoint in `directory`:
+    `inventory/devices.json`, `metrics/graphs/<id>.json`... The answer to
+    one particular query, `<endpoint>@<key>.json` with the key from
+    `query_key`, is preferred over the endpoint's file."""
+
+    def __init__(self, directory, upstream=None):
+        self.directory = directory
+        self.upstream = upstream
+        self._lock = threading.Lock()
+
+    def query_key(self, query):
+        stable = sorted((k, v) for k, v in query.items() if k not in VOLATILE)
+        return hashlib.sha1(json.dumps(stable).encode('utf8')).hexdigest()[:12]
+
+    def paths(self, path, query):
+        endpoint = os.path.join(self.directory, *path.strip('/').split('/'))
+        return endpoint + '@' + self.query_key(query) + '.json', endpoint + '.json'
+
+    def load(self, path, query):
+        """The recorded answer to a GET of `path`, or None"""
+        for filename in self.paths(path, query):
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    return json.load(f)
+
+    def save(self, path, query, body):
+        """Keeps `body` as the answer to `query`, and to any query of the
+        endpoint unless it already has one"""
+        exact, endpoint = self.paths(path, query)
+        with self._lock:
+            if not os.path.isdir(os.path.dirname(exact)):
+                os.makedirs(os.path.dirname(exact))
+            for filename in (exact, endpoint):
+                if filename == exact or not os.path.exists(filename):
+                    with open(filename, 'w') as f:
+                        json.dump(body, f, indent=2, sort_keys=True)
+
+    def fetch(self, path, query):
+        """(status, body) from the upstream API, keeping good answers"""
+        response = requests.get(self.upstream + path, params=query, timeout=(3, 30))
+        body = response.json()
+        if response.status_code == 200:
+            self.save(path, query, body)
+        return response.status_code, body
+
+
+class StubApi(object):
+    def __init__(self, devices=100, services=10, alerts=0, latency=0.0, step=60, fixtures=None):
+        self.latency = latency
+        self.fixtures = fixtures
+        self.step = step
+        self.requests = 0
+        self.on_slack = None
+        self._saved = None
+        self._server = None
+        self._lock = threading.Lock()
+
+        now = int(time.time())
+        self.devices = [{
+            '_id': object_id('d', i),
+            'name': 'web-{0}'.format(i),
+            'group': 'group-{0}'.format(i % GROUPS),
+            'provider': 'stub',
+            'lastPayloadAt': {'sec': now}
+        } for i in range(devices)]
+        self.services = [self.service(i) for i in range(services)]
+        self.alerts = [{
+            '_id': object_id('a', i),
+            'fixed': False,
+            'config': {
+                '_id': object_id('c', i),
+                'subjectId': self.devices[i % len(self.devices)]['_id'] if self.devices else 'group-0',
+                'subjectType': 'device',
+                'fullName': 'System > Load average',
+                'fullComparison': 'more than',
+                'value': 4,
+                'group': 'group-{0}'.format(i % GROUPS),
+                'lastTriggeredAt': {'sec': now - i * 60}
+            }
+        } for i in range(alerts)]
+        self._routes = [
+            (re.compile(r'^/inventory/devices$'), lambda q: self.devices),
+            (re.compile(r'^/inventory/services$'), lambda q: self.services),
+            (re.compile(r'^/inventory/devices/(\w+)$'), lambda q, _id: self.find(self.devices, _id)),
+            (re.compile(r'^/inventory/services/(\w+)$'), lambda q, _id: self.find(self.services, _id)),
+            (re.compile(r'^/metrics/graphs/(\w+)$'), self.graphs),
+            (re.compile(r'^/metrics/definitions/(\w+)$'), self.definitions),
+            (re.compile(r'^/alerts/triggered$'), lambda q: self.alerts),
+            (re.compile(r'^/service-monitor/last/(\w+)$'), self.last),
+            (re.compile(r'^/service-monitor/nodes$'), self.nodes),
+        ]
+
+    def service(self, i):
+        # the wrapper validates services against its json schema
+        service = {
+            '_id': object_id('s', i),
+            'name': 'check-{0}'.format(i),
+            'group': 'group-{0}'.format(i % GROUPS),
+            'timeout': 10,
+            'slowThreshold': 500,
+            'checkLocations': LOCATIONS
+        }
+        if i % 2 == 0:
+            service.update({'checkType': 'http', 'checkUrl': 'https://example.com/{0}'.format(i), 'checkMethod': 'GET'})
+        else:
+            service.update({'checkType': 'tcp', 'host': 'example.com', 'port': '443', 'data': ''})
+        return service
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self._server.server_port)
+
+    def start(self):
+        stub = self
+
+        class Handler(StubHandler):
+            api = stub
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='stubapi')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.uninstall()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def install(self):
+        """Sends the wrapper's and the dispatcher's requests to the stub"""
+        if self._saved is None:
+            self._saved = (ApiClient.BASE_URL, outbound.API_BASE_URL)
+        ApiClient.BASE_URL = self.url
+        outbound.API_BASE_URL = self.url + '/slack/{api}'
+
+    def uninstall(self):
+        if self._saved is not None:
+            ApiClient.BASE_URL, outbound.API_BASE_URL = self._saved
+            self._saved = None
+
+    def answer(self, path, query):
+        """(status, body) for a GET of `path`"""
+        with self._lock:
+            self.requests += 1
+        if self.fixtures is not None:
+            body = self.fixtures.load(path, query)
+            if body is not None:
+                return 200, body
+            if self.fixtures.upstream:
+                return self.fixtures.fetch(path, query)
+        for pattern, route in self._routes:
+            match = pattern.match(path)
+            if match:
+                body = route(query, *match.groups())
+                if body is None:
+                    return 404, {'message': 'not found'}
+                return 200, body
+        return 404, {'message': 'no stub for {0}'.format(path)}
+
+    def find(self, entities, _id):
+        for entity in entities:
+            if entity['_id'] == _id:
+                return entity
+
+    def graphs(self, query, _id):
+        start = timestamp(query['start'])
+        end = timestamp(query['end'])
+        filter = json.loads(query.get('filter', '{}'))
+        first = start - start % self.step + self.step
+        data = [{'x': x, 'y': round(50 + 40 * math.sin(x / 3600.0), 2)}
+                for x in range(first, end + 1, self.step)]
+        return tree(filter, data)
+
+    def definitions(self, query, _id):
+        return [{'key': 'cpuStats', 'name': 'CPU Stats', 'tree': [
+            {'key': 'CPUs', 'name': 'CPUs', 'tree': [{'key': 'usr', 'name': 'usr'}, {'key': 'sys', 'name': 'sys'}]}
+        ]}, {'key': 'memory', 'name': 'Memory', 'tree': [{'key': 'memSwapFree', 'name': 'Swap free'}]}]
+
+    def last(self, query, _id):
+        return [{'location': location, 'rtt': 0.05, 'time': 0.2, 'status': 'up', 'code': 200}
+                for location in LOCATIONS]
+
+    def nodes(self, query):
+        return [{'id': location, 'name': location.upper()} for location in LOCATIONS]
+
+
+def timestamp(value):
+    """Seconds since the epoch of a datetime's isoformat(); naive ones are
+    UTC, as for the real API"""
+    match = ISOFORMAT.match(value)
+    seconds = calendar.timegm(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+    if match.group(2):
+        offset = (int(match.group(3)) * 60 + int(match.group(4))) * 60
+        seconds += -offset if match.group(2) == '+' else offset
+    return seconds
+
+
+def tree(filter, data):
+    """The metric tree the API answers for `filter`, each leaf holding `data`"""
+    nodes = []
+    for key, value in sorted(filter.items()):
+        node = {'key': key, 'name': key}
+        if isinstance(value, dict):
+            node['tree'] = tree(value, data)
+        else:
+            node['data'] = data
+            node['unit'] = '%'
+        nodes.append(node)
+    return nodes
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    api = None
+    # keep-alive, as the real API does
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if self.api.latency:
+            time.sleep(self.api.latency)
+        status, body = self.api.answer(url.path, query)
+        self.respond(status, body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if not url.path.startswith('/slack/'):
+            self.respond(404, {'message': 'no stub for {0}'.format(url.path)})
+            return
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        content_type = self.headers.get('Content-Type') or ''
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params.update((k, v[0]) for k, v in parse_qs(body.decode('utf8')).items())
+        elif content_type.startswith('multipart/form-data'):
+            # files.upload; the channel is all we need
+            match = re.search(br'name="channels"\r\n\r\n([^\r]*)', body)
+            if match:
+                params['channels'] = match.group(1).decode('utf8')
+        if self.api.on_slack is not None:
+            self.api.on_slack(url.path[len('/slack/'):], params)
+        self.respond(200, {'ok': True})
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug('stubapi: ' + format, *args)
@@ -0,0 +1,401 @@
+"""Many Slack teams served by one process.
+
+With Beep Boop every team that installs the bot is a resource, and beepboop's
+BotManager gives each one its own Slackbot: its own copy of the plugins, a
+thread blocked in `loop()` and another one sleeping in BotRunner.
+
+TenantManager takes BotManager's place for the Resourcer. The plugins are
+loaded once and shared. A single thread waits on the RTM sockets of every
+team at once, and plugin hooks run on one fixed pool of worker threads. No
+team may have more than `concurrency` events in the pool; any more wait in
+that team's backlog, so one busy team can't starve the others.
+
+A team that is removed stops being read at once, but keeps its connection
+until its events in flight are handled or `drain_timeout` seconds pass. Then
+the socket is closed and the `stop` hooks run, so the plugins can free what
+they hold for the team.
+
+A team whose connection breaks is reconnected with backoff (see
+connection.py) while its plugins, caches and work in flight carry on.
+
+Each team still gets its own SlackClient and LimboServer, whose config holds
+the team's resource. The plugins key their Server Density clients and caches
+on the SD token from that resource, so no state is shared between teams.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import select
+import socket
+import threading
+import time
+import traceback
+
+from slackrtm import SlackClient
+
+from .connection import CONNECTION_ERRORS, EventDeduper, backoff, check_event, close_websocket
+from .handlers import handle_event, run_hook, run_stop
+from .metrics import metrics
+from .server import LimboServer
+from .settings import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# default size of the worker pool shared by all teams
+WORKERS = 16
+# default number of events of a single team handled at the same time
+CONCURRENCY = 8
+# how often teams without a socket (FakeSlack) are polled for events
+POLL_INTERVAL = 0.05
+# default seconds a removed team gets to finish the events in flight
+DRAIN_TIMEOUT = 10
+
+
+class Tenant(object):
+    """A team's connection to Slack and the work in flight for it"""
+
+    def __init__(self, resource, server):
+        self.id = resource['resourceID']
+        self.resource = resource
+        self.server = server
+        self.in_flight = 0
+        self.backlog = deque()
+        self.loop_hook = None
+        self.next_loop_hook = 0
+        self.last_activity = time.time()
+        self.drain_deadline = None
+        self.closed = False
+        self.deduper = EventDeduper()
+        # while the connection is down replies are held back, and a new
+        # connection is tried at `reconnect_at`
+        self.connected = True
+        self.held = []
+        self.reconnect_attempt = 0
+        self.reconnect_at = None
+        self.connecting = None
+
+    def idle(self):
+        return self.in_flight == 0 and not self.backlog and (self.loop_hook is None or self.loop_hook.done())
+
+    def socket(self):
+        websocket = getattr(self.server.slack.server, "websocket", None)
+        return getattr(websocket, "sock", None)
+
+    def reply(self, event, response):
+        if self.closed:
+            # sending would have slackrtm reconnect the closed socket
+            return
+        if not self.connected:
+            self.held.append((event, response))
+            return
+        if isinstance(event['channel'], dict):
+            channel_id = event['channel']['id']
+        else:
+            channel_id = event['channel']
+        self.server.slack.rtm_send_message(channel_id, response)
+
+    def ping(self):
+        websocket = getattr(self.server.slack.server, "websocket", None)
+        if websocket is None:
+            self.server.slack.server.ping()
+        else:
+            # slackrtm's ping reconnects on the spot when sending fails
+            websocket.send(json.dumps({"type": "ping"}))
+
+    def close(self):
+        self.closed = True
+        metrics.add("limbo_event_queue_depth", -len(self.backlog))
+        self.backlog.clear()
+        self.held = []
+        close_websocket(self.server.slack)
+
+
+class TenantManager(object):
+    """Runs a Slack connection for every Beep Boop resource. Implements the
+    add/update/get/remove_bot_resource calls of beepboop's BotManager."""
+
+    def __init__(self, hooks, config=CONFIG, Client=SlackClient, ServerClass=LimboServer):
+        self.hooks = hooks
+        self.config = config
+        self.Client = Client
+        self.ServerClass = ServerClass
+        self.loop_interval = float(config.get("loop_interval", 1))
+        self.ping_interval = float(config.get("ping_interval", 5))
+        self.concurrency = int(config.get("concurrency", CONCURRENCY))
+        self.drain_timeout = float(config.get("drain_timeout", DRAIN_TIMEOUT))
+        self.executor = ThreadPoolExecutor(int(config.get("workers", WORKERS)))
+
+        # only touched by the loop thread
+        self.tenants = {}
+        # removed teams finishing their work
+        self.draining = []
+        # the latest resource of every team, whether connected yet or not
+        self.resources = {}
+        self._lock = threading.Lock()
+        # work handed to the loop thread by other threads
+        self._calls = deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._thread = None
+        self._running = False
+        self._stopping = False
+
+    # the BotManager interface, called from the Resourcer's thread
+
+    def add_bot_resource(self, resource):
+        logger.debug("tenants: adding resource {0}".format(resource['resourceID']))
+        with self._lock:
+            self.resources[resource['resourceID']] = resource
+        # connecting takes a few round trips, keep it off the loop thread
+        return self.executor.submit(self._connect, resource)
+
+    def update_bot_resource(self, resource):
+        logger.debug("tenants: updating resource {0}".format(resource['resourceID']))
+        self.remove_bot_resource(resource['resourceID'])
+        return self.add_bot_resource(resource)
+
+    def get_bot_resource(self, resource_id):
+        """The resource of a team, connected or not, or None"""
+        with self._lock:
+            return self.resources.get(resource_id)
+
+    def remove_bot_resource(self, resource_id):
+        logger.debug("tenants: removing resource {0}".format(resource_id))
+        with self._lock:
+            self.resources.pop(resource_id, None)
+        self.call_soon(self._remove, resource_id)
+
+    def start(self):
+        """Starts the loop thread"""
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name="limbo-tenants")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Removes every team, lets them drain, and ends the loop"""
+        with self._lock:
+            resource_ids = list(self.resources)
+            self.resources.clear()
+        for resource_id in resource_ids:
+            self.call_soon(self._remove, resource_id, timeout)
+        self._stopping = True
+        self._wake()
+        if self._thread is not None:
+            self._thread.join((self.drain_timeout if timeout is None else timeout) + 1)
+        self.executor.shutdown(wait=False)
+
+    def call_soon(self, func, *args):
+        """Runs `func(*args)` on the loop thread"""
+        self._calls.append((func, args))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"x")
+        except socket.error:
+            # the buffer is full, so the loop is waking up anyway
+            pass
+
+    def _connect(self, resource):
+        try:
+            config = dict(self.config)
+            config['resource'] = resource['resource']
+            slack = self.Client(resource['resource']['SlackBotAccessToken'])
+            server = self.ServerClass(slack, config, self.hooks, None)
+            slack.rtm_connect()
+        except Exception:
+            logger.warning("tenants: connecting {0} failed".format(resource['resourceID']))
+            logger.warning("{0}".format(traceback.format_exc()))
+            return
+        self.call_soon(self._add, Tenant(resource, server))
+
+    def _add(self, tenant):
+        with self._lock:
+            current = self.resources.get(tenant.id)
+        if current is not tenant.resource:
+            # removed or updated while it was connecting
+            tenant.close()
+            return
+        self.tenants[tenant.id] = tenant
+        logger.info("tenants: serving {0}, {1} teams in all".format(tenant.id, len(self.tenants)))
+
+    def _remove(self, resource_id, timeout=None):
+        """Stops reading from a team; it's closed once drained"""
+        tenant = self.tenants.pop(resource_id, None)
+        if tenant is None:
+            return
+        tenant.drain_deadline = time.time() + (self.drain_timeout if timeout is None else timeout)
+        self.draining.append(tenant)
+        self._drain(time.time())
+
+    def _drain(self, now):
+        for tenant in list(self.draining):
+            if tenant.idle() or now >= tenant.drain_deadline:
+                if not tenant.idle():
+                    logger.warning("tenants: {0} still busy after draining, closing it anyway".format(tenant.id))
+                self.draining.remove(tenant)
+                tenant.close()
+                self.executor.submit(self._stop, tenant.server)
+                logger.info("tenants: closed {0}, {1} teams left".format(tenant.id, len(self.tenants)))
+
+    def _stop(self, server):
+        run_stop(self.hooks, server)
+        # sends the replies still queued for the team, off the loop thread
+        server.close()
+
+    def run(self, test_loop=None):
+        """The loop: waits for events from any team, hands them to the pool,
+        sends the replies, and runs the `loop` hooks and keepalive pings of
+        every team when they're due.
+        test_loop, if present, is a number of times to run the loop"""
+        while self._running or test_loop is not None:
+            if test_loop is not None:
+                if test_loop <= 0:
+                    break
+                test_loop -= 1
+            if self._stopping and not self._calls and not self.tenants and not self.draining:
+                self._running = False
+                break
+
+            self._run_calls()
+            for tenant in self._wait():
+                self._read(tenant)
+            self._run_calls()
+
+            now = time.time()
+            self._drain(now)
+            for tenant in list(self.tenants.values()):
+                if now >= tenant.next_loop_hook and (tenant.loop_hook is None or tenant.loop_hook.done()):
+                    tenant.loop_hook = self.executor.submit(run_hook, self.hooks, "loop", tenant.server)
+                    tenant.next_loop_hook = now + self.loop_interval
+                if not tenant.connected:
+                    if tenant.connecting is None and now >= tenant.reconnect_at:
+                        tenant.connecting = self.executor.submit(self._reconnect, tenant)
+                elif now - tenant.last_activity >= self.ping_interval:
+                    try:
+                        tenant.ping()
+                    except CONNECTION_ERRORS as e:
+                        self._lost(tenant, e)
+                    tenant.last_activity = now
+
+    def _wait(self):
+        """Blocks until a team's socket is readable or a timer is due, and
+        returns the teams that may have events waiting"""
+        now = time.time()
+        due = now + self.loop_interval
+        ready = []
+        sockets = {}
+        for tenant in self.draining:
+            due = min(due, tenant.drain_deadline)
+        for tenant in self.tenants.values():
+            due = min(due, tenant.next_loop_hook)
+            if not tenant.connected:
+                if tenant.connecting is None:
+                    due = min(due, tenant.reconnect_at)
+                continue
+            due = min(due, tenant.last_activity + self.ping_interval)
+            sock = tenant.socket()
+            if sock is None:
+                # no real socket (FakeSlack in tests), so just poll rtm_read
+                ready.append(tenant)
+                due = min(due, now + POLL_INTERVAL)
+            elif hasattr(sock, "pending") and sock.pending():
+                # the SSL layer holds decrypted bytes that select can't see
+                ready.append(tenant)
+            else:
+                sockets[sock] = tenant
+
+        timeout = 0 if self._calls else max(due - now, 0)
+        readable, _, _ = select.select([self._wake_r] + list(sockets), [], [], timeout)
+        if self._wake_r in readable:
+            try:
+                while self._wake_r.recv(4096):
+                    pass
+            except socket.error:
+                pass
+        return ready + [sockets[sock] for sock in readable if sock in sockets]
+
+    def _read(self, tenant):
+        try:
+            events = tenant.server.slack.rtm_read()
+            for event in events:
+                check_event(event)
+        except CONNECTION_ERRORS as e:
+            self._lost(tenant, e)
+            return
+        if events:
+            tenant.last_activity = time.time()
+        for event in events:
+            logger.debug("got {0}".format(event.get("type", event)))
+            if tenant.deduper.seen(event):
+                logger.debug("tenants: dropping repeated event {0}".format(event.get("ts")))
+                continue
+            metrics.add("limbo_event_queue_depth", 1)
+            self._dispatch(tenant, event)
+
+    def _lost(self, tenant, error):
+        tenant.connected = False
+        delay = backoff(tenant.reconnect_attempt)
+        tenant.reconnect_at = time.time() + delay
+        logger.warning("tenants: connection of {0} lost ({1}), reconnecting in {2:.1f}s".format(
+            tenant.id, error, delay))
+
+    def _reconnect(self, tenant):
+        # runs on a worker thread
+        close_websocket(tenant.server.slack)
+        try:
+            tenant.server.slack.rtm_connect()
+        except Exception as e:
+            self.call_soon(self._reconnected, tenant, e)
+        else:
+            self.call_soon(self._reconnected, tenant, None)
+
+    def _reconnected(self, tenant, error):
+        tenant.connecting = None
+        if tenant.closed or self.tenants.get(tenant.id) is not tenant:
+            close_websocket(tenant.server.slack)
+            return
+        if error is not None:
+            tenant.reconnect_attempt += 1
+            self._lost(tenant, error)
+            return
+        logger.info("tenants: {0} reconnected after {1} attempts".format(tenant.id, tenant.reconnect_attempt + 1))
+        tenant.connected = True
+        tenant.reconnect_attempt = 0
+        tenant.last_activity = time.time()
+        held, tenant.held = tenant.held, []
+        for event, response in held:
+            tenant.reply(event, response)
+
+    def _dispatch(self, tenant, event):
+        if tenant.in_flight >= self.concurrency:
+            tenant.backlog.append(event)
+            return
+        tenant.in_flight += 1
+        future = self.executor.submit(handle_event, event, tenant.server)
+        future.add_done_callback(lambda future: self.call_soon(self._done, tenant, event, future))
+
+    def _done(self, tenant, event, future):
+        tenant.in_flight -= 1
+        metrics.add("limbo_event_queue_depth", -1)
+        if tenant.closed:
+            return
+        if future.exception() is not None:
+            logger.warning("Failed to handle event {0}: {1}".format(event, future.exception()))
+        elif future.result():
+            try:
+                tenant.reply(event, future.result())
+            except Exception:
+                logger.warning("tenants: replying to {0} failed".format(tenant.id))
+        if tenant.backlog:
+            self._dispatch(tenant, tenant.backlog.popleft())
+
+    def _run_calls(self):
+        while self._calls:
+            func, args = self._calls.popleft()
+            try:
+                func(*args)
+            except Exception:
+                logger.warning("{0}".format(traceback.format_exc()))
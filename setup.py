@@ -17,7 +17,7 @@ required = ['requests>=2.5', 'websocket-client==0.32.0',
         'beautifulsoup4==4.4.1', 'html5lib==0.9999999', 'pyfiglet==0.7.4',
         'slackrtm==0.2.1']
 if not PYTHON3:
-    required += ['importlib>=1.0.3']
+    required += ['importlib>=1.0.3', 'futures>=3.0.5']
 
 try:
     longdesc = open("README.rs").read()
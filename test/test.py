@@ -1,13 +1,25 @@
 # -*- coding: UTF-8 -*-
 from collections import namedtuple
+import json
 import logging
 from .mock_handler import MockHandler
 import os
 import sqlite3
+import sys
 import tempfile
+import threading
+import time
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_
 
 import limbo
+from limbo import bench
+from limbo.connection import ConnectionLost, EventDeduper, backoff
+from limbo.manifest import LazyHook, read_manifest
+from limbo.metrics import Histogram, Metrics, metrics, serve_metrics
+from limbo.outbound import ClientTransport, Message, OutboundSlack, Outbound, RateLimited, WebTransport
+from limbo.replay import read_events, replay_file
+from limbo.stubapi import FixtureStore, StubApi
 
 # test plugin hooks
 #
@@ -84,6 +96,38 @@ def test_missing_hook():
     hooks = limbo.init_plugins("test/plugins")
     eq_(limbo.run_hook(hooks, "nonexistant", {"text": u"!echo bananas"}, None), [])
 
+# test run_command
+
+def echo_command(msg, server):
+    return msg["text"]
+
+def test_run_command():
+    hooks = {"commands": {"echo": echo_command}}
+    eq_(limbo.run_command(hooks, {"text": u"sdbot echo bananas"}, None), [u"sdbot echo bananas"])
+    eq_(limbo.run_command(hooks, {"text": u"SDBot echo bananas"}, None), [u"SDBot echo bananas"])
+
+def test_run_command_ignores_chatter():
+    hooks = {"commands": {"echo": echo_command}}
+    eq_(limbo.run_command(hooks, {"text": u"echo bananas"}, None), [])
+    eq_(limbo.run_command(hooks, {"text": u"sdbotecho bananas"}, None), [])
+    eq_(limbo.run_command(hooks, {"text": u"sdbot nothere bananas"}, None), [])
+
+def test_run_command_unknown_word_goes_to_help():
+    hooks = limbo.init_plugins(None, ["help"])
+    server = limbo.FakeServer(hooks=hooks)
+    eq_(limbo.run_command(hooks, {"text": u"sdbot x", "channel": "C1"}, server), [u"No help found for x"])
+    eq_(limbo.run_command(hooks, {"text": u"sdbot nothere", "channel": "C1"}, server),
+        [u"No help found for nothere"])
+    # only a single word is taken for a help topic
+    eq_(limbo.run_command(hooks, {"text": u"sdbot not there", "channel": "C1"}, server), [])
+
+def test_run_command_ignores_case():
+    hooks = limbo.init_plugins(None, ["help"])
+    server = limbo.FakeServer(hooks=hooks)
+    eq_(limbo.run_command(hooks, {"text": u"SDBOT help x", "channel": "C1"}, server),
+        limbo.run_command(hooks, {"text": u"sdbot help x", "channel": "C1"}, server))
+    eq_(limbo.run_command(hooks, {"text": u"sdbot HELP x", "channel": "C1"}, server), [u"No help found for x"])
+
 # test handle_message
 
 def test_handle_message_subtype():
@@ -153,3 +197,589 @@ def test_loop_hook():
     limbo.loop(server, test_loop=1)
 
     eq_(server._loop_plugin_ran, True)
+
+# test the multi-tenant runtime
+
+class FakeTenantClient(limbo.FakeSlack):
+    def __init__(self, token):
+        super(FakeTenantClient, self).__init__()
+        self.token = token
+        self.sent = []
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_send_message(self, channel, message):
+        self.sent.append((channel, message))
+
+def resource(resource_id, token):
+    return {"resourceID": resource_id, "resource": {"SlackBotAccessToken": token}}
+
+def test_tenants_share_plugins():
+    hooks = limbo.init_plugins("test/plugins")
+    manager = limbo.TenantManager(hooks, {}, Client=FakeTenantClient, ServerClass=limbo.FakeServer)
+    manager.add_bot_resource(resource("r1", "t1")).result()
+    manager.add_bot_resource(resource("r2", "t2")).result()
+    manager.run(test_loop=1)
+
+    eq_(sorted(manager.tenants), ["r1", "r2"])
+    for tenant in manager.tenants.values():
+        assert tenant.server.hooks is hooks
+        eq_(tenant.server.config["resource"], manager.resources[tenant.id]["resource"])
+
+def test_tenants_reply():
+    hooks = limbo.init_plugins("test/plugins")
+    manager = limbo.TenantManager(hooks, {}, Client=FakeTenantClient, ServerClass=limbo.FakeServer)
+    manager.add_bot_resource(resource("r1", "t1")).result()
+    manager.run(test_loop=1)
+
+    slack = manager.tenants["r1"].server.slack
+    slack.events.append([{"type": "message", "user": "2", "text": u"!echo hi", "channel": "C1"}])
+    for _ in range(20):
+        manager.run(test_loop=1)
+        if slack.sent:
+            break
+    eq_(slack.sent, [("C1", u"!echo hi")])
+
+def test_tenants_get_bot_resource():
+    manager = limbo.TenantManager({}, {}, Client=FakeTenantClient, ServerClass=limbo.FakeServer)
+    manager.add_bot_resource(resource("r1", "t1"))
+    eq_(manager.get_bot_resource("r1")["resourceID"], "r1")
+    eq_(manager.get_bot_resource("r2"), None)
+    manager.remove_bot_resource("r1")
+    eq_(manager.get_bot_resource("r1"), None)
+
+def test_tenants_remove():
+    manager = limbo.TenantManager({}, {}, Client=FakeTenantClient, ServerClass=limbo.FakeServer)
+    manager.add_bot_resource(resource("r1", "t1")).result()
+    manager.remove_bot_resource("r1")
+    manager.run(test_loop=1)
+    eq_(manager.tenants, {})
+
+def test_tenants_drain_before_closing():
+    stopped = []
+
+    def slow_echo(msg, server):
+        time.sleep(0.2)
+        return msg["text"]
+
+    def on_stop(server):
+        stopped.append(server.config["resource"]["SlackBotAccessToken"])
+
+    hooks = {"message": [slow_echo], "stop": [on_stop]}
+    manager = limbo.TenantManager(hooks, {}, Client=FakeTenantClient, ServerClass=limbo.FakeServer)
+    manager.add_bot_resource(resource("r1", "t1")).result()
+    manager.run(test_loop=1)
+    tenant = manager.tenants["r1"]
+    tenant.server.slack.events.append([{"type": "message", "user": "2", "text": u"bye", "channel": "C1"}])
+    manager.run(test_loop=1)
+    manager.remove_bot_resource("r1")
+    manager.run(test_loop=1)
+    eq_(manager.tenants, {})
+    eq_(tenant.closed, False)
+
+    for _ in range(50):
+        manager.run(test_loop=1)
+        if tenant.closed:
+            break
+    eq_(tenant.closed, True)
+    eq_(tenant.server.slack.sent, [("C1", u"bye")])
+    manager.executor.shutdown(wait=True)
+    eq_(stopped, ["t1"])
+
+def test_slackbot_stop():
+    stopped = []
+    bot = limbo.limbo.Slackbot("token", ServerClass=limbo.FakeServer, Client=FakeTenantClient,
+                               config={"plugins": "none", "loop_interval": 0.05})
+    bot.hooks = {"stop": [lambda server: stopped.append(True)]}
+    thread = threading.Thread(target=bot.start)
+    thread.start()
+    time.sleep(0.1)
+    bot.stop(timeout=1)
+    thread.join(1)
+    eq_(thread.is_alive(), False)
+    eq_(stopped, [True])
+
+def test_stop_releases_the_account_once():
+    from limbo.plugins.common.basewrapper import BaseWrapper
+    released = []
+    saved = BaseWrapper.release
+    BaseWrapper.release = classmethod(lambda cls, config: released.append(BaseWrapper.token_of(config)))
+    try:
+        stopped = []
+        hooks = {"stop": [lambda server: stopped.append(1), lambda server: stopped.append(2)]}
+        config = {"resource": {"SD_AUTH_TOKEN": "sd1"}}
+        limbo.handlers.run_stop(hooks, limbo.FakeServer(config=config))
+        eq_(stopped, [1, 2])
+        eq_(released, ["sd1"])
+        # a team without an SD token has nothing to release
+        saved_token = os.environ.pop("SD_AUTH_TOKEN", None)
+        try:
+            limbo.handlers.run_stop(hooks, limbo.FakeServer(config={"resource": {}}))
+        finally:
+            if saved_token is not None:
+                os.environ["SD_AUTH_TOKEN"] = saved_token
+        eq_(released, ["sd1"])
+    finally:
+        BaseWrapper.release = saved
+
+# test the asyncio runtime
+
+def run_async_bot(hooks, events, concurrency):
+    if sys.version_info < (3, 5):
+        raise SkipTest("the asyncio runtime needs python 3.5")
+    from limbo.aio import AsyncSlackbot
+    bot = AsyncSlackbot("token", ServerClass=limbo.FakeServer, Client=FakeTenantClient,
+                        config={"plugins": "none", "concurrency": concurrency})
+    bot.hooks = hooks
+    bot.server = limbo.FakeServer(FakeTenantClient("token"), {}, hooks)
+    bot.server.slack.events.append(events)
+    bot._connected = True
+    bot.loop(test_loop=1)
+    return bot.server.slack.sent
+
+def message(text, ts):
+    return {"type": "message", "user": "2", "text": text, "channel": "C1", "ts": ts}
+
+def test_async_slow_handler_doesnt_hold_up_others():
+    def echo(msg, server):
+        if msg["text"] == "slow":
+            time.sleep(0.3)
+        return msg["text"]
+
+    sent = run_async_bot({"message": [echo]}, [message(u"slow", "1.1"), message(u"fast", "1.2")], 2)
+    eq_(sent, [("C1", u"fast"), ("C1", u"slow")])
+
+def test_async_concurrency_is_bounded():
+    lock = threading.Lock()
+    running = []
+    most = []
+
+    def busy(msg, server):
+        with lock:
+            running.append(1)
+            most.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return msg["text"]
+
+    events = [message(u"m{0}".format(i), "1.{0}".format(i)) for i in range(6)]
+    sent = run_async_bot({"message": [busy]}, events, 2)
+    eq_(len(sent), 6)
+    eq_(max(most), 2)
+
+# test reconnecting
+
+def test_backoff():
+    for attempt in range(10):
+        delay = backoff(attempt, base=1, cap=8)
+        assert 0 <= delay <= min(8, 2 ** attempt)
+
+def test_event_deduper():
+    deduper = EventDeduper(size=2)
+    eq_(deduper.seen({"type": "message", "channel": "C1", "ts": "1.1"}), False)
+    eq_(deduper.seen({"type": "message", "channel": "C1", "ts": "1.1"}), True)
+    eq_(deduper.seen({"type": "message", "channel": "C2", "ts": "1.1"}), False)
+    eq_(deduper.seen({"type": "hello"}), False)
+    eq_(deduper.seen({"type": "hello"}), False)
+    # forgotten once more than `size` events came after it
+    eq_(deduper.seen({"type": "message", "channel": "C3", "ts": "1.2"}), False)
+    eq_(deduper.seen({"type": "message", "channel": "C1", "ts": "1.1"}), False)
+
+class FlakyClient(FakeTenantClient):
+    """Loses the connection on the first read, then sends the same message
+    twice, as Slack can after a reconnect"""
+    def __init__(self, token):
+        super(FlakyClient, self).__init__(token)
+        self.connects = 0
+        self.reads = 0
+
+    def rtm_connect(self):
+        self.connects += 1
+
+    def rtm_read(self):
+        self.reads += 1
+        if self.reads == 1:
+            raise ConnectionLost("gone")
+        if self.reads == 2:
+            event = {"type": "message", "user": "2", "text": u"!echo hi", "channel": "C1", "ts": "1.1"}
+            return [event, dict(event)]
+        return []
+
+def test_slackbot_reconnects():
+    hooks = limbo.init_plugins("test/plugins")
+    bot = limbo.limbo.Slackbot("token", ServerClass=limbo.FakeServer, Client=FlakyClient,
+                               config={"plugins": "none"})
+    bot.hooks = hooks
+    backoff = limbo.limbo.backoff
+    limbo.limbo.backoff = lambda attempt: 0
+    try:
+        bot.server = limbo.FakeServer(FlakyClient("token"), {}, hooks)
+        bot._connected = True
+        bot.loop(test_loop=3)
+    finally:
+        limbo.limbo.backoff = backoff
+    eq_(bot.server.slack.connects, 1)
+    eq_(bot.server.slack.sent, [("C1", u"!echo hi")])
+
+class BatchClient(FlakyClient):
+    def rtm_read(self):
+        self.reads += 1
+        if self.reads == 1:
+            return [{"type": "message", "user": "2", "text": u"boom", "channel": "C1", "ts": "1.1"},
+                    {"type": "message", "user": "2", "text": u"!echo hi", "channel": "C1", "ts": "1.2"}]
+        return []
+
+def test_slackbot_event_error_keeps_the_connection():
+    hooks = limbo.init_plugins("test/plugins")
+    bot = limbo.limbo.Slackbot("token", ServerClass=limbo.FakeServer, Client=BatchClient,
+                               config={"plugins": "none"})
+    handle_event = limbo.limbo.handle_event
+
+    def failing(event, server):
+        if event["text"] == "boom":
+            raise ValueError("bad event")
+        return handle_event(event, server)
+    limbo.limbo.handle_event = failing
+    try:
+        bot.server = limbo.FakeServer(BatchClient("token"), {}, hooks)
+        bot._connected = True
+        bot.loop(test_loop=2)
+    finally:
+        limbo.limbo.handle_event = handle_event
+    # no reconnect, and the rest of the batch was handled
+    eq_(bot.server.slack.connects, 0)
+    eq_(bot.server.slack.sent, [("C1", u"!echo hi")])
+
+class ReplyLostClient(BatchClient):
+    """Loses the connection sending the first reply"""
+    def rtm_send_message(self, channel, message):
+        if not self.sent:
+            self.sent.append(None)
+            raise ConnectionLost("gone")
+        super(ReplyLostClient, self).rtm_send_message(channel, message)
+
+def test_slackbot_reply_error_reconnects():
+    hooks = limbo.init_plugins("test/plugins")
+    bot = limbo.limbo.Slackbot("token", ServerClass=limbo.FakeServer, Client=ReplyLostClient,
+                               config={"plugins": "none"})
+    backoff = limbo.limbo.backoff
+    limbo.limbo.backoff = lambda attempt: 0
+    try:
+        bot.server = limbo.FakeServer(ReplyLostClient("token"), {}, hooks)
+        bot._connected = True
+        bot.loop(test_loop=2)
+    finally:
+        limbo.limbo.backoff = backoff
+    eq_(bot.server.slack.connects, 1)
+
+def test_tenants_reconnect():
+    hooks = limbo.init_plugins("test/plugins")
+    manager = limbo.TenantManager(hooks, {}, Client=FlakyClient, ServerClass=limbo.FakeServer)
+    manager.add_bot_resource(resource("r1", "t1")).result()
+    manager.run(test_loop=1)
+    tenant = manager.tenants["r1"]
+    eq_(tenant.connected, False)
+    tenant.reconnect_at = 0
+    for _ in range(50):
+        manager.run(test_loop=1)
+        if tenant.server.slack.sent:
+            break
+    assert manager.tenants["r1"] is tenant
+    eq_(tenant.server.slack.connects, 2)
+    eq_(tenant.server.slack.sent, [("C1", u"!echo hi")])
+
+
+# test plugin manifests
+
+LAZY_PLUGIN = '''"""{"title": "lazy", "text": "sdbot lazy"}"""
+import sys
+
+PREFIXES = ['lazy']
+LOADED = True
+
+def on_message(msg, server):
+    return "lazy: " + msg["text"]
+
+def on_stop(server):
+    sys.modules[__name__].stopped = True
+'''
+
+LOOP_PLUGIN = LAZY_PLUGIN + '''
+REQUIRES = {'loop': ['LAZY_CHANNELS']}
+
+def on_loop(server):
+    sys.modules[__name__].looped = True
+'''
+
+def lazy_plugindir(name, source=LAZY_PLUGIN):
+    plugindir = tempfile.mkdtemp()
+    with open(os.path.join(plugindir, name + ".py"), "w") as f:
+        f.write(source)
+    return plugindir
+
+def test_read_manifest():
+    plugindir = lazy_plugindir("lazy_manifest")
+    manifest = read_manifest(os.path.join(plugindir, "lazy_manifest.py"), "lazy_manifest")
+    eq_(manifest.prefixes, ['lazy'])
+    eq_(manifest.hooks, ['message', 'stop'])
+    eq_(manifest.doc, '{"title": "lazy", "text": "sdbot lazy"}')
+    # plugins without PREFIXES are imported as before
+    eq_(read_manifest(os.path.join(DIR, "plugins", "echo.py"), "echo"), None)
+
+def test_plugins_imported_on_first_use():
+    import sys
+    plugindir = lazy_plugindir("lazy_plugin")
+    hooks = limbo.init_plugins(plugindir)
+    assert "lazy_plugin" not in sys.modules
+    assert isinstance(hooks["commands"]["lazy"], LazyHook)
+    eq_(hooks["help"]["lazy_plugin"], {"title": "lazy", "text": "sdbot lazy"})
+
+    # a plugin that was never imported has nothing to stop
+    limbo.run_hook(hooks, "stop", None)
+    assert "lazy_plugin" not in sys.modules
+
+    eq_(limbo.run_command(hooks, {"text": u"sdbot lazy up"}, None), [u"lazy: sdbot lazy up"])
+    assert sys.modules["lazy_plugin"].LOADED
+    limbo.run_hook(hooks, "stop", None)
+    assert sys.modules["lazy_plugin"].stopped
+
+def test_hook_without_its_settings_doesnt_import():
+    plugindir = lazy_plugindir("lazy_loop", LOOP_PLUGIN)
+    manifest = read_manifest(os.path.join(plugindir, "lazy_loop.py"), "lazy_loop")
+    eq_(manifest.requires, {'loop': ['LAZY_CHANNELS']})
+    hooks = limbo.init_plugins(plugindir)
+    limbo.run_hook(hooks, "loop", limbo.FakeServer(config={"resource": {}}))
+    assert "lazy_loop" not in sys.modules
+    limbo.run_hook(hooks, "loop", limbo.FakeServer(config={"resource": {"LAZY_CHANNELS": "#ops"}}))
+    assert sys.modules["lazy_loop"].looped
+
+
+# test reloading plugins
+
+RELOADED_PLUGIN = '''import sys
+
+def on_message(msg, server):
+    return "{0}: " + msg["text"]
+
+def on_stop(server):
+    server.stopped.append("{0}")
+'''
+
+def write_plugin(plugindir, name, version, mtime):
+    path = os.path.join(plugindir, name + ".py")
+    with open(path, "w") as f:
+        f.write(RELOADED_PLUGIN.format(version))
+    os.utime(path, (mtime, mtime))
+
+def test_plugin_reloader():
+    plugindir = tempfile.mkdtemp()
+    now = time.time()
+    write_plugin(plugindir, "reload_one", "one", now - 60)
+    write_plugin(plugindir, "reload_two", "two", now - 60)
+    server = limbo.FakeServer()
+    server.stopped = []
+    reloader = limbo.PluginReloader(plugindir)
+    server.hooks = reloader.load()
+    eq_(reloader.reload(server), [])
+
+    write_plugin(plugindir, "reload_one", "changed", now)
+    eq_(reloader.reload(server), ["reload_one"])
+    # only the old version of the changed plugin was stopped
+    eq_(server.stopped, ["one"])
+    eq_(sorted(limbo.run_hook(server.hooks, "message", {"text": u"hi"}, server)), [u"changed: hi", u"two: hi"])
+    eq_(len(server.hooks["stop"]), 2)
+
+    os.remove(os.path.join(plugindir, "reload_two.py"))
+    eq_(reloader.reload(server), ["reload_two"])
+    eq_(limbo.run_hook(server.hooks, "message", {"text": u"hi"}, server), [u"changed: hi"])
+
+def test_run_cmd_reuses_server():
+    server = limbo.FakeServer(hooks=limbo.init_plugins("test/plugins"))
+    hooks = server.hooks
+    eq_(limbo.limbo.run_cmd(u"!echo one", server, "message"), "!echo one")
+    eq_(limbo.limbo.run_cmd(u"!echo two", server, "message"), "!echo two")
+    assert server.hooks is hooks
+
+# test metrics
+
+def test_histogram_quantiles():
+    histogram = Histogram(buckets=(0.1, 1, 10))
+    for value in [0.05] * 50 + [0.5] * 49 + [20]:
+        histogram.observe(value)
+    eq_(histogram.count, 100)
+    eq_(histogram.cumulative()[-1], (float("inf"), 100))
+    assert histogram.quantile(0.5) <= 0.1
+    assert 0.1 < histogram.quantile(0.99) <= 1
+    eq_(Histogram().quantile(0.5), None)
+
+def test_metrics_render():
+    registry = Metrics(buckets=(0.1, 1))
+    registry.observe("limbo_command_seconds", 0.5, command="graph")
+    registry.inc("sd_api_errors_total", endpoint="Device.list")
+    registry.add("limbo_event_queue_depth", 3)
+    registry.add("limbo_event_queue_depth", -1)
+    text = registry.render()
+    assert "# TYPE limbo_command_seconds histogram" in text
+    assert 'limbo_command_seconds_bucket{command="graph",le="0.1"} 0' in text
+    assert 'limbo_command_seconds_bucket{command="graph",le="+Inf"} 1' in text
+    assert 'limbo_command_seconds_count{command="graph"} 1' in text
+    assert 'sd_api_errors_total{endpoint="Device.list"} 1' in text
+    assert "limbo_event_queue_depth 2" in text
+
+def test_commands_are_timed():
+    hooks = {"commands": {"echo": echo_command}}
+    before = metrics.histogram("limbo_command_seconds", command="echo")
+    before = before.count if before else 0
+    limbo.run_command(hooks, {"text": u"sdbot echo bananas"}, None)
+    eq_(metrics.histogram("limbo_command_seconds", command="echo").count, before + 1)
+    assert metrics.histogram("limbo_hook_seconds", plugin=__name__, hook="message").count
+
+def test_serve_metrics():
+    try:
+        from urllib.request import urlopen
+    except ImportError:
+        from urllib2 import urlopen
+    server = serve_metrics(0, host="127.0.0.1")
+    try:
+        metrics.event("message")
+        body = urlopen("http://127.0.0.1:{0}/metrics".format(server.server_port)).read().decode("utf8")
+        assert 'limbo_events_total{type="message"}' in body
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# test the benchmark harness
+
+def test_stub_api():
+    stub = StubApi(devices=3, services=2, alerts=1)
+    eq_(stub.answer("/inventory/devices", {}), (200, stub.devices))
+    status, graph = stub.answer("/metrics/graphs/x", {
+        "start": "2016-01-01T00:00:00", "end": "2016-01-01T00:05:00",
+        "filter": '{"cpuStats": {"CPUs": {"usr": "all"}}}'})
+    eq_(status, 200)
+    leaf = graph[0]["tree"][0]["tree"][0]
+    eq_(leaf["key"], "usr")
+    eq_(len(leaf["data"]), 5)
+    eq_(stub.answer("/nothing/here", {})[0], 404)
+
+def test_bench_scenario():
+    options = bench.parse_args(["--events", "3", "--runtime", "direct", "--latency", "0"])
+    stub = StubApi(devices=5, services=2).start()
+    stub.install()
+    try:
+        result = bench.run_scenario("devices find", stub, options, limbo.init_plugins(None))
+    finally:
+        stub.stop()
+    eq_(result["answered"], 3)
+    assert result["p99"] >= result["p50"] > 0
+    eq_(bench.compare({"devices find": result}, {"devices find": result}, 0.1), [])
+    slower = dict(result, p99=result["p99"] * 2 + 1, throughput=result["throughput"] / 2)
+    eq_(len(bench.compare({"devices find": slower}, {"devices find": result}, 0.1)), 2)
+    eq_(bench.unanswered({"devices find": result}), [])
+    eq_(bench.unanswered({"devices find": dict(result, answered=1)}),
+        ["devices find: answered 1 of 3 events"])
+
+def test_fixture_store():
+    store = FixtureStore(tempfile.mkdtemp())
+    eq_(store.load("/inventory/devices", {}), None)
+    store.save("/inventory/devices", {"filter": "a"}, [{"name": "a"}])
+    eq_(store.load("/inventory/devices", {"filter": "a", "token": "x"}), [{"name": "a"}])
+    # the first answer also stands in for other queries of the endpoint
+    store.save("/inventory/devices", {"filter": "b"}, [{"name": "b"}])
+    eq_(store.load("/inventory/devices", {"filter": "b"}), [{"name": "b"}])
+    eq_(store.load("/inventory/devices", {"filter": "c"}), [{"name": "a"}])
+
+    stub = StubApi(devices=0, services=0, fixtures=store)
+    eq_(stub.answer("/inventory/devices", {"filter": "b"}), (200, [{"name": "b"}]))
+    eq_(stub.answer("/inventory/services", {})[0], 200)
+
+def test_replay():
+    fixtures = tempfile.mkdtemp()
+    FixtureStore(fixtures).save("/inventory/devices", {}, [
+        {"_id": "d1", "name": "recorded-1", "group": "g", "provider": "x", "lastPayloadAt": {"sec": 0}}])
+    log = os.path.join(fixtures, "events.jsonl")
+    with open(log, "w") as f:
+        f.write('# a comment\n\n')
+        f.write('{"type": "message", "user": "U1", "text": "sdbot devices list", "channel": "C1", "ts": "1.0"}\n')
+        f.write('{"event": {"type": "message", "user": "U2", "text": "nothing", "channel": "C2", "ts": "1.5"}}\n')
+    eq_(len(list(read_events(log))), 2)
+
+    output = os.path.join(fixtures, "out.jsonl")
+    summary = replay_file(log, limbo.init_plugins(None), speed=0, fixtures=fixtures, output=output)
+    eq_((summary["events"], summary["answered"], summary["errors"]), (2, 1, 0))
+    with open(output) as f:
+        records = [json.loads(line) for line in f]
+    eq_(records[-1]["summary"], True)
+    devices = [r for r in records if r.get("channel") == "C1"][0]
+    assert "recorded-1" in devices["posted"][0]["attachments"]
+
+# test the outbound dispatcher
+
+def test_outbound_merges_queued_messages():
+    slack = limbo.FakeSlack()
+    dispatcher = Outbound(interval=0.2, workers=1)
+    out = OutboundSlack(slack, dispatcher=dispatcher)
+    out.rtm_send_message("C1", u"a")
+    assert dispatcher.flush(out.transport, 1)
+    # the channel has to wait now, so these queue up and go out as one
+    out.rtm_send_message("C1", u"b")
+    out.rtm_send_message("C1", u"c")
+    out.post_message("C1", "", attachments="[]")
+    out.rtm_send_message("C2", u"d")
+    assert dispatcher.flush(out.transport, 2)
+    eq_([(channel, message) for channel, message, _ in slack.sent if channel == "C1"],
+        [("C1", u"a"), ("C1", u"b\nc"), ("C1", "")])
+    eq_(slack.sent[1], ("C2", u"d", {}))
+
+def test_outbound_drops_idle_channels():
+    slack = limbo.FakeSlack()
+    dispatcher = Outbound(interval=0.1, workers=1)
+    out = OutboundSlack(slack, dispatcher=dispatcher)
+    for channel in ("C1", "C2", "C3"):
+        out.rtm_send_message(channel, u"hi")
+    assert dispatcher.flush(out.transport, 1)
+    # kept while they have to wait before the next message
+    eq_(len(dispatcher._channels), 3)
+    time.sleep(0.3)
+    eq_(dispatcher._channels, {})
+    out.rtm_send_message("C1", u"again")
+    assert dispatcher.flush(out.transport, 1)
+    eq_(len(slack.sent), 4)
+
+class LimitedTransport(ClientTransport):
+    def __init__(self, slack):
+        super(LimitedTransport, self).__init__(slack)
+        self.tries = []
+
+    def send(self, message):
+        self.tries.append(time.time())
+        if len(self.tries) == 1:
+            raise RateLimited(0.1)
+        return super(LimitedTransport, self).send(message)
+
+def test_outbound_honours_retry_after():
+    slack = limbo.FakeSlack()
+    transport = LimitedTransport(slack)
+    dispatcher = Outbound(interval=0, workers=2)
+    dispatcher.send(transport, Message("rtm", "C1", u"hi"))
+    assert dispatcher.flush(transport, 2)
+    eq_(slack.sent, [("C1", u"hi", {})])
+    eq_(len(transport.tries), 2)
+    assert transport.tries[1] - transport.tries[0] >= 0.1
+
+def test_outbound_web_transport():
+    stub = StubApi(devices=0, services=0).start()
+    calls = []
+    stub.on_slack = lambda method, params: calls.append((method, params.get("channel"), params.get("text")))
+    stub.install()
+    try:
+        transport = WebTransport("t")
+        transport.send(Message("rtm", "C1", u"hi"))
+        transport.send(Message("files.upload", "C1", files={"file": ("g.png", b"png", "image/png")}))
+        transport.close()
+    finally:
+        stub.stop()
+    eq_(calls[0], ("chat.postMessage", "C1", u"hi"))
+    eq_(calls[1][0], "files.upload")
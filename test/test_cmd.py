@@ -37,6 +37,13 @@ def test_repl():
     ret = proc.returncode
     eq_(ret, 0)
 
+def test_repl_reload():
+    proc = subprocess.Popen(["bin/limbo", "-t", "--pluginpath", TESTPLUGINS], stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+    out = proc.communicate(b"reload")[0]
+    out = out.strip().decode("utf8")
+    eq_(out, u"limbo> no plugins changed\nlimbo>")
+    eq_(proc.returncode, 0)
+
 #  XXX: TODO
 # def test_hook():
 #     out, ret = sh(u"limbo -c '' --pluginpath {0} --hook loop".format(TESTPLUGINS))
@@ -0,0 +1,92 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+
+from nose.tools import eq_, with_setup
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(DIR, '../../limbo/plugins'))
+
+import alerts
+import limbo
+
+CONFIG = {"resource": {"SD_AUTH_TOKEN": "test-alerts", "SD_ALERT_CHANNELS": "#ops"}}
+
+class FakeAlerts(object):
+    """Answers `triggered` with whatever alerts are open"""
+    def __init__(self):
+        self.open = []
+        self.calls = 0
+
+    def triggered(self, params):
+        self.calls += 1
+        return list(self.open)
+
+def alert(_id, subject, group, sec):
+    # short subject ids, so no device names are looked up
+    return {"_id": _id, "config": {"_id": _id, "subjectId": subject, "subjectType": "device",
+                                   "fullName": "CPU > usr", "lastTriggeredAt": {"sec": sec},
+                                   "group": group}}
+
+POLLER = alerts.poller
+
+def make_poller():
+    """A poller, an API wrapper with fake alerts and the Slack it posts to"""
+    server = limbo.FakeServer(config=CONFIG)
+    api = alerts.Wrapper({"text": "", "channel": "C1"}, server)
+    api.alert = FakeAlerts()
+    return alerts.AlertPoller(interval=60), api, server.slack
+
+def release():
+    alerts.poller = POLLER
+    alerts.Wrapper.release(CONFIG)
+
+@with_setup(teardown=release)
+def test_first_poll_posts_nothing():
+    poller, api, slack = make_poller()
+    api.alert.open = [alert("a1", "web", "g1", 100)]
+    poller.poll(api)
+    eq_(slack.sent, [])
+    eq_(list(poller.snapshot(api.token)), ["a1"])
+
+@with_setup(teardown=release)
+def test_new_and_resolved_alerts_are_posted():
+    poller, api, slack = make_poller()
+    api.alert.open = [alert("a1", "web", "g1", 100)]
+    poller.poll(api)
+    api.alert.open = [alert("a1", "web", "g1", 100), alert("a2", "db", "g2", 200)]
+    poller.poll(api)
+    eq_([(channel, text) for channel, text, _ in slack.sent], [("#ops", "1 new alerts")])
+    api.alert.open = [alert("a2", "db", "g2", 200)]
+    poller.poll(api)
+    eq_([(channel, text) for channel, text, _ in slack.sent[1:]], [("#ops", "1 alerts resolved")])
+    # nothing changed, nothing posted
+    poller.poll(api)
+    eq_(len(slack.sent), 2)
+
+@with_setup(teardown=release)
+def test_list_is_answered_from_the_snapshot():
+    poller, api, slack = make_poller()
+    alerts.poller = poller
+    api.alert.open = [alert("a1", "web", "g1", 100), alert("a2", "db", "g2", 200),
+                      alert("a3", "cache", "g1", 300)]
+    poller.poll(api)
+    calls = api.alert.calls
+    found, _ = api.list_alerts("list", "group", "g1")
+    eq_([attachment["title"] for attachment in found], ["Group: cache", "Group: web"])
+    found, _ = api.list_alerts("list", "all", "")
+    eq_(len(found), 3)
+    eq_(api.alert.calls, calls)
+
+def test_tick_without_channels_or_token_does_nothing():
+    poller = alerts.AlertPoller(interval=60)
+    saved = os.environ.pop("SD_AUTH_TOKEN", None)
+    try:
+        poller.tick(limbo.FakeServer(config={"resource": {"SD_AUTH_TOKEN": "test-alerts"}}))
+        poller.tick(limbo.FakeServer(config={"resource": {"SD_ALERT_CHANNELS": "#ops"}}))
+        poller.tick(limbo.FakeServer(config={"resource": {"SD_ALERT_CHANNELS": "#ops"}}))
+        eq_(poller._due, {})
+        eq_(poller._warned, True)
+    finally:
+        if saved is not None:
+            os.environ["SD_AUTH_TOKEN"] = saved
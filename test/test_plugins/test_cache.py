@@ -0,0 +1,38 @@
+# -*- coding: UTF-8 -*-
+from nose.tools import eq_
+
+from limbo.plugins.common.cache import LRUCache
+
+def test_hits_and_misses():
+    cache = LRUCache(100)
+    eq_(cache.get("a"), None)
+    cache.put("a", b"12345")
+    eq_(cache.get("a"), b"12345")
+    stats = cache.stats()
+    eq_(stats["hits"], 1)
+    eq_(stats["misses"], 1)
+    eq_(stats["bytes"], 5)
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    cache.get("a")
+    cache.put("c", b"1234")
+    eq_("b" in cache, False)
+    eq_("a" in cache, True)
+    eq_(cache.stats()["evictions"], 1)
+    eq_(cache.size, 8)
+
+def test_too_large():
+    cache = LRUCache(4)
+    cache.put("a", b"12345")
+    eq_(len(cache), 0)
+
+def test_discard():
+    cache = LRUCache(100, sizeof=lambda value: len(value[0]))
+    cache.put(("t1", 1), (b"12", None))
+    cache.put(("t2", 1), (b"34", None))
+    cache.discard(lambda key: key[0] == "t1")
+    eq_(len(cache), 1)
+    eq_(cache.size, 2)
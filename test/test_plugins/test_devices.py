@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+
+from nose.tools import eq_
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(DIR, '../../limbo/plugins'))
+
+import devices
+import limbo
+from limbo.stubapi import StubApi
+
+CONFIG = {"resource": {"SD_AUTH_TOKEN": "test-devices"}}
+
+STUB = StubApi(devices=12, services=0)
+
+def setup_module():
+    STUB.start()
+    STUB.install()
+
+def teardown_module():
+    devices.Wrapper.release(CONFIG)
+    STUB.stop()
+
+def make_api():
+    return devices.Wrapper({"text": "", "channel": "C1"}, limbo.FakeServer(config=CONFIG))
+
+def names(found):
+    return sorted(device["name"] for device in found)
+
+def test_is_pattern():
+    for name in ["web-*", "web-?", "web-[12]", "group:web"]:
+        eq_(devices.Wrapper.is_pattern(name), True)
+    for name in ["web-1", "groupweb", ""]:
+        eq_(devices.Wrapper.is_pattern(name), False)
+
+def test_find_devices_by_glob():
+    api = make_api()
+    eq_(names(api.find_devices("web-1*")), ["web-1", "web-10", "web-11"])
+    eq_(names(api.find_devices("web-[23]")), ["web-2", "web-3"])
+    # globs are case sensitive, as device names are
+    eq_(api.find_devices("WEB-1"), [])
+
+def test_find_devices_by_group():
+    api = make_api()
+    eq_(names(api.find_devices("group:group-2")), ["web-2", "web-7"])
+    eq_(names(api.find_devices("group: group-2")), ["web-2", "web-7"])
+    eq_(api.find_devices("group:nothere"), [])
+
+def test_get_values_stops_at_the_batch_limit():
+    api = make_api()
+    limit = devices.BATCH_LIMIT
+    devices.BATCH_LIMIT = 3
+    try:
+        text = api.get_values("web-*", "cpuStats.CPUs.usr")
+    finally:
+        devices.BATCH_LIMIT = limit
+    assert text.endswith("```")
+    assert "showing the first 3 devices" in text
+    rows = text.split("```")[1].split("\n")
+    eq_([row.split()[0] for row in rows], ["web-0", "web-1", "web-2"])
+    assert all(row.split()[1] != "no" for row in rows)
+
+    eq_(api.get_values("db-*", "cpuStats.CPUs.usr"), "I couldn't find any devices matching `db-*`")
@@ -0,0 +1,28 @@
+# -*- coding: UTF-8 -*-
+from nose.tools import eq_
+import numpy as np
+
+from limbo.plugins.common.downsample import lttb, minmax
+
+X = np.arange(10000, dtype=np.int64)
+Y = np.sin(X / 100.0)
+# a spike that has to survive downsampling
+Y[4321] = 10
+
+def test_lttb():
+    x, y = lttb(X, Y, 100)
+    eq_(len(x), 100)
+    eq_((x[0], x[-1]), (0, 9999))
+    eq_(y.max(), 10)
+    assert np.all(np.diff(x) > 0)
+
+def test_lttb_short_series():
+    x, y = lttb(X[:50], Y[:50], 100)
+    eq_(len(x), 50)
+
+def test_minmax():
+    x, y = minmax(X, Y, 50)
+    assert len(x) <= 102
+    eq_((x[0], x[-1]), (0, 9999))
+    eq_(y.max(), 10)
+    assert np.all(np.diff(x) > 0)
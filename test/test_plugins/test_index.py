@@ -0,0 +1,36 @@
+# -*- coding: UTF-8 -*-
+from nose.tools import eq_
+
+from limbo.plugins.common.index import EntityIndex
+
+SERVICES = [{"_id": "s1", "name": "web"}]
+DEVICES = [
+    {"_id": "d1", "name": "web1"},
+    {"_id": "d2", "name": "Web2"},
+    {"_id": "d3", "name": "db"},
+    {"_id": "d4", "name": "web1"},
+]
+
+def test_name():
+    index = EntityIndex(SERVICES, DEVICES)
+    eq_(index.name("s1"), "web")
+    eq_(index.name("d2"), "Web2")
+    eq_(index.name("nothere"), None)
+
+def test_id():
+    index = EntityIndex(SERVICES, DEVICES)
+    eq_(index.id("web"), "s1")
+    eq_(index.id("web", "device"), None)
+    # the first device with a name wins
+    eq_(index.id("web1"), "d1")
+
+def test_id_ignore_case():
+    index = EntityIndex(SERVICES, DEVICES)
+    eq_(index.id("web2"), None)
+    eq_(index.id("web2", ignore_case=True), "d2")
+
+def test_prefix():
+    index = EntityIndex(SERVICES, DEVICES)
+    eq_(index.prefix("we"), ["web", "web1", "Web2"])
+    eq_(index.prefix("WE", "device", limit=1), ["web1"])
+    eq_(index.prefix("x"), [])
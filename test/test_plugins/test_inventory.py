@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+import threading
+import time
+from nose.tools import eq_, with_setup
+
+from limbo.plugins.common import inventory as inventory_module
+from limbo.plugins.common.inventory import Inventory
+
+class FakeList(object):
+    def __init__(self, name, delay):
+        self.name = name
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def list(self):
+        with self._lock:
+            self.calls += 1
+            calls = self.calls
+        time.sleep(self.delay)
+        return [{"_id": "{0}{1}".format(self.name, calls), "name": "{0}-{1}".format(self.name, calls)}]
+
+class FakeClients(object):
+    def __init__(self, delay):
+        self.device = FakeList("d", delay)
+        self.service = FakeList("s", delay)
+
+class FakeRegistry(object):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.clients = {}
+
+    def get(self, token):
+        return self.clients.setdefault(token, FakeClients(self.delay))
+
+REGISTRY = inventory_module.registry
+
+def use_registry(delay=0):
+    registry = inventory_module.registry = FakeRegistry(delay)
+    return registry
+
+def restore_registry():
+    inventory_module.registry = REGISTRY
+
+@with_setup(teardown=restore_registry)
+def test_snapshot_is_reused_until_the_ttl():
+    registry = use_registry()
+    inventory = Inventory(ttl=0.1, refresh=10)
+    first = inventory.get("t1")
+    assert inventory.get("t1") is first
+    eq_(registry.clients["t1"].device.calls, 1)
+    time.sleep(0.12)
+    second = inventory.get("t1")
+    assert second is not first
+    eq_(second.devices[0]["name"], "d-2")
+
+@with_setup(teardown=restore_registry)
+def test_refresh_in_background():
+    registry = use_registry(0.05)
+    inventory = Inventory(ttl=10, refresh=0.05)
+    first = inventory.get("t1")
+    time.sleep(0.06)
+    # the old snapshot is answered at once while the new one downloads
+    start = time.time()
+    assert inventory.get("t1") is first
+    assert inventory.get("t1") is first
+    assert time.time() - start < 0.04
+    for _ in range(50):
+        if inventory.get("t1") is not first:
+            break
+        time.sleep(0.01)
+    eq_(inventory.get("t1").devices[0]["name"], "d-2")
+    # one refresh for the two stale gets
+    eq_(registry.clients["t1"].device.calls, 2)
+
+@with_setup(teardown=restore_registry)
+def test_single_flight_per_token():
+    registry = use_registry(0.1)
+    inventory = Inventory(ttl=10, refresh=10)
+    results = []
+    threads = [threading.Thread(target=lambda token=token: results.append(inventory.get(token)))
+               for token in ["t1"] * 5 + ["t2"] * 5]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    eq_(registry.clients["t1"].device.calls, 1)
+    eq_(registry.clients["t2"].device.calls, 1)
+    eq_(len(set(id(snapshot) for snapshot in results)), 2)
+
+@with_setup(teardown=restore_registry)
+def test_invalidate():
+    registry = use_registry()
+    inventory = Inventory(ttl=10, refresh=10)
+    inventory.get("t1")
+    inventory.get("t2")
+    inventory.invalidate("t1")
+    eq_(inventory.get("t1").devices[0]["name"], "d-2")
+    eq_(inventory.get("t2").devices[0]["name"], "d-1")
+    inventory.invalidate()
+    eq_(inventory.get("t2").devices[0]["name"], "d-2")
@@ -0,0 +1,43 @@
+# -*- coding: UTF-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import time
+from nose.tools import eq_
+
+from limbo.plugins.common.pool import FetchTimeout, fetch_all
+
+def test_results_in_order():
+    def slow_first(item):
+        time.sleep(0.05 if item == 0 else 0)
+        return item * 10
+    eq_(fetch_all(slow_first, [0, 1, 2]), [(0, None), (10, None), (20, None)])
+
+def test_errors_are_returned():
+    def fail_on_one(item):
+        if item == 1:
+            raise ValueError("bad")
+        return item
+    results = fetch_all(fail_on_one, [0, 1, 2])
+    eq_(results[0], (0, None))
+    eq_(results[1][0], None)
+    assert isinstance(results[1][1], ValueError)
+    eq_(results[2], (2, None))
+
+def test_timeout_only_spoils_the_slow_call():
+    def one_is_slow(item):
+        time.sleep(0.5 if item == "slow" else 0)
+        return item
+    start = time.time()
+    results = fetch_all(one_is_slow, ["fast", "slow"], timeout=0.1)
+    assert time.time() - start < 0.4
+    eq_(results[0], ("fast", None))
+    assert isinstance(results[1][1], FetchTimeout)
+
+def test_timeout_counts_from_the_start_of_each_call():
+    # a single worker runs the calls one after another; each takes less than
+    # the timeout, so none times out although all of them together do
+    pool = ThreadPoolExecutor(1)
+    def nap(item):
+        time.sleep(0.06)
+        return item
+    eq_(fetch_all(nap, [1, 2, 3], timeout=0.1, pool=pool), [(1, None), (2, None), (3, None)])
+    pool.shutdown()
@@ -0,0 +1,30 @@
+# -*- coding: UTF-8 -*-
+from nose.tools import eq_
+
+from limbo.plugins.common.render import RenderBusy, RenderPool
+
+SERIES = [("web-1", [1500000000, 1500000060, 1500000120], [1.0, 2.5, 2.0])]
+
+def test_render_png():
+    pool = RenderPool(workers=1, queue_size=1)
+    try:
+        png = pool.render(SERIES, 120, "%")
+    finally:
+        pool.shutdown()
+    eq_(png[:8], b"\x89PNG\r\n\x1a\n")
+    # the slot is free again
+    eq_(pool._queued, 0)
+
+def test_render_busy():
+    pool = RenderPool(workers=1, queue_size=2)
+    # two graphs already queued
+    assert pool._acquire(0)
+    assert pool._acquire(0)
+    try:
+        pool.render(SERIES, 120, "%", wait=0.05)
+    except RenderBusy:
+        pass
+    else:
+        raise AssertionError("expected RenderBusy")
+    pool._release()
+    assert pool._acquire(0)
@@ -0,0 +1,32 @@
+# -*- coding: UTF-8 -*-
+from nose.tools import eq_
+
+from limbo.plugins.common.series import Series
+
+NODE = {"name": "usr", "data": [
+    {"x": 1500000000, "y": 2},
+    {"x": 1500000060, "y": None},
+    {"x": 1500000120, "y": 4.5},
+]}
+
+def test_from_node():
+    series = Series.from_node(NODE)
+    eq_(len(series), 3)
+    eq_(series.x.tolist(), [1500000000, 1500000060, 1500000120])
+    eq_(str(series.x.dtype), "int64")
+
+def test_stats_skip_missing_values():
+    series = Series.from_node(NODE)
+    eq_(series.min(), 2)
+    eq_(series.max(), 4.5)
+    eq_(series.mean(), 3.25)
+    eq_(series.percentile(100), 4.5)
+    eq_(series.latest(), 4.5)
+
+def test_empty():
+    eq_(len(Series.from_node({"data": []})), 0)
+
+def test_display():
+    eq_(Series.display(3.0), "3")
+    eq_(Series.display(2.25), "2.25")
+    eq_(Series.display(float("nan")), "n/a")
@@ -0,0 +1,28 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+
+from nose.tools import eq_
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(DIR, '../../limbo/plugins'))
+
+from limbo.metrics import metrics
+from stats import on_message
+
+def test_stats():
+    metrics.observe("limbo_command_seconds", 0.25, command="graph")
+    metrics.observe("sd_api_seconds", 2, endpoint="Metrics.get")
+    ret = on_message({"text": u"sdbot stats"}, None)
+    assert "*Commands*, slowest first:" in ret
+    assert "`sdbot graph`:" in ret
+    assert "Metrics.get:" in ret
+
+def test_help_is_labelled():
+    metrics.observe("limbo_command_seconds", 0.01, command="")
+    ret = on_message({"text": u"sdbot stats"}, None)
+    assert "`sdbot help`:" in ret
+    assert "`sdbot `" not in ret
+
+def test_not_stats():
+    eq_(on_message({"text": u"sdbot statsd"}, None), None)
@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+import threading
+import time
+from nose.tools import eq_
+
+from limbo.plugins.common.clients import Clients
+from limbo.plugins.common.throttle import SingleFlight, TokenBucket
+
+def test_bucket_queues_past_the_burst():
+    bucket = TokenBucket(rate=10, burst=2)
+    eq_(bucket.reserve(), 0)
+    eq_(bucket.reserve(), 0)
+    # the next callers wait their turn, one tenth of a second apart
+    assert 0.09 < bucket.reserve() <= 0.1
+    assert 0.19 < bucket.reserve() <= 0.2
+
+def test_bucket_acquire_waits():
+    bucket = TokenBucket(rate=50, burst=1)
+    bucket.acquire()
+    start = time.time()
+    bucket.acquire()
+    assert time.time() - start >= 0.015
+
+def test_single_flight_coalesces():
+    flights = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        release.wait(2)
+        return [{"name": "web-1"}]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("devices", fetch)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while len(flights) == 0:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    eq_(len(calls), 1)
+    eq_(sorted(shared for _, shared in results), [False, True, True, True, True])
+    # everybody gets their own copy
+    results[0][0][0]["name"] = "changed"
+    eq_(results[1][0][0]["name"], "web-1")
+    eq_(len(flights), 0)
+
+def test_single_flight_shares_errors():
+    flights = SingleFlight()
+    try:
+        flights.do("x", lambda: 1 / 0)
+    except ZeroDivisionError:
+        pass
+    else:
+        raise AssertionError("expected the error")
+    # nothing is left behind for later calls
+    eq_(flights.do("x", lambda: 2), (2, False))
+
+def test_clients_call_is_rate_limited():
+    clients = Clients("token", rate=20, burst=1)
+    start = time.time()
+    for i in range(3):
+        eq_(clients.call("Device.list", lambda i: i, i), i)
+    assert time.time() - start >= 0.09
@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+from datetime import datetime
+
+from nose.tools import eq_
+import pytz
+
+from limbo.plugins.common.timeseries import MetricCache
+from limbo.plugins.common.timeseries import merge
+from limbo.plugins.common.timeseries import timestamp
+
+class FakeMetrics(object):
+    """Serves a point every 60 seconds and records the ranges asked for"""
+    def __init__(self):
+        self.calls = []
+
+    def get(self, _id, start, end, filter):
+        first, last = timestamp(start), timestamp(end)
+        self.calls.append((first, last))
+        points = [{"x": x, "y": x % 7} for x in range(first - first % 60, last + 1, 60) if x >= first]
+        return [{"name": "cpuStats", "tree": [{"name": "usr", "data": points}]}]
+
+class FakeClients(object):
+    token = "token"
+    def __init__(self):
+        self.metrics = FakeMetrics()
+
+def at(seconds):
+    return datetime.fromtimestamp(seconds, pytz.utc)
+
+def xs(tree):
+    return [p["x"] for p in tree[0]["tree"][0]["data"]]
+
+def test_merge_orders_points():
+    old = [{"name": "a", "data": [{"x": 60, "y": 1}, {"x": 180, "y": 3}]}]
+    new = [{"name": "a", "data": [{"x": 120, "y": 2}, {"x": 180, "y": 4}]}]
+    merged = merge(old, new)
+    eq_([(p["x"], p["y"]) for p in merged[0]["data"]], [(60, 1), (120, 2), (180, 4)])
+    eq_(len(old[0]["data"]), 2)
+
+def test_fetches_only_missing_tail():
+    clients = FakeClients()
+    cache = MetricCache()
+    start = 1500000000
+    eq_(xs(cache.get(clients, "d1", at(start), at(start + 600), {})), list(range(start, start + 601, 60)))
+    result = cache.get(clients, "d1", at(start + 300), at(start + 900), {})
+    eq_(xs(result), list(range(start + 300, start + 901, 60)))
+    eq_(clients.metrics.calls, [(start, start + 600), (start + 480, start + 900)])
+
+def test_fetches_missing_head():
+    clients = FakeClients()
+    cache = MetricCache()
+    start = 1500000000
+    cache.get(clients, "d1", at(start), at(start + 600), {})
+    result = cache.get(clients, "d1", at(start - 300), at(start + 600), {})
+    eq_(xs(result), list(range(start - 300, start + 601, 60)))
+    eq_(clients.metrics.calls[1], (start - 300, start))
+
+def test_fresh_range_is_not_fetched():
+    clients = FakeClients()
+    cache = MetricCache()
+    cache.get(clients, "d1", at(1500000000), at(1500000600), {})
+    cache.get(clients, "d1", at(1500000000), at(1500000605), {})
+    eq_(len(clients.metrics.calls), 1)
+    eq_(cache.stats()["requests"], 2)
+
+def test_timezones_share_a_series():
+    clients = FakeClients()
+    cache = MetricCache()
+    start = 1500000000
+    london = pytz.timezone("Europe/London")
+    cache.get(clients, "d1", at(start).astimezone(london), at(start + 600).astimezone(london), {})
+    result = cache.get(clients, "d1", at(start), at(start + 600), {})
+    eq_(xs(result), list(range(start, start + 601, 60)))
+    eq_(clients.metrics.calls, [(start, start + 600)])
+    # naive datetimes are UTC, as the API reads them
+    naive = datetime.utcfromtimestamp(start + 600)
+    eq_(xs(cache.get(clients, "d1", at(start), naive, {})), xs(result))
+    eq_(len(clients.metrics.calls), 1)
+
+def test_memory_budget():
+    clients = FakeClients()
+    cache = MetricCache(max_bytes=250 * 15)
+    cache.get(clients, "d1", at(1500000000), at(1500000600), {})
+    cache.get(clients, "d2", at(1500000000), at(1500000600), {})
+    eq_(cache.stats()["entries"], 1)
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+def test_old_points_are_trimmed():
+    import limbo.plugins.common.timeseries as timeseries
+    clock = FakeClock()
+    saved = timeseries.time
+    timeseries.time = clock
+    try:
+        clients = FakeClients()
+        cache = MetricCache(ttl=900)
+        start = 1500000000
+        # a 10 minute window moving on by 5 minutes, asked for every 5 minutes
+        for i in range(10):
+            first = start + i * 300
+            eq_(xs(cache.get(clients, "d1", at(first), at(first + 600), {})),
+                list(range(first, first + 601, 60)))
+            clock.now += 300
+        series = cache._series.get(("token", "d1", "{}"))
+        # only the starts asked for in the last 900 seconds are kept
+        eq_(series.start, start + 6 * 300)
+        eq_(xs(series.tree)[0], start + 6 * 300)
+        eq_(len(xs(series.tree)), (3 * 300 + 600) // 60 + 1)
+    finally:
+        timeseries.time = saved